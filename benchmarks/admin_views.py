@@ -0,0 +1,81 @@
+"""
+Queries, latency and size of the Flask-Admin pages on a seeded database (see seed.py).
+
+    $ DB_CONNECTION_STRING=sqlite:////tmp/bench.sqlite python benchmarks/admin_views.py --characters 100000
+
+With --characters the database is seeded first, with 10 favorites per character. The list
+pages have to make the same number of queries whatever their size, and the forms must not
+load a whole table into a dropdown.
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from seed import seed  # noqa: E402
+
+PAGES = [
+    "/admin/character/",
+    "/admin/character/?search=character+12",
+    "/admin/character/?{gender}=FEMALE",
+    "/admin/planet/",
+    "/admin/user/",
+    "/admin/favoritecharacter/",
+    "/admin/favoriteplanet/",
+    "/admin/character/edit/?id=1",
+    "/admin/planet/edit/?id=1",
+    "/admin/favoritecharacter/new/",
+    "/admin/favoriteplanet/new/",
+]
+
+
+def filter_argument(app, endpoint, column):
+    # ?flt0_<index>, the index of the equal filter of `column` in the filters of the view
+    from flask_admin.contrib.sqla.filters import FilterEqual
+    view = next(view for view in app.extensions["admin"][0]._views if view.endpoint == endpoint)
+    index = next(index for index, flt in enumerate(view._filters or ())
+                 if isinstance(flt, FilterEqual) and flt.column.key == column)
+    return f"flt0_{index}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--characters", type=int, default=0, help="seed this many characters first")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    if args.characters:
+        print(seed(args.characters, max(1, args.characters // 100), max(1, args.characters // 10),
+                   args.characters * 10))
+
+    from sqlalchemy import event
+    from main import create_app
+    from models import db
+
+    # the polls of the job workers would be counted with the queries of the pages
+    app = create_app({"ADMIN": True, "MIGRATIONS": False, "RATELIMIT_ENABLED": False, "JOBS_WORKERS": 0})
+    client = app.test_client()
+    statements = []
+    with app.app_context():
+        # the requests of the test client run on this thread, the job workers and the search index on theirs
+        event.listen(db.engine, "before_cursor_execute", lambda *arguments: statements.append(arguments[2])
+                     if threading.current_thread() is threading.main_thread() else None)
+
+    for path in PAGES:
+        path = path.format(gender=filter_argument(app, "character", "gender"))
+        del statements[:]
+        response = client.get(path)
+        queries = len(statements)
+        timings = []
+        for _ in range(args.repeats):
+            started = time.perf_counter()
+            client.get(path)
+            timings.append((time.perf_counter() - started) * 1000)
+        print(f"{path:<42} {response.status_code} {queries:>4} queries {statistics.median(timings):>9.1f} ms "
+              f"{len(response.get_data()):>10} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Latency of DELETE /planet/<id>?cascade=true against the number of dependents, on a seeded
+database (see seed.py), and the time the job then takes to delete them.
+
+    $ DB_CONNECTION_STRING=sqlite:////tmp/bench.sqlite python benchmarks/cascade_delete.py --residents 10 100 1000 10000
+
+Each round adds a planet with --residents characters, each favorited by the bench user
+and the planet too, then deletes it. The request only queues the job, its latency has to
+stay the same whatever the number of residents, the job time grows with them.
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from seed import BENCH_EMAIL, BENCH_PASSWORD, insert, planet_rows, character_rows  # noqa: E402
+
+
+def add_planet(db, residents, user_id, tag):
+    from models import Planet, Character, FavoriteCharacter, FavoritePlanet
+    from stats import rebuild_favorite_counts
+    now = datetime.now()
+    planet = dict(next(planet_rows(1, now)), name=f"Cascade {tag}", url="")
+    del planet["id"]
+    planet_id = db.session.execute(Planet.__table__.insert(), planet).inserted_primary_key[0]
+    characters = []
+    for row in character_rows(residents, 1, now):
+        del row["id"]
+        characters.append(dict(row, name=f"Cascade {tag} {len(characters)}", homeworld=planet_id))
+    insert(db, Character, characters)
+    ids = [id for (id,) in db.session.query(Character.id).filter(Character.homeworld == planet_id)]
+    insert(db, FavoriteCharacter, [{"character_id": id, "user_id": user_id} for id in ids])
+    insert(db, FavoritePlanet, [{"planet_id": planet_id, "user_id": user_id}])
+    rebuild_favorite_counts(db.session)
+    return planet_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--residents", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    args = parser.parse_args()
+
+    from main import create_app
+    from models import db, User
+    app = create_app({"ADMIN": False, "MIGRATIONS": False, "RATELIMIT_ENABLED": False})
+    client = app.test_client()
+    token = client.post("/login", json={"email": BENCH_EMAIL, "password": BENCH_PASSWORD}).json["access_token"]
+    headers = {"Authorization": "Bearer " + token}
+    with app.app_context():
+        user_id = User.query.filter_by(email=BENCH_EMAIL).first().id
+
+    print(f"{'residents':>9} {'request ms':>11} {'job ms':>9}  result")
+    for residents in args.residents:
+        with app.app_context():
+            planet_id = add_planet(db, residents, user_id, f"{residents} {time.time()}")
+        started = time.perf_counter()
+        response = client.delete(f"/planet/{planet_id}?cascade=true", headers=headers)
+        request_ms = (time.perf_counter() - started) * 1000
+        assert response.status_code == 202, response.status_code
+        while True:
+            job = client.get(response.headers["Location"], headers=headers).json
+            if job["status"] in ("done", "failed"):
+                break
+            time.sleep(0.01)
+        job_ms = (time.perf_counter() - started) * 1000
+        print(f"{residents:>9} {request_ms:>11.2f} {job_ms:>9.0f}  {job['status']} {job['result'] or job['error']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Cost of keeping a client in sync by polling the collections against the change feed,
+and the fan-out of the SSE stream, on a seeded database (see seed.py).
+
+    $ DB_CONNECTION_STRING=sqlite:////tmp/bench.sqlite python benchmarks/change_feed.py --writes 20 --subscribers 50
+
+`poll` makes --writes updates, then compares what a client downloads to pick them up:
+/people and /planets again, or /changes since its cursor. `stream` connects --subscribers
+clients to /changes/stream on a threaded server, makes --writes updates and reports the
+time until every subscriber got each of them and the queries the broadcaster made.
+"""
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from load import percentile, unique  # noqa: E402
+from seed import BENCH_EMAIL, BENCH_PASSWORD  # noqa: E402
+
+
+def update_planet(client, headers, id):
+    # a new value every time, an update that changes nothing is not a change
+    client.patch(f"/planet/{id}", json={"terrain": unique()}, headers=headers)
+
+
+def poll(app, client, headers, writes):
+    cursor = client.get("/changes").json["cursor"]
+    for number in range(writes):
+        update_planet(client, headers, number % 100 + 1)
+    # /changes lists the changes once they settled
+    from changes import change_feed
+    time.sleep(change_feed.settle)
+    results = {}
+    for label, paths in (("collections", ["/people", "/planets"]), ("changes", [f"/changes?since={cursor}"])):
+        started = time.perf_counter()
+        size = sum(len(client.get(path, headers={"Accept-Encoding": "gzip"}).get_data()) for path in paths)
+        results[label] = {"bytes": size, "ms": round((time.perf_counter() - started) * 1000, 2)}
+    return results
+
+
+def read_events(port, ready, received, ids):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    connection.request("GET", "/changes/stream")
+    response = connection.getresponse()
+    ready.release()
+    # the event ids are resume cursors, the change is in the data, the stream may repeat
+    # the changes written just before it connected
+    while len(received) < len(ids):
+        line = response.fp.readline()
+        if line.startswith(b"data: "):
+            id = json.loads(line[6:])["cursor"]
+            if id in ids:
+                received.append((id, time.perf_counter()))
+    connection.close()
+
+
+def stream(app, client, headers, writes, subscribers, port):
+    from sqlalchemy import event
+    from werkzeug.serving import make_server
+    from models import db
+    from changes import latest_cursor
+
+    queries = []
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute",
+                     lambda conn, cursor, statement, *args: queries.append(statement)
+                     if "FROM change_log" in statement and threading.current_thread().name == "change-feed" else None)
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    ready = threading.Semaphore(0)
+    received = [[] for _ in range(subscribers)]
+    with app.app_context():
+        cursor = latest_cursor()
+    ids = set(range(cursor + 1, cursor + writes + 1))
+    readers = [threading.Thread(target=read_events, args=(port, ready, received[index], ids), daemon=True)
+               for index in range(subscribers)]
+    for reader in readers:
+        reader.start()
+    for _ in readers:
+        ready.acquire()
+
+    committed = {}
+    started = time.perf_counter()
+    for number in range(writes):
+        update_planet(client, headers, number % 100 + 1)
+        committed[cursor + number + 1] = time.perf_counter()
+        time.sleep(0.01)
+    for reader in readers:
+        reader.join()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+
+    latencies = [(at - committed[id]) * 1000 for events in received for id, at in events]
+    return {"events": len(latencies), "p50_ms": round(percentile(latencies, 0.5), 2),
+            "p95_ms": round(percentile(latencies, 0.95), 2), "max_ms": round(max(latencies), 2),
+            "broadcaster_queries": len(queries), "seconds": round(elapsed, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writes", type=int, default=20)
+    parser.add_argument("--subscribers", type=int, default=50)
+    parser.add_argument("--port", type=int, default=5098)
+    args = parser.parse_args()
+
+    from main import create_app
+    app = create_app({"ADMIN": False, "MIGRATIONS": False, "RATELIMIT_ENABLED": False})
+    client = app.test_client()
+    token = client.post("/login", json={"email": BENCH_EMAIL, "password": BENCH_PASSWORD}).json["access_token"]
+    headers = {"Authorization": "Bearer " + token}
+
+    print("poll", poll(app, client, headers, args.writes))
+    print("stream", stream(app, client, headers, args.writes, args.subscribers, args.port))
+
+
+if __name__ == "__main__":
+    main()
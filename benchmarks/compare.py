@@ -0,0 +1,52 @@
+"""
+Compares two result files of load.py endpoint by endpoint.
+
+    $ python benchmarks/compare.py before.json after.json --threshold 10
+
+Exits with status 1 when the p95 latency of any endpoint got worse by more than
+--threshold percent, so it can gate a CI job.
+"""
+import argparse
+import json
+import sys
+
+
+def change(before, after):
+    if not before:
+        return None
+    return (after - before) / before * 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed p95 regression in percent")
+    args = parser.parse_args()
+
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    print(f"before {before.get('commit')} ({before.get('mode')}), after {after.get('commit')} ({after.get('mode')})\n")
+
+    regressions = []
+    for endpoint, result in after["endpoints"].items():
+        previous = before["endpoints"].get(endpoint)
+        if previous is None:
+            print(f"{endpoint:<28} new")
+            continue
+        p95 = change(previous["p95_ms"], result["p95_ms"])
+        throughput = change(previous["throughput_rps"], result["throughput_rps"])
+        marker = ""
+        if p95 is not None and p95 > args.threshold:
+            regressions.append(endpoint)
+            marker = "  REGRESSION"
+        print(f"{endpoint:<28} p95 {previous['p95_ms']:>9.2f} -> {result['p95_ms']:>9.2f} ms ({p95:+.1f}%)  "
+              f"throughput {throughput:+.1f}%{marker}")
+
+    if regressions:
+        print(f"\n{len(regressions)} endpoints regressed more than {args.threshold}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
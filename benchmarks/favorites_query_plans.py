@@ -0,0 +1,139 @@
+"""
+Query plans and timings of the favorites hot paths before and after the
+8d2e4b6a1c57 migration (favorites unique constraints and foreign key indexes).
+
+    $ python benchmarks/favorites_query_plans.py --favorites 1000000
+    $ python benchmarks/favorites_query_plans.py --url postgresql://localhost/bench
+
+The tables only have the columns the queries touch, the data is generated
+so that every (user_id, planet_id) and (user_id, character_id) pair is unique.
+"""
+import argparse
+import json
+import os
+import random
+import time
+from sqlalchemy import create_engine, text
+
+SCHEMA = [
+    "CREATE TABLE planet (id INTEGER PRIMARY KEY, name VARCHAR(250) NOT NULL)",
+    "CREATE TABLE character (id INTEGER PRIMARY KEY, name VARCHAR(250) NOT NULL, homeworld INTEGER NOT NULL)",
+    "CREATE TABLE favorite_planet (id INTEGER PRIMARY KEY, planet_id INTEGER NOT NULL, user_id INTEGER NOT NULL)",
+    "CREATE TABLE favorite_character (id INTEGER PRIMARY KEY, character_id INTEGER NOT NULL, user_id INTEGER NOT NULL)",
+]
+
+# same indexes as migrations/versions/8d2e4b6a1c57_.py
+MIGRATION = [
+    "CREATE INDEX ix_character_homeworld ON character (homeworld)",
+    "CREATE INDEX ix_favorite_character_character_id ON favorite_character (character_id)",
+    "CREATE UNIQUE INDEX uq_favorite_character_user_character ON favorite_character (user_id, character_id)",
+    "CREATE INDEX ix_favorite_planet_planet_id ON favorite_planet (planet_id)",
+    "CREATE UNIQUE INDEX uq_favorite_planet_user_planet ON favorite_planet (user_id, planet_id)",
+]
+
+# the statements issued by the favorites routes
+QUERIES = {
+    "favorites of a user (planets)": "SELECT * FROM favorite_planet WHERE user_id = :user_id",
+    "favorites of a user (characters)": "SELECT * FROM favorite_character WHERE user_id = :user_id",
+    "favorite exists / delete (planet)":
+        "SELECT id FROM favorite_planet WHERE user_id = :user_id AND planet_id = :planet_id",
+    "favorite exists / delete (character)":
+        "SELECT id FROM favorite_character WHERE user_id = :user_id AND character_id = :character_id",
+    "residents of a planet": "SELECT id FROM character WHERE homeworld = :planet_id",
+}
+
+EXPLAIN = {
+    "sqlite": "EXPLAIN QUERY PLAN ",
+    "postgresql": "EXPLAIN ",
+    "mysql": "EXPLAIN ",
+}
+
+
+def seed(connection, favorites, users, planets, characters, chunk=50000):
+    connection.execute(text("INSERT INTO planet (id, name) VALUES (:id, :name)"),
+                       [{"id": id, "name": f"planet {id}"} for id in range(1, planets + 1)])
+    for start in range(1, characters + 1, chunk):
+        rows = [{"id": id, "name": f"character {id}", "homeworld": random.randint(1, planets)}
+                for id in range(start, min(start + chunk, characters + 1))]
+        connection.execute(text("INSERT INTO character (id, name, homeworld) VALUES (:id, :name, :homeworld)"), rows)
+
+    per_user = favorites // users
+    for table, column, targets in (("favorite_planet", "planet_id", planets),
+                                   ("favorite_character", "character_id", characters)):
+        statement = text(f"INSERT INTO {table} (id, {column}, user_id) VALUES (:id, :target, :user_id)")
+        rows = []
+        for index in range(per_user * users):
+            user_id = index // per_user + 1
+            # consecutive targets from a per user offset, so pairs never repeat
+            target = (user_id * 7919 + index % per_user) % targets + 1
+            rows.append({"id": index + 1, "target": target, "user_id": user_id})
+            if len(rows) == chunk:
+                connection.execute(statement, rows)
+                rows = []
+        if rows:
+            connection.execute(statement, rows)
+
+
+def measure(connection, dialect, repeat, users, planets, characters):
+    results = {}
+    for name, sql in QUERIES.items():
+        params = {"user_id": random.randint(1, users), "planet_id": random.randint(1, planets),
+                  "character_id": random.randint(1, characters)}
+        plan = [" ".join(str(value) for value in row) for row in connection.execute(text(EXPLAIN[dialect] + sql), params)]
+        started = time.perf_counter()
+        for _ in range(repeat):
+            connection.execute(text(sql), params).fetchall()
+        elapsed = (time.perf_counter() - started) / repeat
+        results[name] = {"plan": plan, "avg_ms": round(elapsed * 1000, 4)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="sqlite:///favorites_bench.sqlite")
+    parser.add_argument("--favorites", type=int, default=1000000, help="rows per favorites table")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--planets", type=int, default=1000)
+    parser.add_argument("--characters", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--output", help="write the results as json to this file")
+    args = parser.parse_args()
+
+    random.seed(42)
+    if args.url.startswith("sqlite:///") and os.path.exists(args.url[len("sqlite:///"):]):
+        os.remove(args.url[len("sqlite:///"):])
+    engine = create_engine(args.url)
+    dialect = engine.dialect.name
+
+    with engine.begin() as connection:
+        for statement in ("favorite_character", "favorite_planet", "character", "planet"):
+            connection.execute(text(f"DROP TABLE IF EXISTS {statement}"))
+        for statement in SCHEMA:
+            connection.execute(text(statement))
+        started = time.perf_counter()
+        seed(connection, args.favorites, args.users, args.planets, args.characters)
+        print(f"seeded {args.favorites} favorites per table in {time.perf_counter() - started:.1f}s")
+
+    report = {"url": engine.url.render_as_string(hide_password=True), "favorites": args.favorites}
+    with engine.connect() as connection:
+        report["before"] = measure(connection, dialect, args.repeat, args.users, args.planets, args.characters)
+    with engine.begin() as connection:
+        for statement in MIGRATION:
+            connection.execute(text(statement))
+        if dialect == "sqlite":
+            connection.execute(text("ANALYZE"))
+    with engine.connect() as connection:
+        report["after"] = measure(connection, dialect, args.repeat, args.users, args.planets, args.characters)
+
+    for name in QUERIES:
+        before, after = report["before"][name], report["after"][name]
+        print(f"\n{name}")
+        print(f"  before {before['avg_ms']:>9.3f} ms  {' | '.join(before['plan'])}")
+        print(f"  after  {after['avg_ms']:>9.3f} ms  {' | '.join(after['plan'])}")
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
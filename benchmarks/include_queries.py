@@ -0,0 +1,97 @@
+"""
+Queries and latency of ?include= against what a client without it does: one more request
+per related entity. It seeds an in-memory SQLite database, or runs on the database
+already seeded by seed.py with --database.
+
+    $ python benchmarks/include_queries.py
+    $ python benchmarks/include_queries.py --database sqlite:////tmp/bench.sqlite
+
+The number of queries of every include response has to stay the same whatever the page
+size, the script exits with status 1 when one of them makes another number of queries.
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from seed import seed  # noqa: E402
+
+# path, queries: the collection validators of both tables, the page and the include,
+# one query for a character joined with its planet, two for a planet and its residents
+BOUNDS = [
+    ("/people?include=homeworld&limit={limit}", 4),
+    ("/planets?include=residents&limit={limit}", 4),
+    ("/people/{id}?include=homeworld", 1),
+    ("/planet/{id}?include=residents", 2),
+]
+
+
+def measure(client, path, repeats):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        response = client.get(path)
+        timings.append((time.perf_counter() - started) * 1000)
+        assert response.status_code == 200, (path, response.status_code)
+    return response, round(statistics.median(timings), 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--database", help="URL of a database seeded by seed.py, an in-memory one by default")
+    args = parser.parse_args()
+
+    from sqlalchemy import event
+    from main import create_app
+    from models import db
+
+    # every request misses the collection cache, the queries are the ones of a first read, and
+    # the polls of the job workers would be counted with the queries of the responses
+    app = create_app({"ADMIN": False, "MIGRATIONS": False, "RATELIMIT_ENABLED": False,
+                      "COLLECTION_CACHE_TTL": 0, "JOBS_WORKERS": 0,
+                      "SQLALCHEMY_DATABASE_URI": args.database or "sqlite://"})
+    if args.database is None:
+        # enough rows for the pages of 1000 people and 100 planets
+        print(seed(1000, 100, 10, 100, app))
+    client = app.test_client()
+    statements = []
+    with app.app_context():
+        # the requests of the test client run on this thread, the job workers and the search index on theirs
+        event.listen(db.engine, "before_cursor_execute", lambda *arguments: statements.append(arguments[2])
+                     if threading.current_thread() is threading.main_thread() else None)
+
+    failures = []
+    for template, bound in BOUNDS:
+        for limit in (10, 100, 1000):
+            path = template.format(limit=limit, id=limit)
+            del statements[:]
+            client.get(path)
+            queries = len(statements)
+            response, median = measure(client, path, args.repeats)
+            status = "ok" if queries == bound else f"expected {bound}"
+            print(f"{path:<45} {queries:>3} queries {median:>9} ms  {len(response.get_data()):>9} bytes  {status}")
+            if queries != bound:
+                failures.append(path)
+            if "{limit}" not in template:
+                break
+
+    # what a client without include does for the first page of people: one request per homeworld
+    for limit in (10, 100):
+        started = time.perf_counter()
+        people = client.get(f"/people?limit={limit}").json
+        for homeworld in {person["homeworld"] for person in people}:
+            client.get(f"/planet/{homeworld}")
+        print(f"/people?limit={limit} then /planet/<id> per homeworld "
+              f"{round((time.perf_counter() - started) * 1000, 2):>9} ms")
+
+    if failures:
+        print(f"\n{len(failures)} responses made another number of queries: {', '.join(failures)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
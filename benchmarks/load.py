@@ -0,0 +1,347 @@
+"""
+Drives every route of src/main.py against a seeded database (see seed.py) and
+reports p50/p95/p99 latency, throughput and RSS per endpoint.
+
+    $ DB_CONNECTION_STRING=sqlite:////tmp/bench.sqlite python benchmarks/load.py --mode client
+    $ DB_CONNECTION_STRING=sqlite:////tmp/bench.sqlite python benchmarks/load.py --mode gunicorn --workers 4
+    $ DB_CONNECTION_STRING=sqlite:////tmp/bench.sqlite python benchmarks/load.py --mode asgi --workers 4
+
+`client` runs the requests in-process through the Flask test client, `gunicorn`
+starts the app like the Procfile does (gunicorn wsgi --chdir ./src/) and `asgi`
+starts src/asgi.py under uvicorn, both get real HTTP requests from --concurrency
+threads. The results are written as json
+to --output so two commits can be compared with compare.py.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+os.environ.setdefault("DB_CONNECTION_STRING", "sqlite:////tmp/starwars_bench.sqlite")
+# every request comes from one address, benchmarks/ratelimit_overhead.py measures the limiter
+os.environ.setdefault("RATELIMIT_ENABLED", "0")
+
+from seed import BENCH_EMAIL, BENCH_PASSWORD  # noqa: E402
+
+_unique = itertools.count()
+
+
+def unique():
+    return f"{os.getpid()}-{next(_unique)}-{time.time_ns()}"
+
+
+def character_body(name):
+    return {"name": name, "height": 172, "mass": "77", "hair_color": "blond", "skin_color": "fair",
+            "eye_color": "blue", "birth_year": "19BBY", "gender": "male", "homeworld": 1}
+
+
+def planet_body(name):
+    return {"name": name, "rotation_period": 23, "orbital_period": 304, "diameter": 10465,
+            "climate": "arid", "gravity": "1 standard", "terrain": "desert", "surface_water": 1,
+            "population": 200000, "url": "https://swapi.dev/api/planets/1/"}
+
+
+# (endpoint, method, builder) where builder(state) returns (path, json body)
+SCENARIOS = [
+    ("sitemap", "GET", lambda state: ("/", None)),
+    ("get_person", "GET", lambda state: ("/people", None)),
+    ("get_person_page", "GET", lambda state: ("/people?limit=100", None)),
+    ("get_character", "GET", lambda state: (f"/people/{state.pick('characters')}", None)),
+    ("get_planets", "GET", lambda state: ("/planets", None)),
+    ("get_planet", "GET", lambda state: (f"/planet/{state.pick('planets')}", None)),
+    ("get_users", "GET", lambda state: ("/users", None)),
+    ("get_user", "GET", lambda state: (f"/user/{state.pick('users')}", None)),
+    ("get_user_favorites", "GET", lambda state: ("/users/favorites", None)),
+    ("get_user_favorites_expand", "GET", lambda state: ("/users/favorites?expand=true", None)),
+    ("get_cache_stats", "GET", lambda state: ("/cache/stats", None)),
+    ("get_changes", "GET", lambda state: ("/changes?since=0&limit=100", None)),
+    ("login", "POST", lambda state: ("/login", {"email": BENCH_EMAIL, "password": BENCH_PASSWORD})),
+    ("add_people", "POST", lambda state: ("/people", character_body("Bench " + unique()))),
+    ("update_people", "PUT", lambda state: (f"/people/{state.created('people')}", character_body("Bench " + unique()))),
+    ("bulk_people", "POST", lambda state: ("/people/bulk", [character_body("Bulk " + unique()) for _ in range(100)])),
+    ("add_planets", "POST", lambda state: ("/planets", planet_body("Bench " + unique()))),
+    ("update_planet", "PUT", lambda state: (f"/planet/{state.created('planets')}", planet_body("Bench " + unique()))),
+    ("bulk_planets", "POST", lambda state: ("/planets/bulk", [planet_body("Bulk " + unique()) for _ in range(100)])),
+    ("add_user", "POST", lambda state: ("/users", {"name": "Bench", "email": unique() + "@example.com",
+                                                    "password": BENCH_PASSWORD})),
+    ("update_user", "PUT", lambda state: (f"/users/{state.created('users')}",
+                                          {"name": "Bench", "email": unique() + "@example.com"})),
+    ("add_favorite_planet", "POST", lambda state: (f"/favorite/planet/{state.favorite('planets')}", None)),
+    ("delete_favorite_planet", "DELETE", lambda state: (f"/favorite/planet/{state.unfavorite('planets')}", None)),
+    ("add_favorite_people", "POST", lambda state: (f"/favorite/people/{state.favorite('characters')}", None)),
+    ("delete_favorite_people", "DELETE", lambda state: (f"/favorite/people/{state.unfavorite('characters')}", None)),
+    ("delete_person", "DELETE", lambda state: (f"/people/{state.take('people')}", None)),
+    ("delete_planet", "DELETE", lambda state: (f"/planet/{state.take('planets')}", None)),
+    ("delete_user", "DELETE", lambda state: (f"/users/{state.take('users')}", None)),
+]
+
+# the created ids are collected from these responses, so the updates and deletes
+# only touch rows made by the benchmark
+CREATES = {"add_people": "people", "add_planets": "planets", "add_user": "users"}
+
+
+class State:
+    """Ids shared by the scenarios: the seeded volumes and the rows created during the run."""
+
+    def __init__(self, characters, planets, users):
+        self.sizes = {"characters": characters, "planets": planets, "users": users}
+        self._created = {"people": [], "planets": [], "users": []}
+        self._favorites = {"planets": [], "characters": []}
+        self._favorited = {"planets": set(), "characters": set()}
+        self._candidates = {"planets": itertools.count(1), "characters": itertools.count(1)}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def pick(self, kind):
+        return next(self._counter) % self.sizes[kind] + 1
+
+    def created(self, kind):
+        with self._lock:
+            ids = self._created[kind]
+            return ids[next(self._counter) % len(ids)] if ids else 0
+
+    def take(self, kind):
+        with self._lock:
+            ids = self._created[kind]
+            return ids.pop() if ids else 0
+
+    def remember(self, kind, id):
+        with self._lock:
+            self._created[kind].append(id)
+
+    def load_favorites(self, favorites):
+        # the seeded favorites of the bench user are skipped when adding new ones
+        for favorite in favorites:
+            if "planet_id" in favorite:
+                self._favorited["planets"].add(favorite["planet_id"])
+            else:
+                self._favorited["characters"].add(favorite["character_id"])
+
+    def favorite(self, kind):
+        with self._lock:
+            id = next(self._candidates[kind])
+            while id in self._favorited[kind]:
+                id = next(self._candidates[kind])
+            self._favorited[kind].add(id)
+            self._favorites[kind].append(id)
+            return id
+
+    def unfavorite(self, kind):
+        with self._lock:
+            if not self._favorites[kind]:
+                return 0
+            id = self._favorites[kind].pop()
+            self._favorited[kind].discard(id)
+            return id
+
+
+class ClientDriver:
+    def __init__(self):
+        from main import create_app
+        app = create_app()
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None, headers=None):
+        response = self.client.open(path, method=method, json=body, headers=headers or {})
+        data = response.get_data()
+        return response.status_code, data
+
+    def rss(self):
+        return process_rss(os.getpid())
+
+    def close(self):
+        pass
+
+
+SERVER_COMMANDS = {
+    "gunicorn": lambda workers, port: ["gunicorn", "wsgi", "--chdir", os.path.join(ROOT, "src"),
+                                       "-w", str(workers), "-b", f"127.0.0.1:{port}"],
+    "asgi": lambda workers, port: ["uvicorn", "asgi:application", "--app-dir", os.path.join(ROOT, "src"),
+                                   "--workers", str(workers), "--port", str(port), "--no-access-log"],
+}
+
+
+class ServerDriver:
+    def __init__(self, mode, workers, port, extra_args=()):
+        self.port = port
+        command = [*SERVER_COMMANDS[mode](workers, port), *extra_args]
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._local = threading.local()
+        wait_for_port(port)
+
+    def connection(self):
+        if not hasattr(self._local, "connection"):
+            self._local.connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        return self._local.connection
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        connection = self.connection()
+        try:
+            connection.request(method, path, payload, headers)
+            response = connection.getresponse()
+        except (http.client.HTTPException, OSError):
+            # the worker closed the keep-alive connection, retry once on a new one
+            connection.close()
+            connection.request(method, path, payload, headers)
+            response = connection.getresponse()
+        return response.status, response.read()
+
+    def rss(self):
+        return process_rss(self.process.pid) + sum(process_rss(pid) for pid in child_pids(self.process.pid))
+
+    def close(self):
+        self.process.send_signal(signal.SIGTERM)
+        self.process.wait(timeout=30)
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"the server did not listen on {port} after {timeout}s")
+
+
+def process_rss(pid):
+    """Resident set size in bytes from /proc, 0 where it is not available."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def child_pids(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            return [int(child) for child in children.read().split()]
+    except OSError:
+        return []
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(fraction * (len(values) - 1)))))
+    return values[index]
+
+
+def run_scenario(driver, state, method, builder, headers, requests, concurrency):
+    def one(_):
+        path, body = builder(state)
+        started = time.perf_counter()
+        status, data = driver.request(method, path, body, headers)
+        return time.perf_counter() - started, status, data
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as executor:
+            results = list(executor.map(one, range(requests)))
+    else:
+        results = [one(index) for index in range(requests)]
+    return results, time.perf_counter() - started
+
+
+def summarize(results, elapsed, rss):
+    latencies = [latency * 1000 for latency, status, data in results]
+    statuses = {}
+    for latency, status, data in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": len(results),
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+        "throughput_rps": round(len(results) / elapsed, 1) if elapsed else None,
+        "rss_bytes": rss,
+        "status": statuses,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("client", *SERVER_COMMANDS), default="client")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8, help="client threads in server modes")
+    parser.add_argument("--workers", type=int, default=4, help="server worker processes")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--characters", type=int, default=10000, help="seeded volumes, used to pick ids")
+    parser.add_argument("--planets", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--only", help="comma separated endpoints to run")
+    parser.add_argument("--output", default="bench_output.json")
+    args = parser.parse_args()
+
+    if args.mode == "client":
+        driver = ClientDriver()
+        concurrency = 1
+    else:
+        driver = ServerDriver(args.mode, args.workers, args.port)
+        concurrency = args.concurrency
+    state = State(args.characters, args.planets, args.users)
+    only = set(args.only.split(",")) if args.only else None
+
+    report = {"commit": git_commit(), "mode": args.mode, "python": platform.python_version(),
+              "database": os.environ["DB_CONNECTION_STRING"].split("://")[0],
+              "requests": args.requests, "concurrency": concurrency, "endpoints": {}}
+    try:
+        status, data = driver.request("POST", "/login", {"email": BENCH_EMAIL, "password": BENCH_PASSWORD})
+        if status != 200:
+            raise RuntimeError(f"login failed ({status}), seed the database with benchmarks/seed.py first")
+        headers = {"Authorization": "Bearer " + json.loads(data)["access_token"]}
+        status, data = driver.request("GET", "/users/favorites", headers=headers)
+        state.load_favorites(json.loads(data))
+
+        for endpoint, method, builder in SCENARIOS:
+            if only and endpoint not in only:
+                continue
+            results, elapsed = run_scenario(driver, state, method, builder, headers, args.requests, concurrency)
+            if endpoint in CREATES:
+                for latency, status, data in results:
+                    if status == 201:
+                        state.remember(CREATES[endpoint], json.loads(data)["id"])
+            summary = summarize(results, elapsed, driver.rss())
+            report["endpoints"][endpoint] = summary
+            print(f"{endpoint:<28} p50 {summary['p50_ms']:>9.2f} ms  p95 {summary['p95_ms']:>9.2f} ms  "
+                  f"p99 {summary['p99_ms']:>9.2f} ms  {summary['throughput_rps']:>8} req/s  "
+                  f"rss {summary['rss_bytes'] // 2 ** 20} MiB  {summary['status']}")
+    finally:
+        driver.close()
+
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    print(f"\nresults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
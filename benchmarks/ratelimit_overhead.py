@@ -0,0 +1,66 @@
+"""
+Per request cost of the rate limiter, with limits high enough that nothing is rejected.
+
+    $ python benchmarks/ratelimit_overhead.py --requests 20000
+
+`check` times the before_request hook alone for an anonymous client and for one sending
+a JWT. `request` compares full test client requests to /cache/stats (no database) with
+the limiter on and off, the difference is what the limiter adds to a request.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+os.environ.setdefault("DB_CONNECTION_STRING", "sqlite://")
+
+UNLIMITED = {"RATELIMIT_DEFAULT": "1000000/second", "RATELIMIT_LOGIN": "1000000/second",
+             "RATELIMIT_COLLECTIONS": "1000000/second", "ADMIN": False, "MIGRATIONS": False}
+
+
+def per_call_us(function, count, repeats=5):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for _ in range(count):
+            function()
+        timings.append((time.perf_counter() - started) / count * 1e6)
+    return round(statistics.median(timings), 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+
+    from main import create_app
+    from ratelimit import rate_limiter
+    from flask_jwt_extended import create_access_token
+
+    limited = create_app(dict(UNLIMITED, RATELIMIT_ENABLED=True))
+    unlimited = create_app(dict(UNLIMITED, RATELIMIT_ENABLED=False))
+    with limited.app_context():
+        headers = {"Authorization": "Bearer " + create_access_token(identity="bench@example.com",
+                                                                    additional_claims={"user_id": 1})}
+
+    for label, request_headers in (("anonymous", {}), ("jwt", headers)):
+        with limited.test_request_context("/people", headers=request_headers):
+            print(f"check {label:<10} {per_call_us(rate_limiter.check, args.requests)} us")
+
+    for label, request_headers in (("anonymous", {}), ("jwt", headers)):
+        timings = {"on": [], "off": []}
+        # alternated so that a slower period of the machine hits both
+        for _ in range(10):
+            for name, app in (("on", limited), ("off", unlimited)):
+                client = app.test_client()
+                timings[name].append(per_call_us(lambda: client.get("/cache/stats", headers=request_headers),
+                                                 args.requests // 50, repeats=1))
+        results = {name: round(statistics.median(values), 2) for name, values in timings.items()}
+        overhead = round(results["on"] - results["off"], 2)
+        print(f"request {label:<8} on {results['on']} us, off {results['off']} us, overhead {overhead} us")
+
+
+if __name__ == "__main__":
+    main()
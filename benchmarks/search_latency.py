@@ -0,0 +1,134 @@
+"""
+Measures /search latency with the in-process index and the database full-text index
+(SQLite FTS5) on a seeded database.
+
+    $ DB_CONNECTION_STRING=sqlite:////tmp/search_bench.sqlite python benchmarks/search_latency.py --characters 1000000
+
+The database is seeded with seed.py, then the characters and planets are renamed with
+generated multi-word names so the index sees a realistic vocabulary. The queries mix
+typeahead prefixes, whole words, two word queries and misses.
+"""
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from seed import seed, chunks  # noqa: E402
+from load import percentile, process_rss  # noqa: E402
+
+SYLLABLES = ["ka", "lo", "ven", "dar", "mi", "sku", "tor", "rey", "an", "bel", "cor", "dun", "el", "fa",
+             "gor", "ha", "is", "jin", "ko", "lu", "mon", "na", "or", "pa", "qui", "ra", "sol", "ta",
+             "ul", "vi", "wa", "xa", "yo", "ze", "bra", "cre", "dro", "fli", "gre", "pro"]
+
+
+def create_search_tables(db):
+    """Runs the full-text migration on the tables seed.py created without the migrations."""
+    from alembic.migration import MigrationContext
+    from alembic.operations import Operations
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "migrations", "versions", "b52e7c9d4a18_.py")
+    spec = importlib.util.spec_from_file_location("search_migration", path)
+    migration = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(migration)
+    with Operations.context(MigrationContext.configure(db.session.connection())):
+        migration.upgrade()
+    db.session.commit()
+
+
+def word(random):
+    return "".join(random.choice(SYLLABLES) for _ in range(random.randint(2, 3))).capitalize()
+
+
+def unique_names(count, random):
+    seen = set()
+    while len(seen) < count:
+        seen.add(f"{word(random)} {word(random)}")
+    return list(seen)
+
+
+def rename(db, model, names):
+    table = model.__table__
+    rows = ({"row_id": id, "new_name": name} for id, name in enumerate(names, 1))
+    statement = table.update().where(table.c.id == db.bindparam("row_id")).values(name=db.bindparam("new_name"))
+    for batch in chunks(rows):
+        db.session.execute(statement, batch)
+    db.session.commit()
+
+
+def queries(names, count, random):
+    mix = []
+    for _ in range(count):
+        name = random.choice(names).lower()
+        first, last = name.split(" ")
+        kind = random.random()
+        if kind < 0.5:
+            # typeahead, the prefix the client has typed so far
+            mix.append(name[:random.randint(1, len(name))])
+        elif kind < 0.7:
+            mix.append(last)
+        elif kind < 0.8:
+            mix.append(f"{first} {last[:2]}")
+        elif kind < 0.9:
+            mix.append(random.choice(("desert", "arid", "jungle", "temp", "blue", "fair")))
+        else:
+            mix.append("zzq" + first)
+    return mix
+
+
+def measure(client, mix):
+    latencies = []
+    for query in mix:
+        started = time.perf_counter()
+        response = client.get("/search", query_string={"q": query})
+        latencies.append((time.perf_counter() - started) * 1000)
+        assert response.status_code == 200, response.data
+    return {"p50_ms": round(percentile(latencies, 0.5), 3), "p95_ms": round(percentile(latencies, 0.95), 3),
+            "p99_ms": round(percentile(latencies, 0.99), 3), "max_ms": round(max(latencies), 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--characters", type=int, default=100000)
+    parser.add_argument("--planets", type=int, default=10000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--no-seed", action="store_true", help="reuse the database of a previous run")
+    args = parser.parse_args()
+
+    from main import create_app
+    app = create_app()
+    from models import db, Character, Planet
+    from search import search_index
+
+    generator = random.Random(7)
+    character_names = unique_names(args.characters, generator)
+    planet_names = unique_names(args.planets, generator)
+    if not args.no_seed:
+        print("seed:", seed(args.characters, args.planets, 10, 0))
+        with app.app_context():
+            rename(db, Character, character_names)
+            rename(db, Planet, planet_names)
+            if db.engine.dialect.name == "sqlite":
+                create_search_tables(db)
+
+    mix = queries(character_names + planet_names, args.queries, generator)
+    client = app.test_client()
+    for backend in ("memory", "database"):
+        app.config["SEARCH_BACKEND"] = backend
+        search_index.backends.clear()
+        search_index.indexes.clear()
+        rss = process_rss(os.getpid())
+        started = time.perf_counter()
+        # the memory index is built by a thread, the searches answer 503 until it is ready
+        while client.get("/search", query_string={"q": "warmup"}).status_code == 503:
+            time.sleep(0.05)
+        warmup = time.perf_counter() - started
+        result = measure(client, mix)
+        result["first_query_s"] = round(warmup, 2)
+        result["rss_delta_mib"] = (process_rss(os.getpid()) - rss) // 2 ** 20
+        print(f"{backend:<9}", result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Seeds the database of DB_CONNECTION_STRING with generated characters, planets,
+users and favorites for the benchmarks.
+
+    $ DB_CONNECTION_STRING=sqlite:////tmp/bench.sqlite python benchmarks/seed.py --characters 100000
+
+The tables are dropped and recreated from src/models.py. The first user is
+BENCH_EMAIL / BENCH_PASSWORD, the one the load test logs in with.
+"""
+import argparse
+import os
+import sys
+import time
+import random
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+os.environ.setdefault("DB_CONNECTION_STRING", "sqlite:////tmp/starwars_bench.sqlite")
+
+BENCH_EMAIL = "bench@example.com"
+BENCH_PASSWORD = "bench-password"
+CHUNK = 10000
+
+
+def chunks(rows, size=CHUNK):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def insert(db, model, rows):
+    count = 0
+    for batch in chunks(rows):
+        db.session.execute(model.__table__.insert(), batch)
+        count += len(batch)
+    db.session.commit()
+    return count
+
+
+def planet_rows(count, now):
+    for id in range(1, count + 1):
+        yield {"id": id, "name": f"Planet {id}", "rotation_period": random.randint(10, 50),
+               "orbital_period": random.randint(100, 900), "diameter": random.randint(1000, 20000),
+               "climate": random.choice(("arid", "temperate", "frozen", "murky", "tropical")),
+               "gravity": "1 standard", "terrain": random.choice(("desert", "grasslands", "jungle", "tundra")),
+               "surface_water": random.randint(0, 100), "population": random.randint(0, 10 ** 9),
+               "url": f"https://swapi.dev/api/planets/{id}/", "created": now, "edited": now}
+
+
+def character_rows(count, planets, now):
+    from models import Gender
+    for id in range(1, count + 1):
+        yield {"id": id, "name": f"Character {id}", "height": random.randint(60, 250),
+               "mass": str(random.randint(20, 150)), "hair_color": "brown", "skin_color": "fair",
+               "eye_color": "blue", "birth_year": f"{random.randint(1, 900)}BBY",
+               "gender": random.choice((Gender.MALE, Gender.FEMALE)),
+               "homeworld": random.randint(1, planets), "created": now, "edited": now}
+
+
+def user_rows(count, password):
+    # one hash shared by every user, hashing each of them would dominate the seeding time
+    yield {"id": 1, "name": "Bench", "email": BENCH_EMAIL, "password": password}
+    for id in range(2, count + 1):
+        yield {"id": id, "name": f"User {id}", "email": f"user{id}@example.com", "password": password}
+
+
+def favorite_rows(count, users, targets, column):
+    per_user = max(1, min(count // users, targets))
+    id = 0
+    for user_id in range(1, users + 1):
+        offset = user_id * 7919
+        for index in range(per_user):
+            id += 1
+            if id > count:
+                return
+            # consecutive targets from a per user offset, so pairs never repeat
+            yield {"id": id, "user_id": user_id, column: (offset + index) % targets + 1}
+
+
+def seed(characters, planets, users, favorites, app=None):
+    if app is None:
+        from main import create_app
+        app = create_app()
+    from models import db, User, Character, Planet, FavoritePlanet, FavoriteCharacter
+    from stats import rebuild_favorite_counts
+    from passwords import password_hasher
+
+    random.seed(42)
+    now = datetime.now()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        counts = {}
+        started = time.perf_counter()
+        counts["planet"] = insert(db, Planet, planet_rows(planets, now))
+        counts["character"] = insert(db, Character, character_rows(characters, planets, now))
+        counts["user"] = insert(db, User, user_rows(users, password_hasher.hash(BENCH_PASSWORD)))
+        counts["favorite_planet"] = insert(db, FavoritePlanet, favorite_rows(favorites, users, planets, "planet_id"))
+        counts["favorite_character"] = insert(db, FavoriteCharacter,
+                                              favorite_rows(favorites, users, characters, "character_id"))
+        rebuild_favorite_counts(db.session)
+        counts["seconds"] = round(time.perf_counter() - started, 2)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--characters", type=int, default=10000)
+    parser.add_argument("--planets", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--favorites", type=int, default=10000, help="rows per favorites table")
+    args = parser.parse_args()
+    counts = seed(args.characters, args.planets, args.users, args.favorites)
+    print(", ".join(f"{key}: {value}" for key, value in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
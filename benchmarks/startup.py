@@ -0,0 +1,95 @@
+"""
+Startup cost of the API: import of src/main.py, create_app() and the first request,
+each measured in a fresh interpreter, for the optional components on and off.
+
+    $ python benchmarks/startup.py --runs 10
+    $ python benchmarks/startup.py --gunicorn 4
+
+--gunicorn also starts gunicorn with that many workers, with and without --preload, and
+reports the time until the first response and the RSS of all the processes.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from load import ROOT, ServerDriver  # noqa: E402
+
+CONFIGS = {
+    "full": {},
+    # what src/wsgi.py and src/asgi.py build
+    "server": {"MIGRATIONS": False},
+    "api only": {"MIGRATIONS": False, "ADMIN": False, "SWAGGER": False, "SITEMAP": False},
+}
+
+PROBE = """
+import json, os, sys, time
+started = time.perf_counter()
+from main import create_app
+imported = time.perf_counter()
+app = create_app(json.loads(os.environ["STARTUP_CONFIG"]))
+created = time.perf_counter()
+app.test_client().get("/cache/stats")
+answered = time.perf_counter()
+print(json.dumps({"import_ms": (imported - started) * 1000, "create_app_ms": (created - imported) * 1000,
+                  "first_request_ms": (answered - created) * 1000, "modules": len(sys.modules)}))
+"""
+
+
+def probe(config):
+    env = dict(os.environ, STARTUP_CONFIG=json.dumps(config))
+    env.setdefault("DB_CONNECTION_STRING", "sqlite://")
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", PROBE], cwd=os.path.join(ROOT, "src"), env=env,
+                            check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process_ms"] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def measure(config, runs):
+    results = [probe(config) for _ in range(runs)]
+    return {key: round(statistics.median(result[key] for result in results), 1) for key in results[0]}
+
+
+def gunicorn_startup(workers, port, preload):
+    started = time.perf_counter()
+    driver = ServerDriver("gunicorn", workers, port, ["--preload"] if preload else [])
+    try:
+        while True:
+            try:
+                status, _ = driver.request("GET", "/cache/stats")
+                if status == 200:
+                    break
+            except OSError:
+                pass
+            time.sleep(0.01)
+        first_response = time.perf_counter() - started
+        # give the remaining workers the time to boot before measuring their memory
+        time.sleep(2)
+        return {"first_response_ms": round(first_response * 1000, 1), "rss_mib": driver.rss() // 2 ** 20}
+    finally:
+        driver.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per configuration")
+    parser.add_argument("--gunicorn", type=int, default=0, metavar="WORKERS")
+    parser.add_argument("--port", type=int, default=5099)
+    args = parser.parse_args()
+
+    for name, config in CONFIGS.items():
+        print(f"{name:<9}", measure(config, args.runs))
+    if args.gunicorn:
+        for preload in (False, True):
+            label = "preload" if preload else "no preload"
+            print(f"gunicorn -w {args.gunicorn} {label}:", gunicorn_startup(args.gunicorn, args.port, preload))
+
+
+if __name__ == "__main__":
+    main()
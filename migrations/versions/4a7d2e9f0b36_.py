@@ -0,0 +1,33 @@
+"""mark plaintext passwords for rehashing
+
+Revision ID: 4a7d2e9f0b36
+Revises: e1f6a3b8c925
+Create Date: 2026-10-17 21:14:52.602117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4a7d2e9f0b36'
+down_revision = 'e1f6a3b8c925'
+branch_labels = None
+depends_on = None
+
+user = sa.table('user', sa.column('password', sa.String))
+
+
+def upgrade():
+    # werkzeug's "plain$$<password>" format verifies the current passwords as they are,
+    # /login replaces them with a salted hash on the next successful login
+    op.execute(user.update()
+               .where(user.c.password.notlike('pbkdf2:%'))
+               .values(password=sa.literal('plain$$') + user.c.password))
+
+
+def downgrade():
+    # passwords hashed since the upgrade cannot be recovered, those users have to reset them
+    op.execute(user.update()
+               .where(user.c.password.like('plain$$%'))
+               .values(password=sa.func.substr(user.c.password, len('plain$$') + 1)))
@@ -0,0 +1,34 @@
+"""microseconds of the edited columns on mysql
+
+Revision ID: 6e2a9d4c8f13
+Revises: 5b8d1f3e6a92
+Create Date: 2026-10-18 09:41:52.307614
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = '6e2a9d4c8f13'
+down_revision = '5b8d1f3e6a92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the other databases already keep the microseconds of a DateTime
+    if op.get_bind().dialect.name != 'mysql':
+        return
+    for table in ('character', 'planet'):
+        op.alter_column(table, 'edited', existing_type=sa.DateTime(), type_=mysql.DATETIME(fsp=6),
+                        existing_nullable=False)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'mysql':
+        return
+    for table in ('character', 'planet'):
+        op.alter_column(table, 'edited', existing_type=mysql.DATETIME(fsp=6), type_=sa.DateTime(),
+                        existing_nullable=False)
@@ -0,0 +1,62 @@
+"""full-text search indexes on character and planet
+
+Revision ID: b52e7c9d4a18
+Revises: 8d2e4b6a1c57
+Create Date: 2026-10-17 18:21:09.551437
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b52e7c9d4a18'
+down_revision = '8d2e4b6a1c57'
+branch_labels = None
+depends_on = None
+
+# searchable columns at this revision, see search_fields in src/models.py
+SEARCH_FIELDS = {
+    'character': ['name', 'hair_color', 'skin_color', 'eye_color'],
+    'planet': ['name', 'climate', 'terrain'],
+}
+
+
+def upgrade():
+    # sqlite gets FTS5 tables (without positions, prefix indexes up to 8 letters) kept in sync by triggers, postgres a GIN index on the tsvector
+    # the search endpoint queries. Other databases use the in-process index of src/search.py.
+    # batch_alter_table copies sqlite tables and drops their triggers: later migrations
+    # touching these tables in batch mode have to recreate them.
+    dialect = op.get_bind().dialect.name
+    for table, fields in SEARCH_FIELDS.items():
+        columns = ", ".join(fields)
+        if dialect == 'sqlite':
+            new = ", ".join(f"new.{field}" for field in fields)
+            old = ", ".join(f"old.{field}" for field in fields)
+            op.execute(f"CREATE VIRTUAL TABLE {table}_search USING fts5({columns}, content='{table}', "
+                       f"content_rowid='id', prefix='1 2 3 4 5 6 7 8', detail=none)")
+            op.execute(f'CREATE TRIGGER {table}_search_insert AFTER INSERT ON "{table}" BEGIN '
+                       f"INSERT INTO {table}_search(rowid, {columns}) VALUES (new.id, {new}); END")
+            op.execute(f'CREATE TRIGGER {table}_search_delete AFTER DELETE ON "{table}" BEGIN '
+                       f"INSERT INTO {table}_search({table}_search, rowid, {columns}) "
+                       f"VALUES ('delete', old.id, {old}); END")
+            op.execute(f'CREATE TRIGGER {table}_search_update AFTER UPDATE ON "{table}" BEGIN '
+                       f"INSERT INTO {table}_search({table}_search, rowid, {columns}) "
+                       f"VALUES ('delete', old.id, {old}); "
+                       f"INSERT INTO {table}_search(rowid, {columns}) VALUES (new.id, {new}); END")
+            op.execute(f"INSERT INTO {table}_search({table}_search) VALUES ('rebuild')")
+        elif dialect == 'postgresql':
+            document = " || ' ' || ".join(f"coalesce({field}, '')" for field in fields)
+            op.execute(f'CREATE INDEX ix_{table}_search ON "{table}" '
+                       f"USING gin (to_tsvector('simple', {document}))")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table in SEARCH_FIELDS:
+        if dialect == 'sqlite':
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute(f"DROP TRIGGER IF EXISTS {table}_search_{trigger}")
+            op.execute(f"DROP TABLE IF EXISTS {table}_search")
+        elif dialect == 'postgresql':
+            op.execute(f"DROP INDEX IF EXISTS ix_{table}_search")
@@ -1,20 +1,150 @@
 import os
+from flask import request, current_app
 from flask_admin import Admin
 from models import db, User, Character, Planet, FavoriteCharacter, FavoritePlanet
 from flask_admin.contrib.sqla import ModelView
+from flask_admin.contrib.sqla.ajax import QueryAjaxModelLoader, DEFAULT_PAGE_SIZE
+from sqlalchemy import inspect, func, text, and_, or_, literal_column, UniqueConstraint
+from sqlalchemy.orm import Query
+from passwords import password_hasher
+from search import search_index, tokenize, MAX_CANDIDATES
+from database import read_replica
+
+def indexed_columns(model):
+    """Columns the database can filter and sort by with an index, the leading ones of the unique constraints too."""
+    table = model.__table__
+    leading = {next(iter(index.columns)).key for index in table.indexes}
+    leading |= {next(iter(constraint.columns)).key for constraint in table.constraints
+                if isinstance(constraint, UniqueConstraint)}
+    return [column.key for column in table.columns
+            if column.primary_key or column.index or column.unique or column.key in leading]
+
+
+def lookup_columns(model):
+    # unique columns, the prefix searches and the foreign key lookups read their index
+    return [column.key for column in model.__table__.columns if column.unique]
+
+
+def prefix_match(columns, term):
+    # a range instead of LIKE 'term%', which an index only serves with some collations
+    return or_(*[and_(column >= term, column < term + "\uffff") for column in columns])
+
+
+def estimated_rows(session, model):
+    """Rows of the table from the planner statistics, max(id) where there are none."""
+    dialect = session.get_bind().dialect.name
+    estimate = None
+    if dialect == "postgresql":
+        estimate = session.execute(text("SELECT reltuples FROM pg_class WHERE oid = CAST(:table AS regclass)"),
+                                   {"table": model.__tablename__}).scalar()
+    elif dialect == "mysql":
+        estimate = session.execute(text("SELECT table_rows FROM information_schema.tables "
+                                        "WHERE table_schema = DATABASE() AND table_name = :table"),
+                                   {"table": model.__tablename__}).scalar()
+    if estimate is None or estimate < 0:
+        # ids are not reused, the deleted rows make it an upper bound
+        estimate = session.query(func.max(model.id)).scalar() or 0
+    return int(estimate)
+
+
+class CountQuery(Query):
+    """
+    The count of the list views. Tables under ADMIN_EXACT_COUNT rows are counted, bigger ones
+    get their estimate, and a search or filter counts its matches up to ADMIN_EXACT_COUNT.
+    """
+
+    def scalar(self):
+        exact_count = current_app.config["ADMIN_EXACT_COUNT"]
+        if self.whereclause is None:
+            estimate = estimated_rows(self.session, self.admin_model)
+            return estimate if estimate >= exact_count else super().scalar()
+        matches = self.with_entities(literal_column("1")).limit(exact_count).subquery()
+        return self.session.query(func.count()).select_from(matches).scalar()
+
+
+class PrefixAjaxModelLoader(QueryAjaxModelLoader):
+    """Foreign key lookups of the forms, by prefix of a unique column instead of the whole table in a select."""
+
+    def get_list(self, term, offset=0, limit=DEFAULT_PAGE_SIZE):
+        query = self.get_query().filter(prefix_match(self._cached_fields, term))
+        return query.order_by(*self._cached_fields).offset(offset).limit(limit).all()
+
+
+class AdminView(ModelView):
+    """
+    A ModelView that stays usable on large tables: estimated counts, filters and sorting only
+    on indexed columns, search through the /search index (or a prefix of the unique columns),
+    the many-to-one columns joined in the list query, and foreign keys picked by an AJAX
+    lookup. The to-many relationships are left out of the forms, they would list whole tables.
+    The GET pages read from a replica when there are some.
+    """
+
+    column_display_pk = True
+
+    def __init__(self, model, session, page_size=20, **kwargs):
+        self.page_size = page_size
+        mapper = inspect(model)
+        indexed = indexed_columns(model)
+        self.column_sortable_list = indexed
+        self.column_filters = [name for name in indexed if name != "id"]
+        self.column_searchable_list = list(getattr(model, "search_fields", ())) or lookup_columns(model)
+        self.form_excluded_columns = [relationship.key for relationship in mapper.relationships if relationship.uselist]
+        self.form_ajax_refs = {
+            relationship.key: PrefixAjaxModelLoader(relationship.key, session, relationship.mapper.class_,
+                                                    fields=lookup_columns(relationship.mapper.class_), page_size=10)
+            for relationship in mapper.relationships if not relationship.uselist}
+        super().__init__(model, session, **kwargs)
+
+    def get_count_query(self):
+        query = CountQuery([func.count("*")], session=self.session()).select_from(self.model)
+        query.admin_model = self.model
+        return query
+
+    def _apply_search(self, query, count_query, joins, count_joins, search):
+        terms = tokenize(search)
+        if not terms:
+            return query, count_query, joins, count_joins
+        if getattr(self.model, "search_fields", None):
+            # the best matches of the /search index, at most MAX_CANDIDATES
+            ids = [row[0] for row in search_index.search(self.model, terms, MAX_CANDIDATES)]
+            condition = self.model.id.in_(ids)
+        else:
+            condition = prefix_match([getattr(self.model, name) for name in lookup_columns(self.model)], search.strip())
+        query = query.filter(condition)
+        if count_query is not None:
+            count_query = count_query.filter(condition)
+        return query, count_query, joins, count_joins
+
+    def _run_view(self, fn, *args, **kwargs):
+        if request.method == "GET":
+            return read_replica(fn)(self, *args, **kwargs)
+        return fn(self, *args, **kwargs)
+
+
+class UserView(AdminView):
+    column_exclude_list = ("password",)
+
+    # the form takes a plaintext password, only hashes are stored
+    def on_model_change(self, form, model, is_created):
+        if inspect(model).attrs.password.history.has_changes():
+            model.password = password_hasher.hash(model.password)
 
 def setup_admin(app):
     app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
     app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
+    # the list views count up to this many rows, bigger tables show an estimate
+    app.config.setdefault('ADMIN_EXACT_COUNT', int(os.environ.get('ADMIN_EXACT_COUNT', 100000)))
+    app.config.setdefault('ADMIN_PAGE_SIZE', int(os.environ.get('ADMIN_PAGE_SIZE', 20)))
+    page_size = app.config['ADMIN_PAGE_SIZE']
     admin = Admin(app, name='4Geeks Admin', template_mode='bootstrap3')
 
     
     # Add your models here, for example this is how we add a the User model to the admin
-    admin.add_view(ModelView(User, db.session))
-    admin.add_view(ModelView(Character, db.session))
-    admin.add_view(ModelView(Planet, db.session))
-    admin.add_view(ModelView(FavoriteCharacter, db.session))
-    admin.add_view(ModelView(FavoritePlanet, db.session))
+    admin.add_view(UserView(User, db.session, page_size=page_size))
+    admin.add_view(AdminView(Character, db.session, page_size=page_size))
+    admin.add_view(AdminView(Planet, db.session, page_size=page_size))
+    admin.add_view(AdminView(FavoriteCharacter, db.session, page_size=page_size))
+    admin.add_view(AdminView(FavoritePlanet, db.session, page_size=page_size))
 
     # You can duplicate that line to add mew models
-    # admin.add_view(ModelView(YourModelName, db.session))
\ No newline at end of file
+    # admin.add_view(AdminView(YourModelName, db.session, page_size=page_size))
@@ -0,0 +1,286 @@
+"""
+ASGI entry point, an alternative to wsgi.py for deployments with many slow or
+concurrent clients:
+
+    $ uvicorn asgi:application --app-dir src --workers 4
+
+The read-only catalog routes (GET /people, /planets, /users and their single entity
+routes) run natively on the event loop with SQLAlchemy's async engine, so a waiting
+database call does not hold a worker thread. They go through the same Flask request
+handling (before/after request hooks, error handlers, CORS) and produce the same
+responses as the WSGI app. Every other route, and streamed collections, run the
+regular Flask app on a bounded thread pool.
+
+Needs an async driver for the database: aiosqlite, asyncpg or aiomysql.
+"""
+import io
+import os
+import re
+import sys
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import request
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from main import create_app, resources
+from utils import APIException
+from cache import entity_cache, collection_cache
+from compression import compressor
+from pagination import page_query, page_result, page_response, parse_filters, wants_stream
+from conditional import validators_query, validators_from_row, is_not_modified, not_modified_response, set_validators
+
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
+
+# (path pattern, model, not found message) of the GET routes of the registered resources
+NATIVE_ROUTES = ([(re.compile(rf"^{re.escape(resource.collection)}/?$"), resource.model, None)
+                  for resource in resources if "list" in resource.actions]
+                 + [(re.compile(rf"^{re.escape(resource.item)}/(\d+)/?$"), resource.model, f"{resource.label} not found")
+                    for resource in resources if "get" in resource.actions])
+
+
+def async_database_url():
+    url = os.environ.get('ASYNC_DB_CONNECTION_STRING')
+    if url:
+        return make_url(url)
+    url = make_url(os.environ.get('DB_CONNECTION_STRING'))
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+
+def create_engine_from_env():
+    url = async_database_url()
+    options = {"pool_pre_ping": os.environ.get('ASYNC_POOL_PRE_PING', '1') == '1'}
+    # sqlite files are opened per connection, the pool size options do not apply
+    if url.get_backend_name() != "sqlite":
+        options["pool_size"] = int(os.environ.get('ASYNC_POOL_SIZE', 20))
+        options["max_overflow"] = int(os.environ.get('ASYNC_MAX_OVERFLOW', 10))
+        options["pool_timeout"] = float(os.environ.get('ASYNC_POOL_TIMEOUT', 30))
+        options["pool_recycle"] = int(os.environ.get('ASYNC_POOL_RECYCLE', 1800))
+    return create_async_engine(url, **options)
+
+
+def build_environ(scope, body):
+    """WSGI environ (PEP 3333) of an ASGI http scope."""
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("ascii"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+        environ["REMOTE_PORT"] = str(scope["client"][1])
+    for name, value in scope["headers"]:
+        name = name.decode("latin1").upper().replace("-", "_")
+        value = value.decode("latin1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        environ[name] = environ[name] + "," + value if name in environ else value
+    return environ
+
+
+async def read_body(receive):
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+async def send_response(send, response):
+    headers = [(name.lower().encode("latin1"), value.encode("latin1")) for name, value in response.headers.items()]
+    await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+    await send({"type": "http.response.body", "body": response.get_data()})
+
+
+class AsyncApplication:
+    def __init__(self, flask_app, max_concurrency=None, wsgi_threads=None):
+        self.flask_app = flask_app
+        self.max_concurrency = max_concurrency or int(os.environ.get('ASGI_MAX_CONCURRENCY', 1000))
+        self.executor = ThreadPoolExecutor(wsgi_threads or int(os.environ.get('ASGI_WSGI_THREADS', 32)))
+        self.engine = None
+        self.session = None
+        self._semaphore = None
+
+    def start(self):
+        if self.engine is None:
+            self.engine = create_engine_from_env()
+            self.session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        self.start()
+        # requests past the limit wait for a slot instead of piling up on the pool
+        async with self._semaphore:
+            body = await read_body(receive)
+            environ = build_environ(scope, body)
+            if scope["method"] in ("GET", "HEAD"):
+                for pattern, model, not_found_message in NATIVE_ROUTES:
+                    match = pattern.match(scope["path"])
+                    if match:
+                        id = int(match.group(1)) if match.groups() else None
+                        response = await self.handle_native(environ, model, id, not_found_message)
+                        if response is not None:
+                            return await send_response(send, response)
+                        break
+            await self.run_wsgi(environ, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.engine is not None:
+                    await self.engine.dispose()
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def handle_native(self, environ, model, id, not_found_message):
+        """Runs a catalog route inside a regular Flask request context, None when it has to stream."""
+        flask_app = self.flask_app
+        ctx = flask_app.request_context(environ)
+        ctx.push()
+        try:
+            # streams and ?include= run on the Flask app
+            if (id is None and wants_stream()) or "include" in request.args:
+                return None
+            try:
+                rv = flask_app.preprocess_request()
+                if rv is None:
+                    if id is None:
+                        rv = await self.collection(model)
+                    else:
+                        rv = await self.entity(model, id, not_found_message)
+            except Exception as error:
+                try:
+                    rv = flask_app.handle_user_exception(error)
+                except Exception as unhandled:
+                    rv = flask_app.handle_exception(unhandled)
+            response = flask_app.make_response(rv)
+            return flask_app.process_response(response)
+        finally:
+            ctx.pop()
+
+    async def collection(self, model):
+        key = collection_cache.key(model)
+        cached = collection_cache.lookup(key)
+        if cached is not None:
+            return cached
+        etag = None
+        async with self.session() as session:
+            if hasattr(model, "edited"):
+                conditions = parse_filters(model, model.filter_fields)
+                result = await session.execute(validators_query(model, conditions).statement)
+                etag = validators_from_row(model, result.one())
+                if is_not_modified(etag):
+                    return not_modified_response(etag)
+            query, fields, limit = page_query(model)
+            rows = (await session.execute(query.statement)).all()
+        # encoding and compressing a large page would hold the event loop
+        return await asyncio.to_thread(self.collection_response, key, rows, fields, limit, etag)
+
+    def collection_response(self, key, rows, fields, limit, etag):
+        response = page_response(*page_result(rows, fields, limit))
+        if etag is not None:
+            set_validators(response, etag)
+        # compressed here rather than by the after_request hook, which runs on the event loop
+        compressor.compress(response)
+        return collection_cache.store(key, response)
+
+    async def entity(self, model, id, not_found_message):
+        body = entity_cache.lookup(model, id)
+        if body is None:
+            async with self.session() as session:
+                instance = await session.get(model, id)
+                if instance is None:
+                    raise APIException(not_found_message, status_code=404)
+                body = await asyncio.to_thread(entity_cache.store, model, id, instance)
+        return entity_cache.body_response(body)
+
+    async def run_wsgi(self, environ, receive, send):
+        """
+        Runs the Flask app on the thread pool. The whole response is produced on one
+        thread (the session and sqlite connections are bound to it), the chunks are
+        handed to the event loop through a bounded queue. Once the client disconnects the
+        iteration stops at the next chunk, so an endless response like the change stream
+        gives its thread back.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=8)
+        disconnected = threading.Event()
+
+        def put(message):
+            asyncio.run_coroutine_threadsafe(queue.put(message), loop).result()
+
+        def run():
+            def start_response(status, headers, exc_info=None):
+                put(("start", int(status.split(" ", 1)[0]), headers))
+            try:
+                iterable = self.flask_app.wsgi_app(environ, start_response)
+                try:
+                    for chunk in iterable:
+                        if disconnected.is_set():
+                            break
+                        if chunk:
+                            put(("body", chunk))
+                finally:
+                    if hasattr(iterable, "close"):
+                        iterable.close()
+            finally:
+                put(("end",))
+
+        async def watch():
+            # the body was read already, the next message is the disconnect
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        future = loop.run_in_executor(self.executor, run)
+        watcher = asyncio.ensure_future(watch())
+        try:
+            while True:
+                message = await queue.get()
+                if message[0] == "end":
+                    break
+                if disconnected.is_set():
+                    # drained until the thread is done, it may be blocked on a full queue
+                    continue
+                if message[0] == "start":
+                    headers = [(name.lower().encode("latin1"), value.encode("latin1")) for name, value in message[2]]
+                    await send({"type": "http.response.start", "status": message[1], "headers": headers})
+                else:
+                    await send({"type": "http.response.body", "body": message[1], "more_body": True})
+            if not disconnected.is_set():
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            watcher.cancel()
+        await future
+
+# the streams of /changes/stream run on the threads of the executor
+application = AsyncApplication(create_app({"MIGRATIONS": False,
+                                           "WEB_THREADS": int(os.environ.get('ASGI_WSGI_THREADS', 32))}))
@@ -0,0 +1,24 @@
+from flask import g
+from flask_jwt_extended import get_jwt, get_jwt_identity
+from models import User
+
+
+def current_user_id():
+    """Id of the authenticated user, from the token claims without a query."""
+    user_id = get_jwt().get("user_id")
+    if user_id is not None:
+        return user_id
+    # tokens issued before the user_id claim only carry the email
+    user = get_current_user()
+    return user.id if user is not None else None
+
+
+def get_current_user():
+    """Loads the User of the JWT identity once per request, the following calls reuse it."""
+    if "current_user" not in g:
+        user_id = get_jwt().get("user_id")
+        if user_id is not None:
+            g.current_user = User.query.get(user_id)
+        else:
+            g.current_user = User.query.filter_by(email=get_jwt_identity()).first()
+    return g.current_user
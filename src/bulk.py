@@ -0,0 +1,234 @@
+import re
+import click
+from datetime import datetime, timezone
+from flask import request, json, current_app
+from flask.cli import AppGroup
+from utils import APIException, required_fields
+from pagination import coerce_value
+from cache import entity_cache, collection_cache
+from search import search_index
+from changes import change_feed
+from jobs import job_queue
+from models import db, Character, Planet
+
+# resource name: model, for the jobs and the import command
+BULK_MODELS = {"people": Character, "planets": Planet}
+MAX_BATCH_SIZE = 10000
+
+
+def parse_bulk_body():
+    """Accepts a JSON array or one JSON object per line (application/x-ndjson)."""
+    if request.mimetype == "application/x-ndjson":
+        lines = request.get_data(as_text=True).splitlines()
+        try:
+            return [json.loads(line) for line in lines if line.strip()]
+        except ValueError as error:
+            raise APIException(f'Invalid NDJSON body: {error}', status_code=400)
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        raise APIException('Body must be a JSON array', status_code=400)
+    return items
+
+
+def parse_batch_size():
+    try:
+        batch_size = int(request.args.get("batch_size", current_app.config["BULK_BATCH_SIZE"]))
+    except ValueError:
+        raise APIException('batch_size must be an integer', status_code=400)
+    if batch_size < 1:
+        raise APIException('batch_size must be greater than 0', status_code=400)
+    return min(batch_size, MAX_BATCH_SIZE)
+
+
+def validate_item(model, item):
+    """Returns the row to write for `item`, raises APIException with the reason when it is invalid."""
+    if not isinstance(item, dict):
+        raise APIException('Item must be an object')
+    missing = [field for field in required_fields(model) if item.get(field, None) is None]
+    if missing:
+        raise APIException('Missing fields: ' + ", ".join(missing))
+    row = {}
+    for field in model.public_fields:
+        if field == "id" or item.get(field, None) is None:
+            continue
+        row[field] = coerce_value(getattr(model, field), item[field])
+    now = datetime.now()
+    row.setdefault("created", now)
+    row["edited"] = row.get("edited", now)
+    return row
+
+
+def foreign_key_checks(model):
+    # (column name, referenced column) for every foreign key of the model
+    return [(column.key, next(iter(column.foreign_keys)).column)
+            for column in model.__table__.columns if column.foreign_keys]
+
+
+def missing_references(session, model, rows):
+    """One IN query per foreign key column, returns {column name: set of unknown ids}."""
+    missing = {}
+    for name, target in foreign_key_checks(model):
+        values = {row[name] for row in rows if name in row}
+        if not values:
+            continue
+        found = {value for (value,) in session.query(target).filter(target.in_(values))}
+        missing[name] = values - found
+    return missing
+
+
+def load_batch(session, model, batch, upsert, result):
+    """
+    Writes one batch of (index, row) pairs: one SELECT for the names that already exist,
+    one SELECT per foreign key, then one executemany INSERT and, when upserting,
+    one executemany UPDATE.
+    """
+    missing = missing_references(session, model, [row for index, row in batch])
+    valid = []
+    for index, row in batch:
+        unknown = [name for name, ids in missing.items() if row.get(name) in ids]
+        if unknown:
+            result["errors"].append({"index": index, "message": 'Unknown ' + ", ".join(unknown)})
+        else:
+            valid.append((index, row))
+
+    names = [row["name"] for index, row in valid]
+    existing = dict(session.query(model.name, model.id).filter(model.name.in_(names)))
+    inserts = []
+    updates = []
+    for index, row in valid:
+        if row["name"] in existing:
+            if not upsert:
+                result["errors"].append({"index": index, "message": f'{row["name"]} already exist'})
+                continue
+            row = dict(row, id=existing[row["name"]])
+            row.pop("created", None)
+            updates.append(row)
+        else:
+            inserts.append(row)
+
+    if inserts:
+        session.bulk_insert_mappings(model, inserts)
+        if change_feed.enabled:
+            # the mappings do not return the new ids, one more SELECT by name
+            names = [row["name"] for row in inserts]
+            inserted = [id for (id,) in session.query(model.id).filter(model.name.in_(names))]
+            change_feed.record(session, model, inserted, "insert")
+    if updates:
+        session.bulk_update_mappings(model, updates)
+        change_feed.record(session, model, [row["id"] for row in updates], "update")
+    result["inserted"] += len(inserts)
+    result["updated"] += len(updates)
+    return [row["id"] for row in updates]
+
+
+def bulk_load(session, model, items, batch_size=None, upsert=False):
+    """
+    Validates `items` and writes them in batches of `batch_size` (BULK_BATCH_SIZE by default)
+    inside one transaction. Invalid items are skipped and reported by their position in `items`.
+    """
+    batch_size = batch_size or current_app.config["BULK_BATCH_SIZE"]
+    result = {"inserted": 0, "updated": 0, "errors": []}
+    try:
+        updated_ids = load_items(session, model, items, batch_size, upsert, result)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    # bulk mappings skip the session events, so the cached entities are dropped here
+    for id in updated_ids:
+        entity_cache.invalidate(model, id)
+    if result["inserted"] or result["updated"]:
+        collection_cache.changed(model)
+    search_index.changed(model, updated_ids)
+    return result
+
+
+def load_items(session, model, items, batch_size, upsert, result):
+    seen = set()
+    batch = []
+    updated_ids = []
+    for index, item in enumerate(items):
+        try:
+            row = validate_item(model, item)
+        except APIException as error:
+            result["errors"].append({"index": index, "message": error.message})
+            continue
+        if row["name"] in seen:
+            result["errors"].append({"index": index, "message": f'Duplicated name {row["name"]}'})
+            continue
+        seen.add(row["name"])
+        batch.append((index, row))
+        if len(batch) >= batch_size:
+            updated_ids += load_batch(session, model, batch, upsert, result)
+            batch = []
+    if batch:
+        updated_ids += load_batch(session, model, batch, upsert, result)
+    return updated_ids
+
+
+def bulk_response(session, model):
+    items = parse_bulk_body()
+    upsert = request.args.get("upsert", None) == "true"
+    return bulk_load(session, model, items, parse_batch_size(), upsert)
+
+
+def bulk_job_response(session, resource, user_id):
+    """?async=true, the items are stored in a job and the response is a 202 to poll."""
+    payload = {"resource": resource, "items": parse_bulk_body(), "batch_size": parse_batch_size(),
+               "upsert": request.args.get("upsert", None) == "true"}
+    return job_queue.accepted_response(session, "bulk_load", payload, user_id)
+
+
+@job_queue.handler("bulk_load")
+def bulk_load_job(resource, items, batch_size, upsert):
+    return bulk_load(db.session, BULK_MODELS[resource], items, batch_size, upsert)
+
+
+# SWAPI dumps use urls for relations, numbers with thousand separators
+# and utc timestamps ending in Z
+def swapi_value(value, is_reference=False):
+    if not isinstance(value, str):
+        return value
+    if is_reference:
+        match = re.match(r"^https?://.*/(\d+)/?$", value)
+        return int(match.group(1)) if match else value
+    if re.match(r"^\d{1,3}(,\d{3})+$", value):
+        return value.replace(",", "")
+    if re.match(r"^\d{4}-\d{2}-\d{2}T.*Z$", value):
+        moment = datetime.fromisoformat(value[:-1] + "+00:00")
+        return moment.astimezone(timezone.utc).replace(tzinfo=None).isoformat()
+    return value
+
+
+def swapi_record(model, record):
+    references = {name for name, target in foreign_key_checks(model)}
+    record = record.get("fields", record)
+    return {key: swapi_value(value, key in references) for key, value in record.items()}
+
+
+catalog_cli = AppGroup('catalog', help='Load the characters and planets catalog.')
+
+
+@catalog_cli.command('import')
+@click.argument('resource', type=click.Choice(['people', 'planets']))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', type=int, help='Rows per statement, BULK_BATCH_SIZE by default.')
+@click.option('--upsert', is_flag=True, help='Update the entities that already exist by name.')
+def import_command(resource, path, batch_size, upsert):
+    """Imports a SWAPI style dump (JSON array, {"results": [...]} or NDJSON) from PATH."""
+    model = BULK_MODELS[resource]
+
+    with open(path) as dump:
+        content = dump.read()
+    try:
+        records = json.loads(content)
+    except ValueError:
+        records = [json.loads(line) for line in content.splitlines() if line.strip()]
+    if isinstance(records, dict):
+        records = records.get("results", [])
+
+    result = bulk_load(db.session, model, (swapi_record(model, record) for record in records), batch_size, upsert)
+    click.echo(f'{result["inserted"]} inserted, {result["updated"]} updated, {len(result["errors"])} errors')
+    for error in result["errors"]:
+        click.echo(f'  item {error["index"]}: {error["message"]}', err=True)
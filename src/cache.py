@@ -0,0 +1,271 @@
+import os
+import time
+import threading
+from collections import OrderedDict, defaultdict
+from flask import current_app, request
+from sqlalchemy import event
+from utils import APIException
+from serialization import dumps
+from conditional import make_etag, is_not_modified, not_modified_response, set_validators
+from compression import compressor
+from database import replica_bind
+
+
+class MemoryBackend:
+    """In-process cache with a TTL per entry and LRU eviction once max_entries is reached."""
+
+    def __init__(self, ttl=300, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisBackend:
+    """
+    Shared cache for multi-worker deployments. `client` is anything with the
+    redis-py get/setex/delete interface, so a local stand-in can be used in tests.
+    """
+
+    def __init__(self, client, ttl=300, prefix="swapi:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.client.setex(self.prefix + key, self.ttl, value)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+def cache_key(model, id):
+    return f"{model.__tablename__}:{id}"
+
+
+class EntityCache:
+    """
+    Read-through cache of the serialized JSON body of single entities, keyed by model and id.
+    Entries are invalidated when a session that touched them commits, and only filled from
+    the primary.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app, db):
+        if self.backend is None:
+            app.config.setdefault("CACHE_TTL", int(os.environ.get('CACHE_TTL', 300)))
+            app.config.setdefault("CACHE_BACKEND", os.environ.get('CACHE_BACKEND', 'memory'))
+            app.config.setdefault("CACHE_URL", os.environ.get('CACHE_URL', 'redis://localhost:6379/0'))
+            app.config.setdefault("CACHE_MAX_ENTRIES", int(os.environ.get('CACHE_MAX_ENTRIES', 10000)))
+            ttl = app.config["CACHE_TTL"]
+            if app.config["CACHE_BACKEND"] == 'redis':
+                import redis
+                client = redis.Redis.from_url(app.config["CACHE_URL"])
+                self.backend = RedisBackend(client, ttl=ttl)
+            else:
+                self.backend = MemoryBackend(ttl=ttl, max_entries=app.config["CACHE_MAX_ENTRIES"])
+        # db.session is shared by every app of the process, listen once
+        if not event.contains(db.session, 'after_flush', self._collect_keys):
+            event.listen(db.session, 'after_flush', self._collect_keys)
+            event.listen(db.session, 'after_commit', self._invalidate_keys)
+            event.listen(db.session, 'after_rollback', self._discard_keys)
+
+    def lookup(self, model, id):
+        body = self.backend.get(cache_key(model, id))
+        if body is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return body
+
+    def store(self, model, id, entity):
+        body = dumps(entity.serialize()) + b"\n"
+        self.backend.set(cache_key(model, id), body)
+        return body
+
+    def get_or_load(self, model, id, not_found_message):
+        body = self.lookup(model, id)
+        if body is not None:
+            return body
+        entity = model.query.get(id)
+        if entity is None:
+            raise APIException(not_found_message, status_code=404)
+        if replica_bind() is not None:
+            # a lagging replica would put back the row a commit just invalidated
+            return dumps(entity.serialize()) + b"\n"
+        return self.store(model, id, entity)
+
+    def response(self, model, id, not_found_message):
+        return self.body_response(self.get_or_load(model, id, not_found_message))
+
+    def body_response(self, body):
+        etag = make_etag(body)
+        if is_not_modified(etag):
+            return not_modified_response(etag)
+        response = current_app.response_class(body, mimetype="application/json")
+        return set_validators(response, etag)
+
+    def invalidate(self, model, id):
+        self.backend.delete(cache_key(model, id))
+
+    def stats(self):
+        stats = {"hits": self.hits, "misses": self.misses}
+        if hasattr(self.backend, "evictions"):
+            stats["evictions"] = self.backend.evictions
+        return stats
+
+    # the keys touched by a flush are only dropped once the transaction commits,
+    # so a concurrent reader can not re-cache the old row in between
+    def _collect_keys(self, session, flush_context):
+        keys = session.info.setdefault("entity_cache_keys", set())
+        for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+            if hasattr(instance, "__tablename__") and getattr(instance, "id", None) is not None:
+                keys.add(cache_key(type(instance), instance.id))
+
+    def _invalidate_keys(self, session):
+        keys = session.info.pop("entity_cache_keys", None)
+        if keys:
+            self.backend.delete(*keys)
+
+    def _discard_keys(self, session):
+        session.info.pop("entity_cache_keys", None)
+
+
+entity_cache = EntityCache()
+
+
+class CollectionCache:
+    """
+    Final, encoded and compressed bodies of the collection responses, so a repeated read
+    is served from memory without a query. Entries are keyed by the generation of their
+    table, which every commit writing to it moves forward, so they are rebuilt by the next
+    read. Writes of other processes show up once the entries expire (COLLECTION_CACHE_TTL).
+    """
+
+    max_body_size = 16 * 1024 * 1024
+
+    def __init__(self):
+        self.backend = None
+        self.generations = defaultdict(int)
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app, db):
+        app.config.setdefault("COLLECTION_CACHE_TTL", int(os.environ.get('COLLECTION_CACHE_TTL', 5)))
+        app.config.setdefault("COLLECTION_CACHE_MAX_ENTRIES", int(os.environ.get('COLLECTION_CACHE_MAX_ENTRIES', 256)))
+        ttl = app.config["COLLECTION_CACHE_TTL"]
+        # a later app without the cache does not keep the backend of an earlier one
+        self.backend = None
+        if ttl > 0:
+            self.backend = MemoryBackend(ttl=ttl, max_entries=app.config["COLLECTION_CACHE_MAX_ENTRIES"])
+        if not event.contains(db.session, 'after_flush', self._collect_tables):
+            event.listen(db.session, 'after_flush', self._collect_tables)
+            event.listen(db.session, 'do_orm_execute', self._collect_statement)
+            event.listen(db.session, 'after_commit', self._advance_tables)
+            event.listen(db.session, 'after_rollback', self._discard_tables)
+
+    def key(self, model, related=()):
+        # the url holds the host of the Link header, Accept and the coding select the body,
+        # the generations of the `related` tables cover the embedded entities. The bodies read
+        # from a replica are kept apart, the clients that just wrote read the primary ones.
+        tables = ":".join(f"{table}:{self.generations[table]}"
+                          for table in [model.__tablename__] + [other.__tablename__ for other in related])
+        route = "replica" if replica_bind() is not None else "primary"
+        return f"{route}:{tables}:{compressor.negotiate()}:{request.headers.get('Accept', '')}:{request.url}"
+
+    def lookup(self, key):
+        """The response cached under `key`, a 304 when the client has it, None on a miss."""
+        if self.backend is None:
+            return None
+        entry = self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        body, headers, etag, last_modified = entry
+        if etag is not None and is_not_modified(etag, last_modified):
+            return not_modified_response(etag, last_modified)
+        return current_app.response_class(body, status=200, headers=headers)
+
+    def store(self, key, response):
+        if self.backend is None or response.status_code != 200 or response.is_streamed:
+            return response
+        compressor.compress(response)
+        body = response.get_data()
+        if len(body) <= self.max_body_size:
+            etag = response.get_etag()[0]
+            self.backend.set(key, (body, list(response.headers), etag, response.last_modified))
+        return response
+
+    def changed(self, model):
+        """For the writes that skip the session events, like the bulk mappings."""
+        self.generations[model.__tablename__] += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": getattr(self.backend, "evictions", 0)}
+
+    # like the entity cache, a table only moves to its next generation once the transaction commits
+    def _collect_tables(self, session, flush_context):
+        tables = session.info.setdefault("collection_cache_tables", set())
+        for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+            if hasattr(instance, "__tablename__"):
+                tables.add(instance.__tablename__)
+
+    def _collect_statement(self, orm_execute_state):
+        # Query.delete() and the Core statements of the bulk routes bypass the flush
+        if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+            table = getattr(orm_execute_state.statement.table, "name", None)
+            if table is not None:
+                orm_execute_state.session.info.setdefault("collection_cache_tables", set()).add(table)
+
+    def _advance_tables(self, session):
+        for table in session.info.pop("collection_cache_tables", ()):
+            self.generations[table] += 1
+
+    def _discard_tables(self, session):
+        session.info.pop("collection_cache_tables", None)
+
+
+collection_cache = CollectionCache()
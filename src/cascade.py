@@ -0,0 +1,137 @@
+from collections import Counter
+from functools import lru_cache
+from flask import current_app
+from utils import APIException
+from cache import entity_cache
+from search import search_index
+from changes import change_feed
+from stats import increment_favorites
+from jobs import job_queue
+from models import (db, Character, Planet, User, FavoriteCharacter, FavoritePlanet,
+                    CharacterFavoriteCount, PlanetFavoriteCount)
+
+# favorites table: (column of the favorited entity, its counter table)
+FAVORITES = {
+    FavoriteCharacter: ("character_id", CharacterFavoriteCount),
+    FavoritePlanet: ("planet_id", PlanetFavoriteCount),
+}
+
+
+@lru_cache(maxsize=None)
+def references(model):
+    """(model, column) of every foreign key pointing at `model`."""
+    return tuple((mapper.class_, column) for mapper in db.Model.registry.mappers
+                 for column in mapper.local_table.columns
+                 if any(key.column.table is model.__table__ for key in column.foreign_keys))
+
+
+def referencing_tables(session, model, id):
+    """The tables with rows pointing at the entity, one EXISTS query per foreign key."""
+    return [other.__tablename__ for other, column in references(model)
+            if session.query(session.query(column).filter(column == id).exists()).scalar()]
+
+
+def require(session, model, id, label):
+    if session.query(model.id).filter_by(id=id).scalar() is None:
+        raise APIException(f'{label} not found', status_code=404)
+
+
+def in_batches(session, query, delete, committed=None):
+    """
+    Runs delete(rows) on the first CASCADE_BATCH_SIZE rows of `query` and commits, until it
+    finds none. A job that stopped half way starts again from what is left, the jobs do not
+    require their root either: a retry after the root was deleted finishes the dependents.
+    """
+    # a cascade never holds its locks for the whole delete
+    batch_size = current_app.config["CASCADE_BATCH_SIZE"]
+    total = 0
+    while True:
+        rows = query.limit(batch_size).all()
+        if not rows:
+            return total
+        delete(rows)
+        session.commit()
+        if committed is not None:
+            committed(rows)
+        total += len(rows)
+
+
+def favorites_query(session, favorite, condition):
+    target = getattr(favorite, FAVORITES[favorite][0])
+    return session.query(favorite.id, target, favorite.user_id).filter(condition).order_by(favorite.id)
+
+
+def delete_favorites(session, favorite, rows, recount):
+    """`rows` are (id, favorited id, user id), `recount` decrements the counters of the favorited entities."""
+    session.query(favorite).filter(favorite.id.in_([row[0] for row in rows])).delete(synchronize_session=False)
+    change_feed.record_favorites(session, favorite, [(target, user_id) for id, target, user_id in rows], "delete")
+    if recount:
+        counts = Counter(target for id, target, user_id in rows)
+        increment_favorites(session, FAVORITES[favorite][1], {target: -count for target, count in counts.items()})
+
+
+def delete_entities(session, model, ids):
+    # a retried job finds the rows it deleted already gone, they are not logged twice
+    if session.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False):
+        change_feed.record(session, model, ids, "delete")
+
+
+def forget(model, ids):
+    # the query deletes skip the session events of the entity cache and the search index
+    for id in ids:
+        entity_cache.invalidate(model, id)
+    search_index.changed(model, ids)
+
+
+def delete_characters(session, ids):
+    """Deletes the characters with their favorites and counters, returns the number of favorites."""
+    favorites = in_batches(session, favorites_query(session, FavoriteCharacter, FavoriteCharacter.character_id.in_(ids)),
+                           lambda rows: delete_favorites(session, FavoriteCharacter, rows, recount=False))
+    session.query(CharacterFavoriteCount).filter(
+        CharacterFavoriteCount.character_id.in_(ids)).delete(synchronize_session=False)
+    delete_entities(session, Character, ids)
+    return favorites
+
+
+@job_queue.handler("delete_character")
+def delete_character_job(id):
+    session = db.session
+    favorites = delete_characters(session, [id])
+    session.commit()
+    forget(Character, [id])
+    return {"id": id, "favorites": favorites}
+
+
+@job_queue.handler("delete_planet")
+def delete_planet_job(id):
+    """Deletes the planet, the characters of its homeworld and the favorites of both."""
+    session = db.session
+    result = {"id": id, "characters": 0, "favorites": 0}
+
+    def delete_residents(rows):
+        result["favorites"] += delete_characters(session, [row[0] for row in rows])
+
+    residents = session.query(Character.id).filter(Character.homeworld == id).order_by(Character.id)
+    result["characters"] = in_batches(session, residents, delete_residents,
+                                      lambda rows: forget(Character, [row[0] for row in rows]))
+    result["favorites"] += in_batches(session, favorites_query(session, FavoritePlanet, FavoritePlanet.planet_id == id),
+                                      lambda rows: delete_favorites(session, FavoritePlanet, rows, recount=False))
+    session.query(PlanetFavoriteCount).filter_by(planet_id=id).delete(synchronize_session=False)
+    delete_entities(session, Planet, [id])
+    session.commit()
+    forget(Planet, [id])
+    return result
+
+
+@job_queue.handler("delete_user")
+def delete_user_job(id):
+    """Deletes the user and its favorites, the counters of the favorited entities go down."""
+    session = db.session
+    favorites = 0
+    for favorite in FAVORITES:
+        favorites += in_batches(session, favorites_query(session, favorite, favorite.user_id == id),
+                                lambda rows: delete_favorites(session, favorite, rows, recount=True))
+    delete_entities(session, User, [id])
+    session.commit()
+    forget(User, [id])
+    return {"id": id, "favorites": favorites}
@@ -0,0 +1,369 @@
+import os
+import time
+import queue
+import threading
+from datetime import datetime, timedelta
+import click
+from flask import request, current_app, stream_with_context
+from flask.cli import AppGroup
+from flask_jwt_extended import verify_jwt_in_request, get_jwt
+from sqlalchemy import event, func, inspect, or_
+from utils import APIException, config_flag
+from serialization import dumps, json_response
+from pagination import parse_limit
+from auth import current_user_id
+from models import db, Change, Character, Planet, User, FavoriteCharacter, FavoritePlanet
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+# model: (resource in the feed, column of the id clients know, column of the user who sees it)
+FEEDS = {
+    Character: ("people", "id", None),
+    Planet: ("planets", "id", None),
+    User: ("users", "id", None),
+    FavoritePlanet: ("favorite_planets", "planet_id", "user_id"),
+    FavoriteCharacter: ("favorite_people", "character_id", "user_id"),
+}
+
+CHANGE_COLUMNS = (Change.id, Change.resource, Change.entity_id, Change.operation, Change.user_id, Change.created)
+
+changes_cli = AppGroup("changes", help="Maintains the change log.")
+
+
+def latest_cursor():
+    return db.session.query(func.max(Change.id)).scalar() or 0
+
+
+# The ids are taken when a transaction writes its changes, not when it commits: id N can
+# show up after N + 1 was read. A cursor only moves past the changes written more than
+# CHANGE_FEED_SETTLE seconds ago, a transaction committing later than that can be missed.
+def settled_before():
+    return datetime.now() - timedelta(seconds=change_feed.settle)
+
+
+def settled_cursor(before):
+    return db.session.query(func.max(Change.id)).filter(Change.created < before).scalar() or 0
+
+
+def resume_cursor(cursor, rows, before):
+    """The cursor after the longest run of `rows` (ordered by id) written before `before`."""
+    for row in rows:
+        if row.created >= before:
+            break
+        cursor = row.id
+    return cursor
+
+
+def read_changes(since, limit, user_id=None, all_users=False, before=None):
+    """Changes after the `since` cursor, the public ones plus the favorites of `user_id`."""
+    query = db.session.query(*CHANGE_COLUMNS).filter(Change.id > since)
+    if before is not None:
+        query = query.filter(Change.created < before)
+    if not all_users:
+        query = query.filter(or_(Change.user_id.is_(None), Change.user_id == user_id)
+                             if user_id is not None else Change.user_id.is_(None))
+    return query.order_by(Change.id).limit(limit).all()
+
+
+def serialize_change(row):
+    return {"cursor": row.id, "resource": row.resource, "id": row.entity_id,
+            "operation": row.operation, "created": row.created}
+
+
+def encode_event(row, resume):
+    # EventSource sends the event id back as Last-Event-ID when it reconnects, it is the
+    # settled cursor, the changes after it are sent again and the client skips the ones it has
+    return b"id: %d\nevent: change\ndata: %s\n\n" % (resume, dumps(serialize_change(row)))
+
+
+def check_retained(since):
+    oldest = db.session.query(func.min(Change.id)).scalar()
+    if oldest is not None and since < oldest - 1:
+        raise APIException(f'Changes after {since} were pruned, reload the collections', status_code=410,
+                           payload={"cursor": settled_cursor(settled_before())})
+
+
+def parse_since():
+    since = request.args.get("since", request.headers.get("Last-Event-ID", None))
+    if since is None:
+        return None
+    try:
+        since = int(since)
+    except ValueError:
+        raise APIException('since must be an integer', status_code=400)
+    if since < 0:
+        raise APIException('since must not be negative', status_code=400)
+    return since
+
+
+def optional_user_id():
+    # the favorites changes need a token, the catalog ones do not
+    verify_jwt_in_request(optional=True)
+    if not get_jwt():
+        return None
+    return current_user_id()
+
+
+class Subscription(queue.Queue):
+    # set by the broadcaster when the client fell too far behind
+    closed = False
+
+
+class ChangeFeed:
+    """
+    Writes a row of the change log for every insert, update and delete of the FEEDS models,
+    in the transaction of the write. The session events see the ORM writes (the routes and
+    Flask-Admin), the writes that skip them (Query.delete, Core inserts, bulk mappings) call
+    record(). Each process runs one broadcaster thread that reads the new changes once for
+    all of its stream subscribers, so the database sees one query per poll, not per client.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.settle = 2.0
+        self.cursor = 0
+        # ids after the cursor the broadcaster sent already
+        self._published = set()
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def init_app(self, app, db):
+        app.config.setdefault("CHANGE_FEED", os.environ.get('CHANGE_FEED', '1') == '1')
+        # how often the broadcaster looks for the changes of the other processes
+        app.config.setdefault("CHANGE_FEED_POLL_INTERVAL", float(os.environ.get('CHANGE_FEED_POLL_INTERVAL', 1)))
+        app.config.setdefault("CHANGE_FEED_KEEPALIVE", float(os.environ.get('CHANGE_FEED_KEEPALIVE', 15)))
+        app.config.setdefault("CHANGE_FEED_SETTLE", float(os.environ.get('CHANGE_FEED_SETTLE', 2)))
+        # a stream ends after this many seconds and the client reconnects with its Last-Event-ID,
+        # the server only notices a gone client when it writes to it
+        app.config.setdefault("CHANGE_FEED_MAX_AGE", float(os.environ.get('CHANGE_FEED_MAX_AGE', 300)))
+        # every stream holds a thread of the server, half of them are left to the other requests
+        app.config.setdefault("WEB_THREADS", int(os.environ.get('WEB_THREADS', 8)))
+        app.config.setdefault("CHANGE_FEED_MAX_SUBSCRIBERS",
+                              int(os.environ.get('CHANGE_FEED_MAX_SUBSCRIBERS', max(1, app.config["WEB_THREADS"] // 2))))
+        app.config.setdefault("CHANGE_FEED_QUEUE", int(os.environ.get('CHANGE_FEED_QUEUE', 64)))
+        self.enabled = config_flag(app.config["CHANGE_FEED"])
+        self.poll_interval = app.config["CHANGE_FEED_POLL_INTERVAL"]
+        self.keepalive = app.config["CHANGE_FEED_KEEPALIVE"]
+        self.settle = app.config["CHANGE_FEED_SETTLE"]
+        self.max_age = app.config["CHANGE_FEED_MAX_AGE"]
+        self.max_subscribers = app.config["CHANGE_FEED_MAX_SUBSCRIBERS"]
+        self.queue_size = app.config["CHANGE_FEED_QUEUE"]
+        if self.enabled and not event.contains(db.session, 'after_flush', self._record_flush):
+            event.listen(db.session, 'after_flush', self._record_flush)
+            event.listen(db.session, 'after_commit', self._notify)
+            event.listen(db.session, 'after_rollback', self._discard)
+
+    def record(self, session, model, ids, operation, user_id=None):
+        """For the writes that skip the session events, `ids` are the ids clients know (FEEDS)."""
+        if not self.enabled or not ids:
+            return
+        now = datetime.now()
+        self._insert(session, [{"resource": FEEDS[model][0], "entity_id": id, "operation": operation,
+                                "user_id": user_id, "created": now} for id in ids])
+
+    def record_favorites(self, session, model, pairs, operation):
+        """record() for the favorites of several users, `pairs` are (favorited id, user id)."""
+        if not self.enabled or not pairs:
+            return
+        now = datetime.now()
+        self._insert(session, [{"resource": FEEDS[model][0], "entity_id": id, "operation": operation,
+                                "user_id": user_id, "created": now} for id, user_id in pairs])
+
+    def _insert(self, session, rows):
+        # the connection of the session, so the log is written and rolled back with the change
+        session.connection().execute(Change.__table__.insert(), rows)
+        session.info["change_feed"] = True
+
+    def _record_flush(self, session, flush_context):
+        rows = []
+        now = datetime.now()
+        for operation, instances in (("insert", session.new), ("update", session.dirty), ("delete", session.deleted)):
+            for instance in instances:
+                feed = FEEDS.get(type(instance))
+                if feed is None:
+                    continue
+                if operation == "update":
+                    # only the public columns, a password rehash is not a change clients see
+                    attrs = inspect(instance).attrs
+                    if not any(attrs[field].history.has_changes() for field in type(instance).public_fields):
+                        continue
+                resource, id_column, user_column = feed
+                rows.append({"resource": resource, "entity_id": getattr(instance, id_column), "operation": operation,
+                             "user_id": getattr(instance, user_column) if user_column else None, "created": now})
+        if rows:
+            self._insert(session, rows)
+
+    def _notify(self, session):
+        # local commits reach the streams right away, the other processes' on the next poll
+        if session.info.pop("change_feed", None):
+            self._wakeup.set()
+
+    def _discard(self, session):
+        session.info.pop("change_feed", None)
+
+    def response(self):
+        """GET /changes?since=<cursor>, without since only the current cursor to start from."""
+        user_id = optional_user_id()
+        since = parse_since()
+        before = settled_before()
+        if since is None:
+            return json_response({"changes": [], "cursor": settled_cursor(before), "more": False})
+        check_retained(since)
+        limit = parse_limit() or DEFAULT_LIMIT
+        # only the settled changes, the ones after them may still be joined by a late commit
+        rows = read_changes(since, limit + 1, user_id, before=before)
+        more = len(rows) > limit
+        rows = rows[:limit]
+        # when nothing is visible to this client, it can skip past the favorites of the others
+        cursor = rows[-1].id if rows else max(since, settled_cursor(before))
+        return json_response({"changes": [serialize_change(row) for row in rows], "cursor": cursor, "more": more})
+
+    def stream_response(self):
+        """GET /changes/stream, server-sent events of the changes after `since` or Last-Event-ID."""
+        user_id = optional_user_id()
+        since = parse_since()
+        if since is not None:
+            check_retained(since)
+        subscription = self.subscribe()
+        retry = int(self.poll_interval * 1000)
+        deadline = time.monotonic() + self.max_age
+
+        def events():
+            try:
+                yield b"retry: %d\n\n" % retry
+                # subscribed first, so the changes committed while reading the backlog are queued.
+                # The backlog holds the unsettled changes too, the broadcaster may have sent them
+                # before this stream subscribed.
+                cursor = since if since is not None else settled_cursor(settled_before())
+                sent = set()
+                after = cursor
+                while True:
+                    before = settled_before()
+                    rows = read_changes(after, MAX_LIMIT, user_id)
+                    resume = cursor = resume_cursor(cursor, rows, before) if cursor == after else cursor
+                    for row in rows:
+                        sent.add(row.id)
+                        yield encode_event(row, resume)
+                    if len(rows) < MAX_LIMIT:
+                        break
+                    after = rows[-1].id
+                # the connection goes back to the pool while the stream waits
+                db.session.remove()
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    try:
+                        resume, batch = subscription.get(timeout=min(self.keepalive, remaining))
+                    except queue.Empty:
+                        if subscription.closed or time.monotonic() >= deadline:
+                            return
+                        yield b": keepalive\n\n"
+                        continue
+                    for id, owner, body in batch:
+                        if id > cursor and id not in sent and (owner is None or owner == user_id):
+                            sent.add(id)
+                            yield body
+                    # every change up to the settled cursor reached this stream, here or in the backlog
+                    if resume > cursor:
+                        cursor = resume
+                        sent = {id for id in sent if id > cursor}
+            finally:
+                self.unsubscribe(subscription)
+
+        response = current_app.response_class(stream_with_context(events()), mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        # nginx and the Heroku router would otherwise buffer the events
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
+
+    def subscribe(self):
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                raise APIException('Too many change streams, retry later', status_code=503)
+            if self._thread is None:
+                # the broadcaster starts at or before the backlog read of the subscriber
+                self.cursor = settled_cursor(settled_before())
+                self._published = set()
+                self._thread = threading.Thread(target=self._run, args=(current_app._get_current_object(),),
+                                                name="change-feed", daemon=True)
+                self._thread.start()
+            subscription = Subscription(maxsize=self.queue_size)
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def _run(self, app):
+        with app.app_context():
+            while True:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                with self._lock:
+                    if not self._subscribers:
+                        self._thread = None
+                        return
+                try:
+                    more = self._poll()
+                except Exception:
+                    app.logger.exception("Reading the change log failed")
+                    more = False
+                finally:
+                    db.session.remove()
+                if more:
+                    self._wakeup.set()
+
+    def _poll(self):
+        """
+        Sends the changes not sent yet: the new ones after the last id sent, and the ones of
+        late commits found in the ids between the settled cursor and it. True when there are more.
+        """
+        before = settled_before()
+        top = max(self._published, default=self.cursor)
+        window = db.session.query(Change.id, Change.created).filter(Change.id > self.cursor, Change.id <= top)
+        window = window.order_by(Change.id).all()
+        late = [row.id for row in window if row.id not in self._published]
+        rows = read_changes(top, MAX_LIMIT, all_users=True)
+        if late:
+            rows = db.session.query(*CHANGE_COLUMNS).filter(Change.id.in_(late)).all() + rows
+            rows.sort(key=lambda row: row.id)
+        resume = resume_cursor(self.cursor, sorted(window + rows, key=lambda row: row.id), before)
+        # encoded once for every subscriber
+        batch = [(row.id, row.user_id, encode_event(row, resume)) for row in rows]
+        self._published = {id for id in self._published.union(row.id for row in rows) if id > resume}
+        if batch or resume != self.cursor:
+            self._publish((resume, batch))
+        self.cursor = resume
+        return len(rows) - len(late) == MAX_LIMIT
+
+    def _publish(self, message):
+        """`message` is (settled cursor, batch), the cursor alone moves the subscribers on."""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait(message)
+            except queue.Full:
+                # the client reconnects with its Last-Event-ID and reads the backlog
+                subscription.closed = True
+                self.unsubscribe(subscription)
+
+
+change_feed = ChangeFeed()
+
+
+@changes_cli.command("prune")
+@click.option("--days", default=7, show_default=True, help="Age of the oldest change kept.")
+def prune_command(days):
+    """Deletes the old changes, clients with an older cursor get a 410 and reload the collections."""
+    latest = latest_cursor()
+    # the latest change is always kept, so its id is never reused
+    deleted = Change.query.filter(Change.created < datetime.now() - timedelta(days=days),
+                                  Change.id < latest).delete(synchronize_session=False)
+    db.session.commit()
+    click.echo(f"{deleted} changes pruned")
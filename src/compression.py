@@ -0,0 +1,71 @@
+import os
+import gzip
+from flask import request
+from utils import config_flag
+
+# brotli is optional, without it the responses are only gzipped
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ("application/json", "text/html", "text/plain", "text/css", "application/javascript")
+
+
+class Compressor:
+    """Encodes the responses over `min_size` bytes with the best coding the client accepts."""
+
+    def __init__(self):
+        self.enabled = False
+        self.min_size = 1024
+        self.gzip_level = 6
+        self.brotli_quality = 5
+        self.encodings = ["gzip"]
+
+    def init_app(self, app):
+        app.config.setdefault("COMPRESS", os.environ.get('COMPRESS', '1') == '1')
+        app.config.setdefault("COMPRESS_MIN_SIZE", int(os.environ.get('COMPRESS_MIN_SIZE', 1024)))
+        app.config.setdefault("COMPRESS_GZIP_LEVEL", int(os.environ.get('COMPRESS_GZIP_LEVEL', 6)))
+        app.config.setdefault("COMPRESS_BROTLI_QUALITY", int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5)))
+        self.enabled = config_flag(app.config["COMPRESS"])
+        self.min_size = app.config["COMPRESS_MIN_SIZE"]
+        self.gzip_level = app.config["COMPRESS_GZIP_LEVEL"]
+        self.brotli_quality = app.config["COMPRESS_BROTLI_QUALITY"]
+        # preferred first when the client accepts both with the same quality
+        self.encodings = (["br"] if brotli is not None else []) + ["gzip"]
+        if self.enabled:
+            app.after_request(self.compress)
+
+    def negotiate(self):
+        """Content coding the current request gets for a large enough body, None for identity."""
+        if not self.enabled:
+            return None
+        return request.accept_encodings.best_match(self.encodings)
+
+    def encode(self, body, encoding):
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level)
+
+    def compress(self, response):
+        if (not self.enabled or response.direct_passthrough or response.is_streamed
+                or response.status_code != 200 or "Content-Encoding" in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+        body = response.get_data()
+        if len(body) < self.min_size:
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = self.negotiate()
+        if encoding is None:
+            return response
+        response.set_data(self.encode(body, encoding))
+        response.headers["Content-Encoding"] = encoding
+        # every coding of the body shares one validator, so it can only be a weak one
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+compressor = Compressor()
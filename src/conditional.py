@@ -0,0 +1,63 @@
+import hashlib
+from flask import request, current_app
+from sqlalchemy import func
+
+
+def make_etag(*parts):
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b":")
+    return digest.hexdigest()
+
+
+def validators_query(model, conditions=()):
+    query = model.query.with_entities(func.max(model.edited), func.count(model.id), func.max(model.id))
+    for condition in conditions:
+        query = query.filter(condition)
+    return query
+
+
+def collection_validators(model, conditions=(), related=()):
+    """
+    Computes the ETag of a collection with one aggregate query (max(edited), count and
+    max(id)) instead of loading the rows, plus one per `related` model whose entities are
+    embedded in the body. Collections get no Last-Modified: a delete leaves max(edited)
+    as it was, only the count and max(id) of the ETag see it.
+    """
+    etag = validators_from_row(model, validators_query(model, conditions).one())
+    for other in related:
+        etag = make_etag(etag, validators_from_row(other, validators_query(other).one()))
+    return etag
+
+
+def validators_from_row(model, row):
+    edited, count, max_id = row
+    # the ETag keeps the microseconds of `edited`, two writes in the same second must not share it
+    return make_etag(model.__tablename__, edited, count, max_id,
+                     request.query_string.decode(), request.accept_mimetypes)
+
+
+def is_not_modified(etag, last_modified=None):
+    # If-None-Match takes precedence over If-Modified-Since (RFC 7232 section 6) and
+    # uses the weak comparison, compressed responses carry the weak form of the ETag
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is not None and last_modified is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def set_validators(response, etag, last_modified=None):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config["CACHE_MAX_AGE"]
+    response.cache_control.must_revalidate = True
+    response.vary.add("Accept")
+    return response
+
+
+def not_modified_response(etag, last_modified=None):
+    return set_validators(current_app.response_class(status=304), etag, last_modified)
@@ -0,0 +1,131 @@
+import os
+import time
+import random
+from functools import wraps
+from flask import current_app, g, request, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.engine import make_url
+
+# reads of a client go to the primary for this long after it wrote, so it sees its own writes
+PRIMARY_COOKIE = "read_primary_until"
+
+
+def engine_options(uri):
+    """SQLALCHEMY_ENGINE_OPTIONS from the DB_POOL_* variables, applied to the primary and the replicas."""
+    options = {"pool_pre_ping": os.environ.get('DB_POOL_PRE_PING', '1') == '1'}
+    url = make_url(uri)
+    # Flask-SQLAlchemy gives file sqlite databases a NullPool, there is nothing to size
+    if url.get_backend_name() != "sqlite":
+        options["pool_size"] = int(os.environ.get('DB_POOL_SIZE', 10))
+        options["max_overflow"] = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+        options["pool_timeout"] = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+        options["pool_recycle"] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    timeout = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+    if timeout and url.get_backend_name() == "postgresql":
+        options["connect_args"] = {"options": f"-c statement_timeout={timeout}"}
+    return options
+
+
+def mysql_statement_timeout(timeout):
+    def set_timeout(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"SET SESSION max_execution_time = {int(timeout)}")
+        cursor.close()
+    return set_timeout
+
+
+class RoutingSession(SignallingSession):
+    """
+    Sends the statements to a replica while `info["replica"]` holds its bind key (see
+    read_replica), and to the primary once the session flushed or committed anything.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        replica = self.info.get("replica")
+        if replica is not None and not self._flushing and not self.info.get("wrote"):
+            return self.db.get_engine(self.app, bind=replica)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy with pool settings from the environment and read replicas.
+    DB_REPLICA_CONNECTION_STRINGS is a comma separated list of replica URLs, registered as
+    the binds replica_0, replica_1... and used by the views decorated with read_replica.
+    """
+
+    def init_app(self, app):
+        uri = app.config.get('SQLALCHEMY_DATABASE_URI') or 'sqlite:///:memory:'
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(uri))
+        app.config.setdefault('DB_STATEMENT_TIMEOUT_MS', int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0)))
+        app.config.setdefault('REPLICA_LAG_SECONDS', float(os.environ.get('REPLICA_LAG_SECONDS', 5)))
+        replicas = [url.strip() for url in os.environ.get('DB_REPLICA_CONNECTION_STRINGS', '').split(',') if url.strip()]
+        binds = app.config.setdefault('SQLALCHEMY_BINDS', {}) or {}
+        for index, url in enumerate(replicas):
+            binds[f"replica_{index}"] = url
+        app.config['SQLALCHEMY_BINDS'] = binds
+        app.config['DATABASE_REPLICAS'] = [key for key in binds if key.startswith("replica_")]
+        super().init_app(app)
+        app.after_request(set_primary_cookie)
+
+    def create_session(self, options):
+        session_factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        event.listen(session_factory, 'after_flush', mark_written)
+        event.listen(session_factory, 'after_commit', mark_written)
+        return session_factory
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        timeout = self.get_app().config.get('DB_STATEMENT_TIMEOUT_MS')
+        if timeout and sa_url.get_backend_name() == "mysql":
+            event.listen(engine, 'connect', mysql_statement_timeout(timeout))
+        return engine
+
+
+def mark_written(session, flush_context=None):
+    session.info["wrote"] = True
+    if has_request_context():
+        g.wrote_primary = True
+
+
+def set_primary_cookie(response):
+    if g.get("wrote_primary") and current_app.config['DATABASE_REPLICAS']:
+        lag = current_app.config['REPLICA_LAG_SECONDS']
+        response.set_cookie(PRIMARY_COOKIE, str(time.time() + lag), max_age=int(lag) + 1, httponly=True)
+    return response
+
+
+def reads_primary():
+    try:
+        return float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def replica_bind():
+    """Bind key of the replica the current view reads from, None when it reads the primary."""
+    session = current_app.extensions['sqlalchemy'].db.session
+    if session.info.get("wrote"):
+        return None
+    return session.info.get("replica")
+
+
+def read_replica(view):
+    """Runs a read-only view against a random replica, unless the client wrote in the last REPLICA_LAG_SECONDS."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        replicas = current_app.config['DATABASE_REPLICAS']
+        if not replicas or reads_primary():
+            return view(*args, **kwargs)
+        session = current_app.extensions['sqlalchemy'].db.session
+        session.info["replica"] = random.choice(replicas)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            session.info.pop("replica", None)
+    return wrapper
@@ -0,0 +1,105 @@
+from flask import request
+from sqlalchemy.exc import IntegrityError
+from utils import APIException
+from serialization import json_response
+from stats import increment_favorites
+from changes import change_feed
+from models import (db, Character, Planet, FavoriteCharacter, FavoritePlanet,
+                    CharacterFavoriteCount, PlanetFavoriteCount)
+
+MAX_FAVORITE_CHANGES = 1000
+# a concurrent request adding or removing the same favorites makes the batch start over
+MAX_ATTEMPTS = 3
+
+# body key: favorites table, favorited entity, its column in the favorites table, counter table
+FAVORITE_TYPES = {
+    "planets": (FavoritePlanet, Planet, "planet_id", PlanetFavoriteCount),
+    "people": (FavoriteCharacter, Character, "character_id", CharacterFavoriteCount),
+}
+
+
+class ConcurrentChange(Exception):
+    pass
+
+
+def parse_ids(value, name):
+    if value is None:
+        return set()
+    if not isinstance(value, list) or any(type(id) is not int for id in value):
+        raise APIException(f'{name} must be an array of ids', status_code=400)
+    return set(value)
+
+
+def parse_favorites_patch():
+    """{"planets": {"add": [ids], "remove": [ids]}, "people": {...}} as {type: (add, remove)}."""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not body:
+        raise APIException('Body must be an object with planets and/or people', status_code=400)
+    unknown = set(body) - set(FAVORITE_TYPES)
+    if unknown:
+        raise APIException('Unknown favorite types: ' + ", ".join(sorted(unknown)), status_code=400)
+    changes = {}
+    for kind, change in body.items():
+        if not isinstance(change, dict):
+            raise APIException(f'{kind} must be an object with add and/or remove', status_code=400)
+        add = parse_ids(change.get("add"), f'{kind}.add')
+        remove = parse_ids(change.get("remove"), f'{kind}.remove')
+        if add & remove:
+            raise APIException(f'{kind} ids cannot be added and removed at once', status_code=400)
+        if len(add) + len(remove) > MAX_FAVORITE_CHANGES:
+            raise APIException(f'At most {MAX_FAVORITE_CHANGES} {kind} changes per request', status_code=400)
+        changes[kind] = (add, remove)
+    return changes
+
+
+def missing_targets(session, changes):
+    """One IN query per type, returns {type: sorted unknown ids} of the ids to add."""
+    missing = {}
+    for kind, (add, remove) in changes.items():
+        target = FAVORITE_TYPES[kind][1]
+        if add:
+            found = {id for (id,) in session.query(target.id).filter(target.id.in_(add))}
+            if add - found:
+                missing[kind] = sorted(add - found)
+    return missing
+
+
+def apply_changes(session, user_id, changes):
+    """
+    Writes the favorites that are not there yet and deletes the ones that are, with their
+    counters, in one transaction. Returns the ids actually added and removed per type.
+    """
+    diff = {}
+    for kind, (add, remove) in changes.items():
+        favorite, target, column_name, counter = FAVORITE_TYPES[kind]
+        column = getattr(favorite, column_name)
+        existing = {id for (id,) in session.query(column).filter(favorite.user_id == user_id,
+                                                                 column.in_(add | remove))}
+        added = sorted(add - existing)
+        removed = sorted(remove & existing)
+        if added:
+            session.execute(favorite.__table__.insert(), [{"user_id": user_id, column_name: id} for id in added])
+            change_feed.record(session, favorite, added, "insert", user_id)
+        if removed:
+            deleted = (session.query(favorite).filter(favorite.user_id == user_id, column.in_(removed))
+                       .delete(synchronize_session=False))
+            if deleted != len(removed):
+                raise ConcurrentChange()
+            change_feed.record(session, favorite, removed, "delete", user_id)
+        increment_favorites(session, counter, {**{id: 1 for id in added}, **{id: -1 for id in removed}})
+        diff[kind] = {"added": added, "removed": removed}
+    session.commit()
+    return diff
+
+
+def patch_favorites_response(user_id):
+    changes = parse_favorites_patch()
+    missing = missing_targets(db.session, changes)
+    if missing:
+        raise APIException('Favorites not found', status_code=404, payload={"missing": missing})
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            return json_response(apply_changes(db.session, user_id, changes))
+        except (IntegrityError, ConcurrentChange):
+            db.session.rollback()
+    raise APIException('Favorites changed concurrently, retry', status_code=409)
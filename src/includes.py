@@ -0,0 +1,92 @@
+from collections import defaultdict
+from flask import request
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, selectinload
+from utils import APIException
+from serialization import dumps, serialize_instances, serialize_rows
+
+# ids per IN query, a page (at most 1000 rows) always fits in one
+INCLUDE_BATCH_SIZE = 10000
+
+
+def parse_includes(model):
+    """
+    The relationships of ?include=a,b as (name, relationship) pairs, the names a model
+    accepts are the keys of its `includes` (include name: relationship name).
+    """
+    names = request.args.get("include", None)
+    if not names:
+        return []
+    names = [name.strip() for name in names.split(",") if name.strip()]
+    available = getattr(model, "includes", {})
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise APIException('Unknown includes: ' + ", ".join(unknown), status_code=400)
+    relationships = inspect(model).relationships
+    return [(name, relationships[available[name]]) for name in dict.fromkeys(names)]
+
+
+def join_columns(relationship):
+    (local, remote), = relationship.local_remote_pairs
+    return local, remote
+
+
+def include_columns(includes):
+    """Columns the rows of the page need to be matched with the included entities."""
+    return [join_columns(relationship)[0].key for name, relationship in includes]
+
+
+def include_models(includes):
+    return [relationship.mapper.class_ for name, relationship in includes]
+
+
+def embed_includes(items, includes):
+    """
+    Adds the related entities to the serialized `items`, one query per include (per
+    INCLUDE_BATCH_SIZE ids) whatever the number of items. To-one relationships replace
+    the foreign key with the entity, to-many ones add a list.
+    """
+    for name, relationship in includes:
+        local, remote = join_columns(relationship)
+        target = relationship.mapper.class_
+        fields = list(target.public_fields)
+        if remote.key not in fields:
+            fields.append(remote.key)
+        keys = sorted({item[local.key] for item in items if item[local.key] is not None})
+        related = []
+        for start in range(0, len(keys), INCLUDE_BATCH_SIZE):
+            query = target.query.with_entities(*[getattr(target, field) for field in fields])
+            query = query.filter(getattr(target, remote.key).in_(keys[start:start + INCLUDE_BATCH_SIZE]))
+            related += serialize_rows(fields, query.order_by(target.id).all())
+        if relationship.uselist:
+            grouped = defaultdict(list)
+            for entity in related:
+                grouped[entity[remote.key]].append(entity)
+            for item in items:
+                item[name] = grouped.get(item[local.key], [])
+        else:
+            by_key = {entity[remote.key]: entity for entity in related}
+            for item in items:
+                item[name] = by_key.get(item[local.key])
+    return items
+
+
+def entity_body(model, id, not_found_message, includes):
+    """
+    The body of one entity with its includes, to-one relationships are joined in the
+    same query and to-many ones loaded with one more query each.
+    """
+    options = [selectinload(relationship.class_attribute) if relationship.uselist
+               else joinedload(relationship.class_attribute) for name, relationship in includes]
+    instance = model.query.options(*options).get(id)
+    if instance is None:
+        raise APIException(not_found_message, status_code=404)
+    data = serialize_instances(model, [instance])[0]
+    for name, relationship in includes:
+        target = relationship.mapper.class_
+        related = getattr(instance, relationship.key)
+        if relationship.uselist:
+            data[name] = serialize_instances(target, sorted(related, key=lambda entity: entity.id))
+        else:
+            data[name] = serialize_instances(target, [related])[0] if related is not None else None
+    return dumps(data) + b"\n"
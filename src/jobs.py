@@ -0,0 +1,210 @@
+import os
+import json
+import threading
+from datetime import datetime, timedelta
+import click
+from flask import current_app, url_for
+from flask.cli import AppGroup
+from sqlalchemy import event, and_, or_
+from utils import APIException
+from serialization import json_response
+from models import db, Job
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+jobs_cli = AppGroup("jobs", help="Runs and maintains the background jobs.")
+
+
+def serialize_job(job):
+    data = {field: getattr(job, field) for field in Job.public_fields}
+    data["result"] = json.loads(job.result) if job.result is not None else None
+    data["error"] = job.error
+    return data
+
+
+class JobQueue:
+    """
+    Background jobs for the writes whose cost grows with the data (cascading deletes, bulk
+    imports, counter rebuilds). A job is a row of the `job` table added in the transaction
+    of the request, so it exists exactly when that request committed, and survives restarts.
+    The worker threads of every process (JOBS_WORKERS) and `flask jobs work` take the oldest
+    queued row with a conditional UPDATE, so each job runs in one worker at a time. A job
+    whose worker died is taken again after JOBS_TIMEOUT seconds, at most JOBS_MAX_ATTEMPTS times.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.workers = 0
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def init_app(self, app, db):
+        app.config.setdefault("JOBS_WORKERS", int(os.environ.get('JOBS_WORKERS', 2)))
+        # how often idle workers look for the jobs queued by the other processes
+        app.config.setdefault("JOBS_POLL_INTERVAL", float(os.environ.get('JOBS_POLL_INTERVAL', 1)))
+        app.config.setdefault("JOBS_TIMEOUT", float(os.environ.get('JOBS_TIMEOUT', 600)))
+        app.config.setdefault("JOBS_MAX_ATTEMPTS", int(os.environ.get('JOBS_MAX_ATTEMPTS', 3)))
+        self.workers = app.config["JOBS_WORKERS"]
+        self.poll_interval = app.config["JOBS_POLL_INTERVAL"]
+        self.timeout = app.config["JOBS_TIMEOUT"]
+        self.max_attempts = app.config["JOBS_MAX_ATTEMPTS"]
+        if not event.contains(db.session, 'after_commit', self._notify):
+            event.listen(db.session, 'after_commit', self._notify)
+            event.listen(db.session, 'after_rollback', self._discard)
+        if self.workers:
+            app.before_request(self.start)
+
+    def handler(self, kind):
+        """Registers the function running the jobs of `kind`, it gets the payload as keyword arguments."""
+        def register(function):
+            self.handlers[kind] = function
+            return function
+        return register
+
+    def enqueue(self, session, kind, payload, user_id=None):
+        """Adds a job in the transaction of `session`, the workers only see it once that commits."""
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind {kind}")
+        job = Job(kind=kind, payload=json.dumps(payload), status=QUEUED, attempts=0, user_id=user_id,
+                  created=datetime.now())
+        session.add(job)
+        session.flush()
+        session.info["jobs_queued"] = True
+        return job
+
+    def accepted_response(self, session, kind, payload, user_id=None, reuse=False):
+        """
+        Queues a job and answers 202, Location is its status route. With `reuse`, a retried
+        request gets the job of the same user and payload that is still waiting or running.
+        """
+        job = None
+        if reuse:
+            job = (Job.query.filter(Job.kind == kind, Job.payload == json.dumps(payload), Job.user_id == user_id,
+                                    Job.status.in_((QUEUED, RUNNING))).order_by(Job.id).first())
+        if job is None:
+            job = self.enqueue(session, kind, payload, user_id)
+        data = serialize_job(job)
+        session.commit()
+        response = json_response(data, status=202)
+        response.headers["Location"] = url_for("api.get_job", id=data["id"])
+        return response
+
+    def response(self, id, user_id):
+        job = Job.query.filter_by(id=id, user_id=user_id).first()
+        if job is None:
+            raise APIException('Job not found', status_code=404)
+        response = json_response(serialize_job(job))
+        if job.status in (QUEUED, RUNNING):
+            response.headers["Retry-After"] = str(max(1, int(self.poll_interval)))
+        return response
+
+    def start(self):
+        # threads do not survive a fork, each gunicorn worker starts its own on its first request
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.spawn(current_app._get_current_object(), self.workers)
+
+    def spawn(self, app, count):
+        threads = [threading.Thread(target=self._run, args=(app,), name=f"jobs-{index}", daemon=True)
+                   for index in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def claim(self):
+        """Marks the oldest runnable job as running and returns its id, None when there is none."""
+        now = datetime.now()
+        runnable = or_(Job.status == QUEUED,
+                       and_(Job.status == RUNNING, Job.started < now - timedelta(seconds=self.timeout)))
+        candidates = [id for (id,) in db.session.query(Job.id).filter(runnable).order_by(Job.id).limit(10)]
+        for id in candidates:
+            # the condition is checked again by the UPDATE, only one worker gets the row
+            claimed = (Job.query.filter(Job.id == id, runnable)
+                       .update({"status": RUNNING, "started": now, "attempts": Job.attempts + 1},
+                               synchronize_session=False))
+            db.session.commit()
+            if claimed:
+                return id
+        return None
+
+    def run(self, id):
+        job = Job.query.get(id)
+        kind, payload, attempts = job.kind, json.loads(job.payload), job.attempts
+        try:
+            if attempts > self.max_attempts:
+                raise APIException(f'Stopped after {self.max_attempts} attempts')
+            if kind not in self.handlers:
+                raise APIException(f'Unknown job kind {kind}')
+            result = self.handlers[kind](**payload)
+        except APIException as error:
+            db.session.rollback()
+            self.finish(id, FAILED, error=error.message)
+        except Exception as error:
+            db.session.rollback()
+            current_app.logger.exception("Job %s (%s) failed", id, kind)
+            if attempts < self.max_attempts:
+                # the handlers commit in batches and can run again, they skip what is already done
+                Job.query.filter_by(id=id).update({"status": QUEUED}, synchronize_session=False)
+                db.session.commit()
+            else:
+                self.finish(id, FAILED, error=str(error))
+        else:
+            self.finish(id, DONE, result=result)
+
+    def finish(self, id, status, result=None, error=None):
+        Job.query.filter_by(id=id).update({"status": status, "finished": datetime.now(), "error": error,
+                                           "result": json.dumps(result) if result is not None else None},
+                                          synchronize_session=False)
+        db.session.commit()
+
+    def _run(self, app):
+        with app.app_context():
+            while True:
+                id = None
+                try:
+                    id = self.claim()
+                    if id is not None:
+                        self.run(id)
+                except Exception:
+                    app.logger.exception("The job worker failed")
+                finally:
+                    db.session.remove()
+                if id is None:
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+
+    def _notify(self, session):
+        # the local workers take a new job right away, the other processes' on their next poll
+        if session.info.pop("jobs_queued", None):
+            self._wakeup.set()
+
+    def _discard(self, session):
+        session.info.pop("jobs_queued", None)
+
+
+job_queue = JobQueue()
+
+
+@jobs_cli.command("work")
+@click.option("--threads", default=2, show_default=True, help="Jobs run at the same time.")
+def work_command(threads):
+    """Runs the queued jobs until interrupted, for servers started with JOBS_WORKERS=0."""
+    for thread in job_queue.spawn(current_app._get_current_object(), threads):
+        thread.join()
+
+
+@jobs_cli.command("prune")
+@click.option("--days", default=7, show_default=True, help="Age of the oldest finished job kept.")
+def prune_command(days):
+    """Deletes the finished jobs, their status is no longer available."""
+    deleted = Job.query.filter(Job.finished < datetime.now() - timedelta(days=days)).delete(synchronize_session=False)
+    db.session.commit()
+    click.echo(f"{deleted} jobs pruned")
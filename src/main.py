@@ -2,313 +2,230 @@
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
 import os
-from flask import Flask, request, jsonify, url_for
-from flask_migrate import Migrate
-from flask_swagger import swagger
+from flask import Flask, Blueprint, current_app, request, jsonify
 from flask_cors import CORS
-from datetime import datetime
-from utils import APIException, generate_sitemap
-from admin import setup_admin
-from models import db, User, Character, Planet, FavoritePlanet, FavoriteCharacter
-from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required, JWTManager
+from utils import APIException, generate_sitemap, commit_or_conflict
+from cache import entity_cache, collection_cache
+from compression import compressor
+from search import search_index
+from bulk import catalog_cli
+from favorites import patch_favorites_response
+from changes import change_feed, changes_cli
+from jobs import job_queue, jobs_cli
+from stats import (stats_cli, increment_favorites, group_counts, climate_population,
+                   most_favorited)
+from auth import get_current_user, current_user_id
+from passwords import password_hasher
+from ratelimit import rate_limiter, rate_limit
+from resources import ResourceRegistry
+from sqlalchemy.orm import joinedload
+from serialization import json_response, serialize_instances
+from database import read_replica
+from models import (db, User, Character, Planet, FavoritePlanet, FavoriteCharacter,
+                    PlanetFavoriteCount, CharacterFavoriteCount)
+from flask_jwt_extended import create_access_token, jwt_required, JWTManager
 #from models import Person
 
-app = Flask(__name__)
-
-# Setup the Flask-JWT-Extended extension
-app.config["JWT_SECRET_KEY"] = "estamosprobandotaken"  # Change this!
-jwt = JWTManager(app)
-
-app.url_map.strict_slashes = False
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_CONNECTION_STRING')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-MIGRATE = Migrate(app, db)
-db.init_app(app)
-CORS(app)
-setup_admin(app)
+api = Blueprint("api", __name__)
+
+# GET/POST/PUT/PATCH/DELETE routes of the catalog, see src/resources.py
+resources = ResourceRegistry(api)
+# DELETE ?cascade=true queues the job deleting the entity and what points at it, see src/cascade.py
+resources.register(Character, "/people", "/people", "Character", cascade="delete_character")
+resources.register(Planet, "/planets", "/planet", "Planet", cascade="delete_planet")
+# signing up needs no token, the password is only set at creation and stored hashed
+resources.register(User, "/users", "/user", "User", write_item="/users", update_fields=("name", "email"),
+                   actions=("list", "get", "create", "replace", "update", "delete"),
+                   public=("list", "get", "create"), transforms={"password": password_hasher.hash},
+                   cascade="delete_user")
+
+
+def env_flag(name, default="1"):
+    return os.environ.get(name, default) == "1"
+
+
+def create_app(config=None):
+    """
+    Builds the API application. The components read their settings from app.config, filled
+    from the environment variables of the same name, and `config` overrides them.
+    The optional components are only imported when they are on: ADMIN (the Flask-Admin UI),
+    SWAGGER (/swagger.json), SITEMAP (/) and MIGRATIONS (the `flask db` commands, which
+    load alembic). A server only needs the last one for `flask db upgrade`.
+    """
+    app = Flask(__name__)
+
+    # Setup the Flask-JWT-Extended extension
+    app.config["JWT_SECRET_KEY"] = "estamosprobandotaken"  # Change this!
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_CONNECTION_STRING')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config["ADMIN"] = env_flag('ADMIN')
+    app.config["SWAGGER"] = env_flag('SWAGGER')
+    app.config["SITEMAP"] = env_flag('SITEMAP')
+    app.config["MIGRATIONS"] = env_flag('MIGRATIONS')
+    app.config["PROFILING"] = env_flag('PROFILING', "0")
+    # max-age of the GET responses, they are revalidated with their ETag after it
+    app.config["CACHE_MAX_AGE"] = int(os.environ.get('CACHE_MAX_AGE', 0))
+    # rows written per statement by the bulk imports, deleted per transaction by the cascades
+    app.config["BULK_BATCH_SIZE"] = int(os.environ.get('BULK_BATCH_SIZE', 1000))
+    app.config["CASCADE_BATCH_SIZE"] = int(os.environ.get('CASCADE_BATCH_SIZE', 1000))
+    app.config.update(config or {})
+
+    JWTManager(app)
+    # first of the before_request hooks, a rejected request does no other work
+    rate_limiter.init_app(app)
+    app.url_map.strict_slashes = False
+    if app.config["MIGRATIONS"]:
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    app.cli.add_command(catalog_cli)
+    app.cli.add_command(stats_cli)
+    app.cli.add_command(changes_cli)
+    app.cli.add_command(jobs_cli)
+    db.init_app(app)
+    entity_cache.init_app(app, db)
+    collection_cache.init_app(app, db)
+    search_index.init_app(app, db)
+    change_feed.init_app(app, db)
+    job_queue.init_app(app, db)
+    password_hasher.init_app(app)
+    CORS(app)
+    compressor.init_app(app)
+    app.register_blueprint(api)
+    if app.config["SITEMAP"]:
+        app.add_url_rule('/', 'sitemap', sitemap)
+    if app.config["SWAGGER"]:
+        app.add_url_rule('/swagger.json', 'swagger_spec', swagger_spec)
+    if app.config["ADMIN"]:
+        from admin import setup_admin
+        setup_admin(app)
+    if app.config["PROFILING"]:
+        from profiling import init_profiling
+        init_profiling(app)
+    return app
 
 # Handle/serialize errors like a JSON object
-@app.errorhandler(APIException)
+@api.app_errorhandler(APIException)
 def handle_invalid_usage(error):
     return jsonify(error.to_dict()), error.status_code
 
 # generate sitemap with all your endpoints
-@app.route('/')
 def sitemap():
-    return generate_sitemap(app)
+    return generate_sitemap(current_app)
+
+def swagger_spec():
+    from flask_swagger import swagger
+    return jsonify(swagger(current_app))
 
-@app.route("/login", methods=["POST"])
+@api.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(dict(entity_cache.stats(), collections=collection_cache.stats())), 200
+
+@api.route("/login", methods=["POST"])
+@rate_limit("RATELIMIT_LOGIN")
 def login():
     email = request.json.get("email", None)
     password = request.json.get("password", None)
-    user = User.query.filter_by(email=email, password=password).first()
-    if user is None:
+    user = User.query.filter_by(email=email).first()
+    if not password_hasher.verify(user.password if user is not None else None, password):
         raise APIException('Bad username or password', status_code=401)
+    # plaintext passwords of before the hashing migration and older hash costs are upgraded here
+    if password_hasher.needs_rehash(user.password):
+        user.password = password_hasher.hash(password)
+        db.session.commit()
 
-    access_token = create_access_token(identity=email)
+    # protected routes read the user id from the claims instead of looking up the email
+    access_token = create_access_token(identity=email, additional_claims={"user_id": user.id})
     return jsonify(access_token=access_token)
 
-@app.route('/people', methods=['GET'])
-def get_person():
-    people_query = Character.query.all()
-    all_people = list(map(lambda x: x.serialize(), people_query))
-    return jsonify(all_people), 200
-
-@app.route('/people/<int:id>', methods=['GET'])
-def get_character(id):
-    character = Character.query.get(id)
-    if character is None:
-        raise APIException('Character not found', status_code=404)
-    character = character.serialize()
-    return jsonify(character), 200
-
-@app.route('/people', methods=['POST'])
-@jwt_required()
-def add_people():
-    character = Character.query.filter_by(name=request.json.get("name", None)).first()
-    if character is not None:
-        raise APIException('Character already exist', status_code=409)
-
-    name = request.json.get("name", None)
-    height = request.json.get("height", None)
-    mass = request.json.get("mass", None)
-    hair_color = request.json.get("hair_color", None)
-    skin_color = request.json.get("skin_color", None)
-    eye_color = request.json.get("eye_color", None)
-    birth_year = request.json.get("birth_year", None)
-    gender = request.json.get("gender", None)
-    homeworld = request.json.get("homeworld", None)
-
-    character = Character(name=name,
-                    height=height,
-                    mass=mass,
-                    hair_color=hair_color,
-                    skin_color=skin_color,
-                    eye_color=eye_color,
-                    birth_year=birth_year,
-                    gender=gender,
-                    homeworld=homeworld,
-                    created=datetime.now(),
-                    edited=datetime.now()
-                    )
-    db.session.add(character)
-    db.session.commit()
-
-    character = Character.query.filter_by(name=name).first()
-    character = character.serialize()
-    return jsonify(character), 201
-
-@app.route('/people/<int:id>', methods=['PUT'])
-@jwt_required()
-def update_people(id):
-    character = Character.query.get(id)
-
-    if character is None:
-        raise APIException('User not found', status_code=404)
-
-    character.name = request.json.get("name", None)
-    character.height = request.json.get("height", None)
-    character.mass = request.json.get("mass", None)
-    character.hair_color = request.json.get("hair_color", None)
-    character.skin_color = request.json.get("skin_color", None)
-    character.eye_color = request.json.get("eye_color", None)
-    character.birth_year = request.json.get("birth_year", None)
-    character.gender = request.json.get("gender", None)
-    character.homeworld = request.json.get("homeworld", None)
-    character.edited = datetime.now()
-
-    db.session.commit()
-
-    character = Character.query.get(id)
-    character = character.serialize()
-    return jsonify(character), 201
-
-@app.route('/people/<int:id>', methods=['DELETE'])
-@jwt_required()
-def delete_person(id):
-    character = Character.query.get(id)
-    if character is None:
-        raise APIException('User not found', status_code=404)
-    db.session.delete(character)
-    db.session.commit()
-
-    people_query = Character.query.all()
-    all_people = list(map(lambda x: x.serialize(), people_query))
-    return jsonify(all_people), 200
+@api.route('/search', methods=['GET'])
+@read_replica
+def search():
+    return search_index.response()
 
-@app.route('/planets', methods=['GET'])
-def get_planets():
-    planets_query = Planet.query.all()
-    all_planets = list(map(lambda x: x.serialize(), planets_query))
-    return jsonify(all_planets), 200
+@api.route('/changes', methods=['GET'])
+@read_replica
+def get_changes():
+    return change_feed.response()
 
-@app.route('/planet/<int:id>', methods=['GET'])
-def get_planet(id):
-    planet = Planet.query.get(id)
-    if planet is None:
-        raise APIException('Planet not found', status_code=404)
-    planet = planet.serialize()
-    return jsonify(planet), 200
+@api.route('/changes/stream', methods=['GET'])
+def stream_changes():
+    return change_feed.stream_response()
 
-@app.route('/planets', methods=['POST'])
+@api.route('/jobs/<int:id>', methods=['GET'])
 @jwt_required()
-def add_planets():
-    planet = Planet.query.filter_by(name=request.json.get("name", None)).first()
-    if planet is not None:
-        raise APIException('Planet already exist', status_code=409)
-
-    name = request.json.get("name", None)
-    rotation_period = request.json.get("rotation_period", None)
-    orbital_period = request.json.get("orbital_period", None)
-    diameter = request.json.get("diameter", None)
-    climate = request.json.get("climate", None)
-    gravity = request.json.get("gravity", None)
-    terrain = request.json.get("terrain", None)
-    surface_water = request.json.get("surface_water", None)
-    population = request.json.get("population", None)
-    url = request.json.get("url", None)
-
-    planet = Planet(name=name,
-                    rotation_period=rotation_period,
-                    orbital_period=orbital_period,
-                    diameter=diameter,
-                    climate=climate,
-                    gravity=gravity,
-                    terrain=terrain,
-                    surface_water=surface_water,
-                    population=population,
-                    url=url,
-                    created=datetime.now(),
-                    edited=datetime.now()
-                    )
-    db.session.add(planet)
-    db.session.commit()
-
-    planet = Planet.query.filter_by(name=name).first()
-    planet = planet.serialize()
-    return jsonify(planet), 201
+def get_job(id):
+    return job_queue.response(id, current_user_id())
 
-@app.route('/planet/<int:id>', methods=['PUT'])
+@api.route('/stats/favorites/rebuild', methods=['POST'])
 @jwt_required()
-def update_planet(id):
-    planet = Planet.query.get(id)
-
-    if planet is None:
-        raise APIException('Planet not found', status_code=404)
-
-    planet.name = request.json.get("name", None)
-    planet.rotation_period = request.json.get("rotation_period", None)
-    planet.orbital_period = request.json.get("orbital_period", None)
-    planet.diameter = request.json.get("diameter", None)
-    planet.climate = request.json.get("climate", None)
-    planet.gravity = request.json.get("gravity", None)
-    planet.terrain = request.json.get("terrain", None)
-    planet.surface_water = request.json.get("surface_water", None)
-    planet.population = request.json.get("population", None)
-    planet.url = request.json.get("url", None)
-    planet.edited = datetime.now()
-
-    db.session.commit()
-
-    planet = Planet.query.get(id)
-    planet = planet.serialize()
-    return jsonify(planet), 201
-
-@app.route('/planet/<int:id>', methods=['DELETE'])
-@jwt_required()
-def delete_planet(id):
-    planet = Planet.query.get(id)
-    if planet is None:
-        raise APIException('Planet not found', status_code=404)
-    db.session.delete(planet)
-    db.session.commit()
-
-    planets_query = Planet.query.all()
-    all_planets = list(map(lambda x: x.serialize(), planets_query))
-    return jsonify(all_planets), 200
-
-@app.route('/users', methods=['GET'])
-def get_users():
-    user_query = User.query.all()
-    all_users = list(map(lambda x: x.serialize(), user_query))
-    return jsonify(all_users)
-
-@app.route('/user/<int:id>', methods=['GET'])
-def get_user(id):
-    user = User.query.get(id)
-    if user is None:
-        raise APIException('User not found', status_code=404)
-    user = user.serialize()
-    return jsonify(user), 200
-
-@app.route('/users', methods=['POST'])
-def add_user():
-    user = User.query.filter_by(email=request.json.get("email", None)).first()
-    if user is not None:
-        raise APIException('User already exist', status_code=409)
-
-    name = request.json.get("name", None)
-    email = request.json.get("email", None)
-    password = request.json.get("password", None)
-
-    user = User(name=name,
-                email=email,
-                password=password
-                )
-    db.session.add(user)
-    db.session.commit()
-
-    user = User.query.filter_by(email=email).first()
-    user = user.serialize()
-    return jsonify(user), 201
-
-@app.route('/users/<int:id>', methods=['PUT'])
+def rebuild_favorite_stats():
+    return job_queue.accepted_response(db.session, "rebuild_favorite_counts", {}, current_user_id(), reuse=True)
+
+@api.route('/stats/people/homeworld', methods=['GET'])
+@read_replica
+def get_people_per_homeworld():
+    return group_counts(Character, "homeworld")
+
+@api.route('/stats/people/gender', methods=['GET'])
+@read_replica
+def get_people_per_gender():
+    return group_counts(Character, "gender")
+
+@api.route('/stats/planets/climate', methods=['GET'])
+@read_replica
+def get_population_per_climate():
+    return climate_population()
+
+@api.route('/stats/favorites/planets', methods=['GET'])
+@read_replica
+def get_most_favorited_planets():
+    return most_favorited("planets")
+
+@api.route('/stats/favorites/people', methods=['GET'])
+@read_replica
+def get_most_favorited_people():
+    return most_favorited("people")
+
+@api.route('/users/favorites', methods=['GET'])
 @jwt_required()
-def update_user(id):
-    user = User.query.get(id)
-
-    if user is None:
+@read_replica
+def get_user_favorites():
+    user_id = current_user_id()
+    if user_id is None:
         raise APIException('User not found', status_code=404)
 
-    user.name = request.json.get("name", None)
-    user.email = request.json.get("email", None)
-
-    db.session.commit()
-
-    user = User.query.get(id)
-    user = user.serialize()
-    return jsonify(user), 201
-
-@app.route('/users/<int:id>', methods=['DELETE'])
+    # ?expand=true embeds the favorited entities, joined in the same query
+    expand = request.args.get("expand", None) == "true"
+    characters_query = FavoriteCharacter.query.filter_by(user_id=user_id)
+    planets_query = FavoritePlanet.query.filter_by(user_id=user_id)
+    if expand:
+        characters_query = characters_query.options(joinedload(FavoriteCharacter.character))
+        planets_query = planets_query.options(joinedload(FavoritePlanet.planet))
+
+    fav_characters = characters_query.all()
+    fav_planets = planets_query.all()
+    user_fav = (serialize_instances(FavoriteCharacter, fav_characters)
+                + serialize_instances(FavoritePlanet, fav_planets))
+    if expand:
+        characters = serialize_instances(Character, [favorite.character for favorite in fav_characters])
+        planets = serialize_instances(Planet, [favorite.planet for favorite in fav_planets])
+        for item, embedded in zip(user_fav, characters + planets):
+            item["character" if "character_id" in item else "planet"] = embedded
+    return json_response(user_fav)
+
+@api.route('/users/favorites', methods=['PATCH'])
 @jwt_required()
-def delete_user(id):
-    user = User.query.get(id)
+def patch_user_favorites():
+    user = get_current_user()
     if user is None:
         raise APIException('User not found', status_code=404)
-    db.session.delete(user)
-    db.session.commit()
-
-    users_query = User.query.all()
-    all_users = list(map(lambda x: x.serialize(), users_query))
-    return jsonify(all_users), 200
+    # adds and removes sets of ids in one transaction, answers with the favorites that changed
+    return patch_favorites_response(user.id)
 
-@app.route('/users/favorites', methods=['GET'])
-@jwt_required()
-def get_user_favorites():
-    current_user = get_jwt_identity()
-    user = User.query.filter_by(email=current_user).first()
-    user_fav_characters = FavoriteCharacter.query.filter_by(user_id=user.id).all()
-    user_fav_characters = list(map(lambda x: x.serialize(), user_fav_characters))
-    user_fav_planets = FavoritePlanet.query.filter_by(user_id=user.id).all()
-    user_fav_planets = list(map(lambda x: x.serialize(), user_fav_planets))
-    user_fav = user_fav_characters + user_fav_planets
-    return jsonify(user_fav)
-
-@app.route('/favorite/planet/<int:planet_id>', methods=['POST'])
+@api.route('/favorite/planet/<int:planet_id>', methods=['POST'])
 @jwt_required()
 def add_favorite_planet(planet_id):
-    current_user = get_jwt_identity()
-    user = User.query.filter_by(email=current_user).first()
+    user = get_current_user()
     planet_exists = Planet.query.get(planet_id) is not None
     user_exists = user is not None
     if not planet_exists:
@@ -316,20 +233,17 @@ def add_favorite_planet(planet_id):
     if not user_exists:
         raise APIException('User not found', status_code=404)
     
-    fav_exists = FavoritePlanet.query.filter_by(user_id=user.id, planet_id=planet_id).first() is not None
-    if not fav_exists and planet_exists and user_exists:
-        fav_planet = FavoritePlanet(planet_id=planet_id, user_id=user.id)
-        db.session.add(fav_planet)
-        db.session.commit()
-        return get_user_favorites()
-    else:
-        raise APIException('Favorite already exist', status_code=409)
-
-@app.route('/favorite/people/<int:character_id>', methods=['POST'])
+    # the (user_id, planet_id) unique constraint rejects duplicates
+    fav_planet = FavoritePlanet(planet_id=planet_id, user_id=user.id)
+    db.session.add(fav_planet)
+    increment_favorites(db.session, PlanetFavoriteCount, {planet_id: 1})
+    commit_or_conflict(db.session, 'Favorite already exist')
+    return get_user_favorites()
+
+@api.route('/favorite/people/<int:character_id>', methods=['POST'])
 @jwt_required()
 def add_favorite_people(character_id):
-    current_user = get_jwt_identity()
-    user = User.query.filter_by(email=current_user).first()
+    user = get_current_user()
     character_exists = Character.query.get(character_id) is not None
     user_exists = user is not None
     if not character_exists:
@@ -337,58 +251,50 @@ def add_favorite_people(character_id):
     if not user_exists:
         raise APIException('User not found', status_code=404)
     
-    fav_exists = FavoriteCharacter.query.filter_by(user_id=user.id, character_id=character_id).first() is not None
-    if not fav_exists and character_exists and user_exists:
-        fav_character = FavoriteCharacter(character_id=character_id, user_id=user.id)
-        db.session.add(fav_character)
-        db.session.commit()
-        return get_user_favorites()
-    else:
-        raise APIException('Favorite already exist', status_code=409)
-
-@app.route('/favorite/planet/<int:planet_id>', methods=['DELETE'])
+    # the (user_id, character_id) unique constraint rejects duplicates
+    fav_character = FavoriteCharacter(character_id=character_id, user_id=user.id)
+    db.session.add(fav_character)
+    increment_favorites(db.session, CharacterFavoriteCount, {character_id: 1})
+    commit_or_conflict(db.session, 'Favorite already exist')
+    return get_user_favorites()
+
+@api.route('/favorite/planet/<int:planet_id>', methods=['DELETE'])
 @jwt_required()
 def delete_favorite_planet(planet_id):
-    current_user = get_jwt_identity()
-    user = User.query.filter_by(email=current_user).first()
+    user_id = current_user_id()
     planet_exists = Planet.query.get(planet_id) is not None
-    user_exists = user is not None
     if not planet_exists:
         raise APIException('Planet not found', status_code=404)
-    if not user_exists:
+    if user_id is None:
         raise APIException('User not found', status_code=404)
     
-    favorite = FavoritePlanet.query.filter_by(user_id=user.id, planet_id=planet_id).first()
-    fav_exists = favorite is not None
-    if fav_exists and planet_exists and user_exists:
-        db.session.delete(favorite)
-        db.session.commit()
-        return get_user_favorites()
-    else:
+    deleted = FavoritePlanet.query.filter_by(user_id=user_id, planet_id=planet_id).delete()
+    if not deleted:
         raise APIException('Favorite not found', status_code=404)
+    increment_favorites(db.session, PlanetFavoriteCount, {planet_id: -deleted})
+    change_feed.record(db.session, FavoritePlanet, [planet_id], "delete", user_id)
+    db.session.commit()
+    return get_user_favorites()
 
-@app.route('/favorite/people/<int:character_id>', methods=['DELETE'])
+@api.route('/favorite/people/<int:character_id>', methods=['DELETE'])
 @jwt_required()
 def delete_favorite_people(character_id):
-    current_user = get_jwt_identity()
-    user = User.query.filter_by(email=current_user).first()
+    user_id = current_user_id()
     character_exists = Character.query.get(character_id) is not None
-    user_exists = user is not None
     if not character_exists:
         raise APIException('Character not found', status_code=404)
-    if not user_exists:
+    if user_id is None:
         raise APIException('User not found', status_code=404)
     
-    favorite = FavoriteCharacter.query.filter_by(user_id=user.id, character_id=character_id).first()
-    fav_exists = favorite is not None
-    if fav_exists and character_exists and user_exists:
-        db.session.delete(favorite)
-        db.session.commit()
-        return get_user_favorites()
-    else:
+    deleted = FavoriteCharacter.query.filter_by(user_id=user_id, character_id=character_id).delete()
+    if not deleted:
         raise APIException('Favorite not found', status_code=404)
+    increment_favorites(db.session, CharacterFavoriteCount, {character_id: -deleted})
+    change_feed.record(db.session, FavoriteCharacter, [character_id], "delete", user_id)
+    db.session.commit()
+    return get_user_favorites()
 
 # this only runs if `$ python src/main.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    create_app().run(host='0.0.0.0', port=PORT, debug=False)
@@ -1,9 +1,15 @@
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+from database import RoutingSQLAlchemy
+from sqlalchemy.dialects.mysql import LONGTEXT, DATETIME
+from datetime import datetime
 import enum
 import json
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+# `edited` keeps the microseconds (mysql drops them by default) and is bumped by every
+# update, the ETags of the collections are derived from it
+EDITED = db.DateTime().with_variant(DATETIME(fsp=6), "mysql")
 
 class Gender(str, enum.Enum):
     MALE = "male"
@@ -19,12 +25,21 @@ class Character(db.Model):
     skin_color = db.Column(db.String(250), nullable=False)
     eye_color = db.Column(db.String(250), nullable=False)
     birth_year = db.Column(db.String(250), nullable=False)
-    gender = db.Column(db.Enum(Gender), nullable=False)
+    gender = db.Column(db.Enum(Gender), nullable=False, index=True)
     created = db.Column(db.DateTime, nullable=False)
-    edited = db.Column(db.DateTime, nullable=False)
-    homeworld = db.Column(db.Integer, db.ForeignKey('planet.id'), nullable=False)
+    edited = db.Column(EDITED, nullable=False, onupdate=datetime.now)
+    homeworld = db.Column(db.Integer, db.ForeignKey('planet.id'), nullable=False, index=True)
     favorite_character = db.relationship('FavoriteCharacter', backref='character', lazy=True)
 
+    # columns exposed by serialize() and the ones the collection endpoint can filter by
+    public_fields = ("id", "name", "height", "mass", "hair_color", "skin_color", "eye_color",
+                     "birth_year", "gender", "created", "edited", "homeworld")
+    filter_fields = ("homeworld", "gender")
+    # columns matched by /search and their ranking weight
+    search_fields = {"name": 2.0, "hair_color": 1.0, "skin_color": 1.0, "eye_color": 1.0}
+    # ?include= names and the relationship they embed
+    includes = {"homeworld": "planet"}
+
     def __repr__(self):
         return f'<Character {self.name}>'
 
@@ -51,17 +66,23 @@ class Planet(db.Model):
     rotation_period = db.Column(db.Integer, nullable=False)
     orbital_period = db.Column(db.Integer, nullable=False)
     diameter = db.Column(db.Integer, nullable=False)
-    climate = db.Column(db.String(250), nullable=False)
+    climate = db.Column(db.String(250), nullable=False, index=True)
     gravity = db.Column(db.String(250), nullable=False)
     terrain = db.Column(db.String(250), nullable=False)
     surface_water = db.Column(db.Integer, nullable=False)
     population = db.Column(db.Integer, nullable=False)
     url = db.Column(db.String(250), nullable=False)
     created= db.Column(db.DateTime, nullable=False)
-    edited = db.Column(db.DateTime, nullable=False)
+    edited = db.Column(EDITED, nullable=False, onupdate=datetime.now)
     character = db.relationship('Character', backref='planet', lazy=True)
     favorite_planet = db.relationship('FavoritePlanet', backref='planet', lazy=True)
 
+    public_fields = ("id", "name", "rotation_period", "orbital_period", "diameter", "climate",
+                     "gravity", "terrain", "surface_water", "population", "url", "created", "edited")
+    filter_fields = ("climate",)
+    search_fields = {"name": 2.0, "climate": 1.0, "terrain": 1.0}
+    includes = {"residents": "character"}
+
     def __repr__(self):
         return f'<Planet {self.name}>'
 
@@ -84,10 +105,14 @@ class Planet(db.Model):
         }
 
 class FavoriteCharacter(db.Model):
+    # the unique constraint also serves the lookups by user_id (leftmost column)
+    __table_args__ = (db.UniqueConstraint('user_id', 'character_id', name='uq_favorite_character_user_character'),)
     id = db.Column(db.Integer, primary_key=True)
-    character_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
+    character_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
+    public_fields = ("id", "character_id", "user_id")
+
     def __repr__(self):
         return f'<FavoriteCharacter {self.id}>'
 
@@ -100,10 +125,14 @@ class FavoriteCharacter(db.Model):
         }
 
 class FavoritePlanet(db.Model):
+    # the unique constraint also serves the lookups by user_id (leftmost column)
+    __table_args__ = (db.UniqueConstraint('user_id', 'planet_id', name='uq_favorite_planet_user_planet'),)
     id = db.Column(db.Integer, primary_key=True)
-    planet_id = db.Column(db.Integer, db.ForeignKey('planet.id'), nullable=False)
+    planet_id = db.Column(db.Integer, db.ForeignKey('planet.id'), nullable=False, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
+    public_fields = ("id", "planet_id", "user_id")
+
     def __repr__(self):
         return f'<FavoritePlanet {self.id}>'
 
@@ -115,6 +144,64 @@ class FavoritePlanet(db.Model):
             # do not serialize the password, its a security breach
         }
 
+# favorites per planet and per character, kept by stats.increment_favorites in the
+# transaction of every favorite write so the most favorited lists are an index scan
+class PlanetFavoriteCount(db.Model):
+    planet_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    favorites = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+    public_fields = ("planet_id", "favorites")
+
+    def __repr__(self):
+        return f'<PlanetFavoriteCount {self.planet_id}>'
+
+class CharacterFavoriteCount(db.Model):
+    character_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    favorites = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+    public_fields = ("character_id", "favorites")
+
+    def __repr__(self):
+        return f'<CharacterFavoriteCount {self.character_id}>'
+
+# append-only log of the writes, read by /changes and its stream, the id is the cursor
+class Change(db.Model):
+    __tablename__ = "change_log"
+    id = db.Column(db.Integer, primary_key=True)
+    resource = db.Column(db.String(32), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(8), nullable=False)
+    # set for the favorites, which only their user sees
+    user_id = db.Column(db.Integer, nullable=True)
+    created = db.Column(db.DateTime, nullable=False, index=True)
+
+    public_fields = ("id", "resource", "entity_id", "operation", "created")
+
+    def __repr__(self):
+        return f'<Change {self.id}>'
+
+# queue of the background jobs, see src/jobs.py
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    # json, a bulk import holds all of its items
+    payload = db.Column(db.Text().with_variant(LONGTEXT(), "mysql"), nullable=False)
+    # queued, running, done or failed
+    status = db.Column(db.String(16), nullable=False, index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    result = db.Column(db.Text().with_variant(LONGTEXT(), "mysql"), nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    # who queued it, only they see its status
+    user_id = db.Column(db.Integer, nullable=True)
+    created = db.Column(db.DateTime, nullable=False)
+    started = db.Column(db.DateTime, nullable=True)
+    finished = db.Column(db.DateTime, nullable=True, index=True)
+
+    public_fields = ("id", "kind", "status", "attempts", "created", "started", "finished")
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind}>'
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(250), nullable=False)
@@ -123,6 +210,9 @@ class User(db.Model):
     favorite_character = db.relationship('FavoriteCharacter', backref='user', lazy=True)
     favorite_planet = db.relationship('FavoritePlanet', backref='user', lazy=True)
 
+    public_fields = ("id", "name", "email")
+    filter_fields = ("email",)
+
     def __repr__(self):
         return f'<User {self.name}>'
 
@@ -0,0 +1,220 @@
+from datetime import datetime
+from urllib.parse import urlencode
+from flask import request, Response, stream_with_context
+from utils import APIException
+from serialization import dumps, json_response, serialize_rows
+from conditional import collection_validators, is_not_modified, not_modified_response, set_validators
+from cache import collection_cache
+from includes import parse_includes, include_columns, include_models, embed_includes
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 1000
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# query string suffixes accepted for range filters on the filter_fields, e.g. ?homeworld__gte=10
+RANGE_OPERATORS = {
+    "gt": lambda column, value: column > value,
+    "gte": lambda column, value: column >= value,
+    "lt": lambda column, value: column < value,
+    "lte": lambda column, value: column <= value,
+}
+
+# parameters that are never treated as filters
+RESERVED_PARAMS = ("limit", "cursor", "fields", "stream", "full", "include")
+
+
+def coerce_value(column, value):
+    python_type = column.type.python_type
+    try:
+        if python_type is datetime:
+            return datetime.fromisoformat(value)
+        return python_type(value)
+    except (TypeError, ValueError):
+        raise APIException(f'Invalid value for {column.key}: {value}', status_code=400)
+
+
+def parse_fields(public_fields):
+    fields = request.args.get("fields", None)
+    if not fields:
+        return list(public_fields)
+    fields = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in fields if field not in public_fields]
+    if unknown:
+        raise APIException('Unknown fields: ' + ", ".join(unknown), status_code=400)
+    # the id is always loaded because the cursor is built from it
+    if "id" not in fields:
+        fields.insert(0, "id")
+    return fields
+
+
+def parse_filters(model, filter_fields):
+    conditions = []
+    for key, value in request.args.items():
+        if key in RESERVED_PARAMS:
+            continue
+        name, _, operator = key.partition("__")
+        if name not in filter_fields or (operator and operator not in RANGE_OPERATORS):
+            raise APIException(f'Cannot filter by {key}', status_code=400)
+        column = getattr(model, name)
+        value = coerce_value(column, value)
+        if operator:
+            conditions.append(RANGE_OPERATORS[operator](column, value))
+        else:
+            conditions.append(column == value)
+    return conditions
+
+
+def parse_limit():
+    limit = request.args.get("limit", None)
+    if limit is None:
+        return None
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise APIException('limit must be an integer', status_code=400)
+    if limit < 1:
+        raise APIException('limit must be greater than 0', status_code=400)
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def parse_cursor():
+    cursor = request.args.get("cursor", None)
+    if cursor is None:
+        return None
+    try:
+        return int(cursor)
+    except ValueError:
+        raise APIException('Invalid cursor', status_code=400)
+
+
+def build_query(model):
+    """
+    Reads `limit`, `cursor`, `fields` and filter parameters from the query string
+    and returns the query for one page of `model`, the projected fields and the page size.
+    Pages are keyset based (id > cursor ORDER BY id), so every page costs the same.
+    """
+    fields = parse_fields(model.public_fields)
+    # the columns the included entities are matched on
+    for field in include_columns(parse_includes(model)):
+        if field not in fields:
+            fields.append(field)
+    limit = parse_limit()
+    cursor = parse_cursor()
+    if limit is None and cursor is not None:
+        limit = DEFAULT_PAGE_SIZE
+
+    columns = [getattr(model, field) for field in fields]
+    query = model.query.with_entities(*columns)
+    for condition in parse_filters(model, model.filter_fields):
+        query = query.filter(condition)
+    if cursor is not None:
+        query = query.filter(model.id > cursor)
+    query = query.order_by(model.id)
+    return query, fields, limit
+
+
+def page_query(model):
+    query, fields, limit = build_query(model)
+    if limit is not None:
+        # fetch one extra row to know if there is a next page without a COUNT
+        query = query.limit(limit + 1)
+    return query, fields, limit
+
+
+def page_result(rows, fields, limit):
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+    return serialize_rows(fields, rows), next_cursor
+
+
+def paginate(model):
+    """
+    Returns one page of `model` as a list of dicts plus the cursor of the next page.
+    Without `limit` or `cursor` the whole (filtered) collection is returned, like before.
+    """
+    query, fields, limit = page_query(model)
+    return page_result(query.all(), fields, limit)
+
+
+def wants_stream():
+    if request.args.get("stream", None) == "true":
+        return "application/json"
+    best = request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE])
+    if best == NDJSON_MIMETYPE:
+        return NDJSON_MIMETYPE
+    return None
+
+
+def stream_rows(query, fields, mimetype):
+    """
+    Yields the encoded rows of `query` one by one. Rows are fetched from the database
+    in batches of STREAM_BATCH_SIZE, so memory stays flat no matter the table size.
+    """
+    rows = query.yield_per(STREAM_BATCH_SIZE)
+    if mimetype == NDJSON_MIMETYPE:
+        for row in rows:
+            yield dumps(dict(zip(fields, row))) + b"\n"
+        return
+
+    # chunked JSON array
+    yield b"["
+    separator = b""
+    for row in rows:
+        yield separator + dumps(dict(zip(fields, row)))
+        separator = b","
+    yield b"]\n"
+
+
+def stream_response(model, mimetype):
+    query, fields, limit = build_query(model)
+    if limit is not None:
+        query = query.limit(limit)
+    return Response(stream_with_context(stream_rows(query, fields, mimetype)), mimetype=mimetype)
+
+
+def collection_response(model):
+    related = include_models(parse_includes(model))
+    mimetype = wants_stream()
+    if mimetype is not None and related:
+        raise APIException('include is not available for streamed responses', status_code=400)
+    if mimetype is None:
+        key = collection_cache.key(model, related)
+        cached = collection_cache.lookup(key)
+        if cached is not None:
+            return cached
+
+    etag = None
+    if hasattr(model, "edited"):
+        etag = collection_validators(model, parse_filters(model, model.filter_fields), related)
+        if is_not_modified(etag):
+            return not_modified_response(etag)
+
+    if mimetype is not None:
+        response = stream_response(model, mimetype)
+    else:
+        response = paginated_response(model)
+    if etag is not None:
+        set_validators(response, etag)
+    if mimetype is None:
+        collection_cache.store(key, response)
+    return response
+
+
+def paginated_response(model):
+    items, next_cursor = paginate(model)
+    embed_includes(items, parse_includes(model))
+    return page_response(items, next_cursor)
+
+
+def page_response(items, next_cursor):
+    response = json_response(items)
+    if next_cursor is not None:
+        args = request.args.to_dict()
+        args["cursor"] = next_cursor
+        next_url = request.base_url + "?" + urlencode(args)
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    return response
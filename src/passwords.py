@@ -0,0 +1,79 @@
+import os
+import hmac
+import hashlib
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+from utils import APIException
+from cache import MemoryBackend
+
+
+class PasswordHasher:
+    """
+    Salted password hashes (werkzeug's `method$salt$hash` format) computed by a bounded
+    thread pool. Logins beyond the pool and its queue are answered 503 instead of
+    piling up and starving the other requests of the worker.
+    """
+
+    def __init__(self):
+        self.method = None
+        self._executor = None
+        self._slots = None
+        self._verified = None
+
+    def init_app(self, app):
+        # pbkdf2:<digest>:<iterations>, the iterations are the cost
+        app.config.setdefault("PASSWORD_HASH_METHOD", os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000'))
+        app.config.setdefault("PASSWORD_HASH_THREADS", int(os.environ.get('PASSWORD_HASH_THREADS', 2)))
+        app.config.setdefault("PASSWORD_HASH_QUEUE", int(os.environ.get('PASSWORD_HASH_QUEUE', 16)))
+        app.config.setdefault("PASSWORD_CACHE_TTL", int(os.environ.get('PASSWORD_CACHE_TTL', 300)))
+        method = app.config["PASSWORD_HASH_METHOD"]
+        threads = app.config["PASSWORD_HASH_THREADS"]
+        queued = app.config["PASSWORD_HASH_QUEUE"]
+        ttl = app.config["PASSWORD_CACHE_TTL"]
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="password")
+        self._slots = threading.BoundedSemaphore(threads + queued)
+        # keeps a keyed digest of recently verified passwords, the key never leaves the process
+        self._verified = MemoryBackend(ttl=ttl, max_entries=10000) if ttl > 0 else None
+        self._key = secrets.token_bytes(32)
+        # the method as werkzeug writes it in the hashes, with the iterations
+        if method.startswith("pbkdf2:") and method.count(":") == 1:
+            method = f"{method}:{DEFAULT_PBKDF2_ITERATIONS}"
+        self.method = method
+        # compared against for unknown users, hashed on first use to keep the startup fast
+        self._dummy = None
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            raise APIException('Too many logins in progress, retry later', status_code=503)
+        try:
+            return self._executor.submit(function, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method, 16)
+
+    def needs_rehash(self, stored):
+        return not stored.startswith(self.method + "$")
+
+    def verify(self, stored, password):
+        """Checks `password` against the `stored` hash, None for an unknown user takes the same time."""
+        if stored is None or not isinstance(password, str):
+            if self._dummy is None:
+                self._dummy = self.hash(secrets.token_hex(8))
+            self._run(check_password_hash, self._dummy, "")
+            return False
+        digest = hmac.new(self._key, f"{stored}\0{password}".encode(), hashlib.sha256).digest()
+        if self._verified is not None:
+            cached = self._verified.get(stored)
+            if cached is not None and hmac.compare_digest(cached, digest):
+                return True
+        valid = self._run(check_password_hash, stored, password)
+        if valid and self._verified is not None:
+            self._verified.set(stored, digest)
+        return valid
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,190 @@
+import os
+import time
+import random
+import cProfile
+import threading
+from flask import g, request, current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics:
+    """Per endpoint counters and latency histograms, rendered in the Prometheus text format."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def observe(self, endpoint, method, status, wall, sql_count, sql_time, serialize_time):
+        with self._lock:
+            stats = self._endpoints.get((endpoint, method))
+            if stats is None:
+                stats = {"count": 0, "wall": 0.0, "sql_count": 0, "sql_time": 0.0,
+                         "serialize_time": 0.0, "buckets": [0] * len(self.buckets), "status": {}}
+                self._endpoints[(endpoint, method)] = stats
+            stats["count"] += 1
+            stats["wall"] += wall
+            stats["sql_count"] += sql_count
+            stats["sql_time"] += sql_time
+            stats["serialize_time"] += serialize_time
+            stats["status"][status] = stats["status"].get(status, 0) + 1
+            for index, bound in enumerate(self.buckets):
+                if wall <= bound:
+                    stats["buckets"][index] += 1
+
+    def render(self):
+        lines = [
+            "# HELP http_request_duration_seconds Request wall time.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            for (endpoint, method), stats in endpoints:
+                labels = f'endpoint="{endpoint}",method="{method}"'
+                for bound, count in zip(self.buckets, stats["buckets"]):
+                    lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {stats["count"]}')
+                lines.append(f'http_request_duration_seconds_sum{{{labels}}} {stats["wall"]}')
+                lines.append(f'http_request_duration_seconds_count{{{labels}}} {stats["count"]}')
+            for name, key, kind, help in (
+                ("http_requests_total", "status", "counter", "Requests by status code."),
+                ("sql_statements_total", "sql_count", "counter", "SQL statements executed."),
+                ("sql_duration_seconds_total", "sql_time", "counter", "Time spent in SQL statements."),
+                ("serialize_duration_seconds_total", "serialize_time", "counter", "Time spent encoding JSON."),
+            ):
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (endpoint, method), stats in endpoints:
+                    labels = f'endpoint="{endpoint}",method="{method}"'
+                    if key == "status":
+                        for status, count in sorted(stats["status"].items()):
+                            lines.append(f'{name}{{{labels},status="{status}"}} {count}')
+                    else:
+                        lines.append(f'{name}{{{labels}}} {stats[key]}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _record_statement(time.perf_counter() - conn.info["query_start"].pop())
+
+
+def _handle_error(context):
+    # a statement that raises skips after_cursor_execute, its start would stay on the stack.
+    # The errors of the result fetches come without a statement, their start was popped already.
+    connection = context.connection
+    if context.statement is None or connection is None or not connection.info.get("query_start"):
+        return
+    _record_statement(time.perf_counter() - connection.info["query_start"].pop())
+
+
+def _record_statement(elapsed):
+    # statements run outside of a request (cli, migrations) are not tracked
+    if g and "profile" in g:
+        g.profile["sql_count"] += 1
+        g.profile["sql_time"] += elapsed
+
+
+def _record_serialization(started):
+    if g and "profile" in g:
+        g.profile["serialize_time"] += time.perf_counter() - started
+
+
+def timed_json_encoder(encoder):
+    class TimedJSONEncoder(encoder):
+        def encode(self, o):
+            started = time.perf_counter()
+            try:
+                return super().encode(o)
+            finally:
+                _record_serialization(started)
+    return TimedJSONEncoder
+
+
+def timed_json_dumps(dumps):
+    def timed_dumps(obj, **kwargs):
+        started = time.perf_counter()
+        try:
+            return dumps(obj, **kwargs)
+        finally:
+            _record_serialization(started)
+    return timed_dumps
+
+
+def start_profile():
+    g.profile = {"start": time.perf_counter(), "sql_count": 0, "sql_time": 0.0,
+                 "serialize_time": 0.0, "profiler": None}
+    if random.random() < current_app.config["PROFILE_SAMPLE_RATE"]:
+        g.profile["profiler"] = cProfile.Profile()
+        g.profile["profiler"].enable()
+
+
+def finish_profile(response):
+    profile = g.pop("profile", None)
+    if profile is None:
+        return response
+    wall = time.perf_counter() - profile["start"]
+    endpoint = request.endpoint or "unknown"
+
+    profiler = profile["profiler"]
+    if profiler is not None:
+        profiler.disable()
+        if wall * 1000 >= current_app.config["PROFILE_SLOW_MS"]:
+            directory = current_app.config["PROFILE_DIR"]
+            os.makedirs(directory, exist_ok=True)
+            profiler.dump_stats(os.path.join(directory, f"{endpoint}-{int(time.time() * 1000)}.prof"))
+
+    metrics.observe(endpoint, request.method, response.status_code, wall,
+                    profile["sql_count"], profile["sql_time"], profile["serialize_time"])
+    response.headers.add("Server-Timing", ", ".join([
+        f'app;dur={wall * 1000:.2f}',
+        f'db;dur={profile["sql_time"] * 1000:.2f};desc="{profile["sql_count"]} queries"',
+        f'serialize;dur={profile["serialize_time"] * 1000:.2f}',
+    ]))
+    return response
+
+
+def discard_profile(error=None):
+    # unhandled errors skip after_request, the profiler must not stay enabled
+    profile = g.pop("profile", None)
+    if profile is not None and profile["profiler"] is not None:
+        profile["profiler"].disable()
+
+
+def init_profiling(app):
+    """
+    Opt-in request instrumentation, enabled with PROFILING=1: wall time, SQL statement
+    count and time, JSON encoding time per endpoint, exposed as Server-Timing headers and
+    on /metrics. A PROFILE_SAMPLE_RATE share of the requests runs under cProfile and the
+    ones slower than PROFILE_SLOW_MS are dumped to PROFILE_DIR.
+    """
+    app.config.setdefault("PROFILE_SAMPLE_RATE", float(os.environ.get('PROFILE_SAMPLE_RATE', 0)))
+    app.config.setdefault("PROFILE_SLOW_MS", float(os.environ.get('PROFILE_SLOW_MS', 500)))
+    app.config.setdefault("PROFILE_DIR", os.environ.get('PROFILE_DIR', 'profiles'))
+
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(Engine, "handle_error", _handle_error)
+    if hasattr(app, "json"):
+        # Flask 2.2+ encodes through its JSON provider, app.json_encoder is gone in 2.3
+        app.json.dumps = timed_json_dumps(app.json.dumps)
+    else:
+        app.json_encoder = timed_json_encoder(app.json_encoder)
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
+    app.teardown_request(discard_profile)
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return current_app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,167 @@
+import os
+import re
+import math
+import time
+from functools import lru_cache
+from flask import jsonify, current_app, request as current_request
+from flask_jwt_extended import decode_token
+from utils import config_flag
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+RULE = re.compile(r"^\s*(\d+)\s*/\s*(second|minute|hour|day)\s*$")
+
+
+@lru_cache(maxsize=None)
+def parse_rule(rule):
+    """'10/minute' as (seconds between two tokens, seconds of burst), the bucket holds 10 tokens."""
+    match = RULE.match(rule)
+    if match is None or int(match.group(1)) < 1:
+        raise ValueError(f"Invalid rate limit: {rule!r}, expected <count>/<second|minute|hour|day>")
+    interval = PERIODS[match.group(2)] / int(match.group(1))
+    return interval, interval * int(match.group(1))
+
+
+class MemoryStore:
+    """
+    Token buckets of this process, each one a single timestamp (GCRA): the time at which
+    the bucket is full again. A check is one dict read and write without a lock, two
+    threads racing on one key can let one extra request through.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._full_at = {}
+
+    def hit(self, key, interval, burst, now):
+        """Takes a token, returns 0 or the seconds until one is available."""
+        full_at = self._full_at.get(key, now)
+        if full_at < now:
+            full_at = now
+        full_at += interval
+        retry_after = full_at - now - burst
+        if retry_after > 0:
+            return retry_after
+        self._full_at[key] = full_at
+        if len(self._full_at) > self.max_keys:
+            self._sweep(now)
+        return 0
+
+    def _sweep(self, now):
+        # full buckets are the same as missing ones, concurrent writes to the old dict may be lost
+        self._full_at = {key: full_at for key, full_at in list(self._full_at.items()) if full_at > now}
+
+
+class RedisStore:
+    """
+    Buckets shared by every worker. `client` is anything with the redis-py eval
+    interface, so a local stand-in can be used in tests.
+    """
+
+    # same algorithm as MemoryStore, atomic on the server
+    SCRIPT = """
+local now = tonumber(ARGV[1])
+local full_at = tonumber(redis.call('GET', KEYS[1]) or ARGV[1])
+if full_at < now then full_at = now end
+full_at = full_at + tonumber(ARGV[2])
+local retry_after = full_at - now - tonumber(ARGV[3])
+if retry_after > 0 then return tostring(retry_after) end
+redis.call('SET', KEYS[1], tostring(full_at), 'PX', math.ceil((full_at - now) * 1000))
+return '0'
+"""
+
+    def __init__(self, client, prefix="swapi:ratelimit:"):
+        self.client = client
+        self.prefix = prefix
+
+    def hit(self, key, interval, burst, now):
+        return float(self.client.eval(self.SCRIPT, 1, self.prefix + key, repr(now), repr(interval), repr(burst)))
+
+
+def rate_limit(config_key):
+    """
+    Gives a route its own bucket per client, with the rule of app.config[config_key].
+    It only marks the view, the check runs in before_request so the ASGI routes get it too.
+    """
+    def decorator(view):
+        view.rate_limit = config_key
+        return view
+    return decorator
+
+
+class RateLimiter:
+    """
+    Checks every request against a bucket per client (RATELIMIT_DEFAULT) and, for the
+    routes marked with rate_limit(), against a bucket per route and client. Clients are
+    the subject of a valid JWT or the IP address. Over the limit, the answer is a 429
+    with Retry-After.
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self._subjects = {}
+
+    def init_app(self, app):
+        app.config.setdefault("RATELIMIT_ENABLED", os.environ.get('RATELIMIT_ENABLED', '1') == '1')
+        app.config.setdefault("RATELIMIT_DEFAULT", os.environ.get('RATELIMIT_DEFAULT', '100/second'))
+        app.config.setdefault("RATELIMIT_LOGIN", os.environ.get('RATELIMIT_LOGIN', '10/minute'))
+        app.config.setdefault("RATELIMIT_COLLECTIONS", os.environ.get('RATELIMIT_COLLECTIONS', '20/second'))
+        # number of proxies in front of the app appending to X-Forwarded-For, 0 trusts no header
+        app.config.setdefault("RATELIMIT_PROXY_HOPS", int(os.environ.get('RATELIMIT_PROXY_HOPS', 0)))
+        app.config.setdefault("RATELIMIT_STORE", os.environ.get('RATELIMIT_STORE', 'memory'))
+        app.config.setdefault("RATELIMIT_URL", os.environ.get('RATELIMIT_URL', 'redis://localhost:6379/0'))
+        if not config_flag(app.config["RATELIMIT_ENABLED"]):
+            return
+        if self.store is None:
+            if app.config["RATELIMIT_STORE"] == 'redis':
+                import redis
+                self.store = RedisStore(redis.Redis.from_url(app.config["RATELIMIT_URL"]))
+            else:
+                self.store = MemoryStore()
+        for config_key in ("RATELIMIT_DEFAULT", "RATELIMIT_LOGIN", "RATELIMIT_COLLECTIONS"):
+            parse_rule(app.config[config_key])
+        app.before_request(self.check)
+
+    def client(self, app, request):
+        authorization = request.headers.get("Authorization")
+        if authorization is not None and authorization.startswith("Bearer "):
+            token = authorization[7:]
+            subject = self._subjects.get(token)
+            if subject is None:
+                # verified once per token, forged or expired tokens count against the IP
+                try:
+                    subject = f"user:{decode_token(token)['sub']}"
+                except Exception:
+                    subject = ""
+                if len(self._subjects) >= 10000:
+                    self._subjects = {}
+                self._subjects[token] = subject
+            if subject:
+                return subject
+        hops = app.config["RATELIMIT_PROXY_HOPS"]
+        if hops:
+            forwarded = request.access_route
+            if len(forwarded) >= hops:
+                return f"ip:{forwarded[-hops]}"
+        return f"ip:{request.remote_addr}"
+
+    def check(self):
+        # the proxies are resolved once, every access through them costs a lookup
+        app, request = current_app._get_current_object(), current_request._get_current_object()
+        if request.method == "OPTIONS":
+            return None
+        config = app.config
+        client = self.client(app, request)
+        now = time.time()
+        retry_after = self.store.hit(client, *parse_rule(config["RATELIMIT_DEFAULT"]), now)
+        config_key = getattr(app.view_functions.get(request.endpoint), "rate_limit", None)
+        if not retry_after and config_key is not None:
+            retry_after = self.store.hit(f"{request.endpoint}|{client}", *parse_rule(config[config_key]), now)
+        if not retry_after:
+            return None
+        response = jsonify(message='Too many requests', retry_after=round(retry_after, 3))
+        response.status_code = 429
+        response.headers["Retry-After"] = str(math.ceil(retry_after))
+        return response
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,191 @@
+from datetime import datetime
+from flask import request, jsonify
+from flask_jwt_extended import jwt_required
+from utils import APIException, required_fields, save_or_conflict, commit_or_conflict
+from pagination import collection_response
+from cache import entity_cache
+from search import search_index
+from bulk import bulk_response, bulk_job_response
+from database import read_replica
+from ratelimit import rate_limit
+from changes import change_feed
+from includes import parse_includes, entity_body
+from jobs import job_queue
+from cascade import referencing_tables, require
+from auth import current_user_id
+from serialization import json_response
+from models import db
+
+# columns set by the server, never read from the body
+TIMESTAMPS = ("created", "edited")
+
+# action: (path attribute of the resource, suffix of the rule, method)
+ROUTES = {
+    "list": ("collection", "", "GET"),
+    "create": ("collection", "", "POST"),
+    "bulk": ("collection", "/bulk", "POST"),
+    "get": ("item", "/<int:id>", "GET"),
+    "replace": ("write_item", "/<int:id>", "PUT"),
+    "update": ("write_item", "/<int:id>", "PATCH"),
+    "delete": ("write_item", "/<int:id>", "DELETE"),
+}
+READ_ACTIONS = ("list", "get")
+RATE_LIMITS = {"list": "RATELIMIT_COLLECTIONS"}
+
+
+class Resource:
+    """
+    The CRUD routes of one model. The column metadata (writable and required fields,
+    timestamps) is read once here, the handlers only do dict lookups on the body.
+    """
+
+    def __init__(self, model, collection, item, label, write_item=None, fields=None, update_fields=None,
+                 actions=tuple(ROUTES), public=READ_ACTIONS, transforms=None, cascade=None):
+        columns = model.__table__.columns
+        self.model = model
+        self.name = collection.strip("/")
+        self.collection = collection
+        self.item = item
+        # /user/<id> is read, /users/<id> is written
+        self.write_item = write_item or item
+        self.label = label
+        self.actions = actions
+        self.public = public
+        self.fields = tuple(fields or [column.key for column in columns
+                                       if not column.primary_key and column.key not in TIMESTAMPS])
+        self.update_fields = tuple(update_fields or self.fields)
+        self.required = tuple(field for field in required_fields(model) if field in self.fields)
+        self.update_required = tuple(field for field in required_fields(model) if field in self.update_fields)
+        self.timestamps = tuple(field for field in TIMESTAMPS if field in columns)
+        # applied to the incoming values before they are written, e.g. the password hash
+        self.transforms = transforms or {}
+        # job kind deleting the entity with what points at it, run on DELETE ?cascade=true
+        self.cascade = cascade
+
+    def body(self):
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            raise APIException('Expected a JSON object', status_code=400)
+        return body
+
+    def values(self, body, fields, required):
+        missing = [field for field in required if body.get(field, None) is None]
+        if missing:
+            raise APIException('Missing fields: ' + ", ".join(missing), status_code=400)
+        values = {field: body.get(field, None) for field in fields}
+        for field, transform in self.transforms.items():
+            if values.get(field, None) is not None:
+                values[field] = transform(values[field])
+        return values
+
+    def load(self, id):
+        instance = self.model.query.get(id)
+        if instance is None:
+            raise APIException(f'{self.label} not found', status_code=404)
+        return instance
+
+    def save(self, instance, values, status):
+        """Writes the columns whose value differs, an update that changes nothing does not commit."""
+        changed = {field: value for field, value in values.items() if getattr(instance, field) != value}
+        if not changed:
+            return json_response(instance.serialize(), status=status)
+        for field, value in changed.items():
+            setattr(instance, field, value)
+        if "edited" in self.timestamps:
+            instance.edited = datetime.now()
+        return json_response(save_or_conflict(db.session, instance, f'{self.label} already exist'), status=status)
+
+    def list(self):
+        return collection_response(self.model)
+
+    def get(self, id):
+        includes = parse_includes(self.model)
+        if includes:
+            # not cached, the body also changes with the included entities
+            return entity_cache.body_response(entity_body(self.model, id, f'{self.label} not found', includes))
+        return entity_cache.response(self.model, id, f'{self.label} not found')
+
+    def create(self):
+        values = self.values(self.body(), self.fields, self.required)
+        now = datetime.now()
+        for field in self.timestamps:
+            values[field] = now
+        instance = save_or_conflict(db.session, self.model(**values), f'{self.label} already exist')
+        return json_response(instance, status=201)
+
+    def bulk(self):
+        if request.args.get("async", None) == "true":
+            return bulk_job_response(db.session, self.name, current_user_id())
+        return jsonify(bulk_response(db.session, self.model)), 200
+
+    def replace(self, id):
+        instance = self.load(id)
+        return self.save(instance, self.values(self.body(), self.update_fields, self.update_required), 201)
+
+    def update(self, id):
+        body = self.body()
+        unknown = [field for field in body if field not in self.update_fields]
+        if unknown:
+            raise APIException('Unknown fields: ' + ", ".join(unknown), status_code=400)
+        nulls = [field for field in self.update_required if field in body and body[field] is None]
+        if nulls:
+            raise APIException('Fields can not be null: ' + ", ".join(nulls), status_code=400)
+        instance = self.load(id)
+        fields = [field for field in self.update_fields if field in body]
+        return self.save(instance, self.values(body, fields, ()), 200)
+
+    def delete(self, id):
+        if request.args.get("cascade", None) == "true":
+            return self.delete_later(id)
+        referenced = referencing_tables(db.session, self.model, id)
+        if referenced:
+            hint = ", delete it with ?cascade=true" if self.cascade else ""
+            raise APIException(f'{self.label} is still referenced by {", ".join(referenced)}{hint}', status_code=409)
+        deleted = self.model.query.filter_by(id=id).delete()
+        if not deleted:
+            raise APIException(f'{self.label} not found', status_code=404)
+        change_feed.record(db.session, self.model, [id], "delete")
+        commit_or_conflict(db.session, f'{self.label} is still referenced')
+        entity_cache.invalidate(self.model, id)
+        search_index.changed(self.model, [id])
+        # deletes answer with the deleted id, the remaining collection is only sent with ?full=true
+        if request.args.get("full", None) == "true":
+            return collection_response(self.model)
+        return jsonify(id=id, deleted=True), 200
+
+    def delete_later(self, id):
+        """Queues the cascade, the response does not wait for the dependents to be deleted."""
+        if self.cascade is None:
+            raise APIException(f'{self.label} deletes do not cascade', status_code=400)
+        require(db.session, self.model, id, self.label)
+        return job_queue.accepted_response(db.session, self.cascade, {"id": id}, current_user_id(), reuse=True)
+
+
+class ResourceRegistry:
+    """Generates the routes of the registered resources on `blueprint`, endpoints are `<name>_<action>`."""
+
+    def __init__(self, blueprint):
+        self.blueprint = blueprint
+        self.resources = {}
+
+    def __iter__(self):
+        return iter(self.resources.values())
+
+    def register(self, model, collection, item, label, **options):
+        resource = Resource(model, collection, item, label, **options)
+        self.resources[resource.name] = resource
+        for action in resource.actions:
+            attribute, suffix, method = ROUTES[action]
+            self.blueprint.add_url_rule(getattr(resource, attribute) + suffix, f"{resource.name}_{action}",
+                                        self.view(resource, action), methods=[method])
+        return resource
+
+    def view(self, resource, action):
+        view = getattr(resource, action)
+        if action in READ_ACTIONS:
+            view = read_replica(view)
+        if action not in resource.public:
+            view = jwt_required()(view)
+        if action in RATE_LIMITS:
+            view = rate_limit(RATE_LIMITS[action])(view)
+        return view
@@ -0,0 +1,360 @@
+import os
+import re
+import heapq
+import threading
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from flask import request, current_app
+from sqlalchemy import event, func, text
+from utils import APIException
+from serialization import json_response
+from models import Character, Planet
+
+SEARCH_TYPES = {"people": Character, "planets": Planet}
+DEFAULT_SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 50
+MAX_TERMS = 8
+# prefix matches rank below a whole word match of the same field
+PREFIX_FACTOR = 0.5
+# a prefix expands to at most this many words, this is what keeps one letter queries fast
+# on large tables. The database indexes hand over their best MAX_CANDIDATES by their own rank.
+MAX_EXPANSIONS = 32
+MAX_CANDIDATES = 500
+REFRESH_OVERLAP = 30
+TOKEN = re.compile(r"\w+")
+
+
+def tokenize(value):
+    return TOKEN.findall(str(value).lower()) if value is not None else []
+
+
+def parse_search():
+    terms = tokenize(request.args.get("q", ""))[:MAX_TERMS]
+    if not terms:
+        raise APIException('Missing search query q', status_code=400)
+    types = request.args.get("type", ",".join(SEARCH_TYPES)).split(",")
+    unknown = [name for name in types if name not in SEARCH_TYPES]
+    if unknown:
+        raise APIException(f'Unknown search type {", ".join(unknown)}', status_code=400)
+    try:
+        limit = int(request.args.get("limit", DEFAULT_SEARCH_LIMIT))
+    except ValueError:
+        raise APIException('limit must be an integer', status_code=400)
+    if limit < 1 or limit > MAX_SEARCH_LIMIT:
+        raise APIException(f'limit must be between 1 and {MAX_SEARCH_LIMIT}', status_code=400)
+    return terms, types, limit
+
+
+def tsvector_sql(model):
+    # the expression of the GIN index created by migration b52e7c9d4a18, postgres only uses it when they match
+    document = " || ' ' || ".join(f"coalesce({field}, '')" for field in model.search_fields)
+    return f"to_tsvector('simple', {document})"
+
+
+def score_values(model, terms, values):
+    """Same ranking as MemoryIndex: per term the best field weight, halved for a prefix match."""
+    fields = [(weight, str(value).lower()) for weight, value in zip(model.search_fields.values(), values)
+              if value is not None]
+    score = 0.0
+    for term in terms:
+        best = 0.0
+        for weight, value in fields:
+            # the substring test skips the tokenizing of most fields
+            if weight <= best or term not in value:
+                continue
+            for word in TOKEN.findall(value):
+                if word.startswith(term):
+                    best = max(best, weight if word == term else weight * PREFIX_FACTOR)
+        if not best:
+            return 0.0
+        score += best
+    return score
+
+
+def rank_rows(model, terms, rows, limit):
+    """(id, name, score) of the best `limit` rows of (id, *search_fields) candidates."""
+    name = list(model.search_fields).index("name") + 1
+    scored = [(row[0], row[name], score_values(model, terms, row[1:])) for row in rows]
+    return heapq.nsmallest(limit, [row for row in scored if row[2]], key=lambda row: (-row[2], row[0]))
+
+
+class MemoryIndex:
+    """
+    Inverted index of the search_fields of one model: word -> {id: weight}, plus a sorted
+    vocabulary for the prefix lookups. Kept up to date by the session events of this
+    process, and refreshed by the thread of SearchIndex for the writes of the other workers.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.postings = {}
+        self.vocabulary = []
+        self.documents = {}
+        self.max_id = 0
+        self.since = None
+        self._lock = threading.RLock()
+
+    def rows(self, session, *conditions):
+        columns = [getattr(self.model, field) for field in self.model.search_fields]
+        query = session.query(self.model.id, *columns)
+        for condition in conditions:
+            query = query.filter(condition)
+        return query.order_by(self.model.id).yield_per(10000)
+
+    def build(self, session):
+        # only called before the index is searched, the writes made meanwhile are picked up by refresh()
+        self.since = datetime.now()
+        for row in self.rows(session):
+            self.max_id = max(self.max_id, row[0])
+            self.add(row[0], row[1:], sort=False)
+        self.vocabulary = sorted(self.postings)
+
+    def refresh(self, session):
+        """
+        Indexes the rows inserted or edited since the last refresh and drops the deleted ones.
+        `edited` is set before the commit, REFRESH_OVERLAP covers the writes committed late.
+        """
+        model = self.model
+        since, self.since = self.since, datetime.now()
+        edited = model.edited >= since - timedelta(seconds=REFRESH_OVERLAP)
+        for row in self.rows(session, (model.id > self.max_id) | edited):
+            self.max_id = max(self.max_id, row[0])
+            self.add(row[0], row[1:])
+        if session.query(func.count(model.id)).scalar() != len(self.documents):
+            # rows deleted by another worker, only their ids are read to find them
+            present = {id for (id,) in session.query(model.id).yield_per(10000)}
+            for id in [id for id in list(self.documents) if id not in present]:
+                self.remove(id)
+
+    def add(self, id, values, sort=True):
+        with self._lock:
+            self.remove(id)
+            words = {}
+            for (field, weight), value in zip(self.model.search_fields.items(), values):
+                for word in tokenize(value):
+                    words[word] = max(words.get(word, 0), weight)
+            for word, weight in words.items():
+                posting = self.postings.get(word)
+                if posting is None:
+                    posting = self.postings[word] = {}
+                    if sort:
+                        insort(self.vocabulary, word)
+                posting[id] = weight
+            self.documents[id] = tuple(words)
+
+    def remove(self, id):
+        with self._lock:
+            for word in self.documents.pop(id, ()):
+                posting = self.postings[word]
+                del posting[id]
+                if not posting:
+                    del self.postings[word]
+                    del self.vocabulary[bisect_left(self.vocabulary, word)]
+
+    def expand(self, term):
+        index = bisect_left(self.vocabulary, term)
+        words = []
+        while index < len(self.vocabulary) and len(words) < MAX_EXPANSIONS:
+            word = self.vocabulary[index]
+            if not word.startswith(term):
+                break
+            words.append((word, 1.0 if word == term else PREFIX_FACTOR))
+            index += 1
+        return words
+
+    def search(self, terms, limit):
+        """(id, score) of the best matches, every term has to match a word or a word prefix."""
+        with self._lock:
+            expanded = [self.expand(term) for term in terms]
+            if not all(expanded):
+                return []
+            expanded.sort(key=lambda words: sum(len(self.postings[word]) for word, factor in words))
+            # the rarest term picks the candidates, all of them are ranked
+            scores = {}
+            for word, factor in expanded[0]:
+                for id, weight in self.postings[word].items():
+                    if weight * factor > scores.get(id, 0.0):
+                        scores[id] = weight * factor
+            for expansions in expanded[1:]:
+                term_scores = {}
+                for word, factor in expansions:
+                    posting = self.postings[word]
+                    if len(posting) < len(scores):
+                        matches = [(id, weight) for id, weight in posting.items() if id in scores]
+                    else:
+                        matches = [(id, posting[id]) for id in scores if id in posting]
+                    for id, weight in matches:
+                        if weight * factor > term_scores.get(id, 0.0):
+                            term_scores[id] = weight * factor
+                scores = {id: score + term_scores[id] for id, score in scores.items() if id in term_scores}
+            return heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+class SearchIndex:
+    """
+    Backs /search with the database full-text index when the migration created it
+    (SQLite FTS5, Postgres tsvector) and with a MemoryIndex per model otherwise.
+    SEARCH_BACKEND=memory or database forces one of them. The MemoryIndexes are built and
+    refreshed by a thread of each worker, started by its first request, a search answers
+    503 until they are ready.
+    """
+
+    def __init__(self):
+        self.indexes = {}
+        self.backends = {}
+        self.db = None
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def init_app(self, app, db):
+        self.db = db
+        app.config.setdefault("SEARCH_BACKEND", os.environ.get('SEARCH_BACKEND', 'auto'))
+        app.config.setdefault("SEARCH_REFRESH_SECONDS", float(os.environ.get('SEARCH_REFRESH_SECONDS', 5)))
+        if not event.contains(db.session, 'after_flush', self._collect_changes):
+            event.listen(db.session, 'after_flush', self._collect_changes)
+            event.listen(db.session, 'after_commit', self._apply_changes)
+            event.listen(db.session, 'after_rollback', self._discard_changes)
+        app.before_request(self.start)
+
+    def start(self):
+        # like the job workers, each gunicorn worker starts its thread on its first request
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, args=(current_app._get_current_object(),),
+                             name="search-index", daemon=True).start()
+
+    def _run(self, app):
+        with app.app_context():
+            while True:
+                for model in SEARCH_TYPES.values():
+                    try:
+                        if self.backend(model) != "memory":
+                            continue
+                        index = self.indexes.get(model)
+                        if index is None:
+                            index = MemoryIndex(model)
+                            index.build(self.db.session)
+                            self.indexes[model] = index
+                        else:
+                            index.refresh(self.db.session)
+                    except Exception:
+                        app.logger.exception("Indexing %s for the search failed", model.__tablename__)
+                    finally:
+                        self.db.session.remove()
+                self._wakeup.wait(app.config["SEARCH_REFRESH_SECONDS"])
+                self._wakeup.clear()
+
+    def backend(self, model):
+        engine = self.db.session.get_bind()
+        key = (str(engine.url), model)
+        if key not in self.backends:
+            setting = current_app.config["SEARCH_BACKEND"]
+            has_index = setting != "memory" and self.has_database_index(engine, model)
+            if setting == "database" and not has_index:
+                raise APIException('The search index is missing, run the migrations', status_code=500)
+            self.backends[key] = "database" if has_index else "memory"
+        return engine.dialect.name if self.backends[key] == "database" else "memory"
+
+    def has_database_index(self, engine, model):
+        table = model.__tablename__
+        if engine.dialect.name == "sqlite":
+            query = text("SELECT 1 FROM sqlite_master WHERE name = :name")
+            return self.db.session.execute(query, {"name": f"{table}_search"}).first() is not None
+        if engine.dialect.name == "postgresql":
+            query = text("SELECT 1 FROM pg_indexes WHERE indexname = :name")
+            return self.db.session.execute(query, {"name": f"ix_{table}_search"}).first() is not None
+        return False
+
+    def search(self, model, terms, limit):
+        backend = self.backend(model)
+        if backend == "sqlite":
+            return self.search_sqlite(model, terms, limit)
+        if backend == "postgresql":
+            return self.search_postgresql(model, terms, limit)
+        return self.search_memory(model, terms, limit)
+
+    def search_sqlite(self, model, terms, limit):
+        table = model.__tablename__
+        columns = ", ".join(f"m.{field}" for field in model.search_fields)
+        weights = ", ".join(str(weight) for weight in model.search_fields.values())
+        query = text(
+            f'SELECT m.id, {columns} FROM (SELECT rowid FROM {table}_search WHERE {table}_search MATCH :query '
+            f'ORDER BY bm25({table}_search, {weights}) LIMIT :candidates) s JOIN "{table}" m ON m.id = s.rowid')
+        match = " ".join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+        rows = self.db.session.execute(query, {"query": match, "candidates": MAX_CANDIDATES})
+        return rank_rows(model, terms, rows, limit)
+
+    def search_postgresql(self, model, terms, limit):
+        columns = [getattr(model, field) for field in model.search_fields]
+        query = self.db.session.query(model.id, *columns).filter(
+            text(f"{tsvector_sql(model)} @@ to_tsquery('simple', :query)")).order_by(
+            text(f"ts_rank({tsvector_sql(model)}, to_tsquery('simple', :query)) DESC")).limit(MAX_CANDIDATES)
+        match = " & ".join(f"{term}:*" for term in terms)
+        return rank_rows(model, terms, query.params(query=match), limit)
+
+    def search_memory(self, model, terms, limit):
+        index = self.memory_index(model)
+        matches = index.search(terms, limit)
+        if not matches:
+            return []
+        names = dict(self.db.session.query(model.id, model.name).filter(model.id.in_([id for id, score in matches])))
+        return [(id, names[id], score) for id, score in matches if id in names]
+
+    def memory_index(self, model):
+        index = self.indexes.get(model)
+        if index is None:
+            self.start()
+            self._wakeup.set()
+            raise APIException('The search index is being built, retry later', status_code=503)
+        return index
+
+    def changed(self, model, ids):
+        """Reindexes `ids` after writes that skip the session events (bulk mappings, query deletes)."""
+        index = self.indexes.get(model)
+        if index is None:
+            return
+        found = set()
+        for row in index.rows(self.db.session, model.id.in_(list(ids))):
+            index.add(row[0], row[1:])
+            found.add(row[0])
+        for id in set(ids) - found:
+            index.remove(id)
+
+    def _collect_changes(self, session, flush_context):
+        changes = session.info.setdefault("search_changes", {})
+        for instance in list(session.new) + list(session.dirty):
+            model = type(instance)
+            if model in self.indexes:
+                values = tuple(getattr(instance, field) for field in model.search_fields)
+                changes[(model, instance.id)] = values
+        for instance in session.deleted:
+            if type(instance) in self.indexes:
+                changes[(type(instance), instance.id)] = None
+
+    def _apply_changes(self, session):
+        changes = session.info.pop("search_changes", None)
+        for (model, id), values in (changes or {}).items():
+            if values is None:
+                self.indexes[model].remove(id)
+            else:
+                self.indexes[model].add(id, values)
+
+    def _discard_changes(self, session):
+        session.info.pop("search_changes", None)
+
+    def response(self):
+        terms, types, limit = parse_search()
+        results = []
+        for name in types:
+            for id, entity_name, score in self.search(SEARCH_TYPES[name], terms, limit):
+                results.append({"type": name, "id": id, "name": entity_name, "score": round(score, 6)})
+        results.sort(key=lambda result: -result["score"])
+        return json_response(results[:limit])
+
+
+search_index = SearchIndex()
@@ -0,0 +1,120 @@
+import click
+import importlib
+from collections import defaultdict
+from flask import request
+from flask.cli import AppGroup
+from sqlalchemy import func, select
+from utils import APIException
+from serialization import json_response, serialize_rows
+from jobs import job_queue
+from models import (db, Character, Planet, FavoriteCharacter, FavoritePlanet,
+                    CharacterFavoriteCount, PlanetFavoriteCount)
+
+DEFAULT_TOP = 10
+MAX_TOP = 100
+
+# dialects with an upsert, their insert() is imported on use like the dialect itself
+UPSERTS = ("sqlite", "postgresql", "mysql")
+
+# counter table, counted favorites table, favorited entity
+FAVORITE_COUNTERS = {
+    "planets": (PlanetFavoriteCount, FavoritePlanet, Planet),
+    "people": (CharacterFavoriteCount, FavoriteCharacter, Character),
+}
+
+stats_cli = AppGroup("stats", help="Maintains the aggregated statistics.")
+
+
+def counter_key(counter):
+    return counter.__table__.primary_key.columns.values()[0]
+
+
+def increment_favorites(session, counter, deltas):
+    """
+    Adds the {target id: delta} `deltas` to the favorites counters in the current transaction,
+    so they commit or roll back together with the favorite rows they count.
+    """
+    table = counter.__table__
+    key = counter_key(counter)
+    dialect = session.get_bind().dialect.name
+    updates = defaultdict(list)
+    for target_id, delta in deltas.items():
+        updates[delta].append(target_id)
+    # the pending favorites are flushed by the commit, a conflict on them then rolls this back too
+    with session.no_autoflush:
+        added = {target_id: delta for target_id, delta in deltas.items() if delta > 0}
+        if added and dialect in UPSERTS:
+            insert = importlib.import_module(f"sqlalchemy.dialects.{dialect}").insert
+            statement = insert(table).values([{key.name: target_id, "favorites": delta}
+                                              for target_id, delta in added.items()])
+            if dialect == "mysql":
+                statement = statement.on_duplicate_key_update(
+                    favorites=table.c.favorites + statement.inserted.favorites)
+            else:
+                statement = statement.on_conflict_do_update(
+                    index_elements=[key], set_={"favorites": table.c.favorites + statement.excluded.favorites})
+            session.execute(statement)
+            updates = {delta: ids for delta, ids in updates.items() if delta < 0}
+        for delta, ids in updates.items():
+            result = session.execute(table.update().where(key.in_(ids)).values(favorites=table.c.favorites + delta))
+            if result.rowcount < len(ids) and delta > 0:
+                existing = {target_id for (target_id,) in session.execute(select(key).where(key.in_(ids)))}
+                session.execute(table.insert(), [{key.name: target_id, "favorites": delta}
+                                                 for target_id in ids if target_id not in existing])
+
+
+def rebuild_favorite_counts(session):
+    """Recomputes every counter from the favorites tables, for the seeded or repaired databases."""
+    for counter, favorite, target in FAVORITE_COUNTERS.values():
+        key = counter_key(counter)
+        column = getattr(favorite, key.name)
+        session.execute(counter.__table__.delete())
+        counts = session.query(column, func.count(favorite.id)).group_by(column)
+        session.execute(counter.__table__.insert().from_select([key.name, "favorites"], counts))
+    session.commit()
+
+
+@job_queue.handler("rebuild_favorite_counts")
+def rebuild_favorite_counts_job():
+    rebuild_favorite_counts(db.session)
+    return {"counters": list(FAVORITE_COUNTERS)}
+
+
+def parse_top():
+    try:
+        limit = int(request.args.get("limit", DEFAULT_TOP))
+    except ValueError:
+        raise APIException('limit must be an integer', status_code=400)
+    if limit < 1 or limit > MAX_TOP:
+        raise APIException(f'limit must be between 1 and {MAX_TOP}', status_code=400)
+    return limit
+
+
+def group_counts(model, column_name):
+    column = getattr(model, column_name)
+    rows = db.session.query(column, func.count(model.id)).group_by(column).order_by(column)
+    return json_response(serialize_rows((column_name, "count"), rows))
+
+
+def climate_population():
+    rows = (db.session.query(Planet.climate, func.count(Planet.id), func.coalesce(func.sum(Planet.population), 0))
+            .group_by(Planet.climate).order_by(Planet.climate))
+    return json_response(serialize_rows(("climate", "planets", "population"), rows))
+
+
+def most_favorited(kind):
+    counter, favorite, target = FAVORITE_COUNTERS[kind]
+    key = counter_key(counter)
+    rows = (db.session.query(key, target.name, counter.favorites)
+            .join(target, target.id == key)
+            .filter(counter.favorites > 0)
+            .order_by(counter.favorites.desc(), key)
+            .limit(parse_top()))
+    return json_response(serialize_rows(("id", "name", "favorites"), rows))
+
+
+@stats_cli.command("rebuild")
+def rebuild_command():
+    """Recounts the favorites of every planet and character."""
+    rebuild_favorite_counts(db.session)
+    click.echo("favorite counters rebuilt")
@@ -1,4 +1,6 @@
+from functools import lru_cache
 from flask import jsonify, url_for
+from sqlalchemy.exc import IntegrityError
 
 class APIException(Exception):
     status_code = 400
@@ -15,6 +17,10 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+def config_flag(value):
+    # "0"/"1" from the environment, or a bool set in Python
+    return str(value).lower() in ("1", "true")
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
@@ -40,3 +46,63 @@ def generate_sitemap(app):
         <p>Start working on your proyect by following the <a href="https://github.com/4GeeksAcademy/flask-rest-hello/blob/master/docs/_QUICK_START.md" target="_blank">Quick Start</a></p>
         <p>Remember to specify a real endpoint path like: </p>
         <ul style="text-align: left;">"""+links_html+"</ul></div>"
+
+@lru_cache(maxsize=None)
+def required_fields(model):
+    # columns the client has to send, the id and timestamps are set by the server
+    return tuple(column.key for column in model.__table__.columns
+                 if not column.nullable and not column.primary_key and column.key not in ("created", "edited"))
+
+# the constraint a failed write violated, from the SQLSTATE of postgres, the error number of
+# mysql or the message of sqlite
+VIOLATIONS = (
+    ("unique", {"23505"}, {1062, 1586}, ("UNIQUE constraint failed", "PRIMARY KEY must be unique", "is not unique")),
+    ("foreign_key", {"23503"}, {1216, 1217, 1451, 1452}, ("FOREIGN KEY constraint failed",)),
+    ("not_null", {"23502"}, {1048, 1364}, ("NOT NULL constraint failed",)),
+    ("check", {"23514"}, {3819}, ("CHECK constraint failed",)),
+)
+
+VIOLATION_MESSAGES = {
+    "foreign_key": "Refers to an entity that does not exist",
+    "not_null": "Missing a required value",
+    "check": "Invalid value",
+}
+
+def violated_constraint(error):
+    orig = error.orig
+    pgcode = getattr(orig, "pgcode", None)
+    errno = getattr(orig, "errno", None)
+    if errno is None and orig.args and isinstance(orig.args[0], int):
+        errno = orig.args[0]
+    text = str(orig)
+    for kind, pgcodes, errnos, messages in VIOLATIONS:
+        if pgcode in pgcodes or errno in errnos or any(message in text for message in messages):
+            return kind
+    return None
+
+def save_or_conflict(session, instance, message):
+    """
+    Flushes `instance`, serializes it and commits, relying on the unique constraints
+    instead of a pre-SELECT. The instance is serialized before the commit expires it,
+    so no extra SELECT is needed to return it. Only a unique violation is a 409 with
+    `message`, the other constraints are a 400.
+    """
+    try:
+        session.add(instance)
+        session.flush()
+        data = instance.serialize()
+        session.commit()
+    except IntegrityError as error:
+        session.rollback()
+        kind = violated_constraint(error)
+        if kind == "unique":
+            raise APIException(message, status_code=409)
+        raise APIException(VIOLATION_MESSAGES.get(kind, "Invalid data"), status_code=400)
+    return data
+
+def commit_or_conflict(session, message):
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        raise APIException(message, status_code=409)
@@ -1,7 +1,10 @@
 # This file was created to run the application on heroku using gunicorn.
 # Read more about it here: https://devcenter.heroku.com/articles/python-gunicorn
 
-from main import app as application
+from main import create_app
+
+# the `flask db` commands run from the CLI, the web workers don't need to load alembic
+application = create_app({"MIGRATIONS": False})
 
 if __name__ == "__main__":
     application.run()